@@ -25,17 +25,48 @@ Some useful utility functions.
 .. automodule:: dossier.web.routes
 .. automodule:: dossier.web.folder
 .. automodule:: dossier.web.tags
+.. automodule:: dossier.web.compression
+.. automodule:: dossier.web.versions
+.. automodule:: dossier.web.write_behind
+.. automodule:: dossier.web.pool
+.. automodule:: dossier.web.breaker
+.. automodule:: dossier.web.warmup
+.. automodule:: dossier.web.server
+.. automodule:: dossier.web.executor
+.. automodule:: dossier.web.admission
+.. automodule:: dossier.web.timing
+.. automodule:: dossier.web.metrics
+.. automodule:: dossier.web.profiling
+.. automodule:: dossier.web.slowlog
+.. automodule:: dossier.web.memory
+.. automodule:: dossier.web.benchmark
+.. automodule:: dossier.web.loadtest
 '''
-from dossier.web.builder import WebBuilder, add_cli_arguments
-from dossier.web.config import Config
-from dossier.web.filters import already_labeled as filter_already_labeled
-from dossier.web.filters import \
-    nilsimsa_near_duplicates as filter_nilsimsa_near_duplicates
-from dossier.web.folder import Folders
-from dossier.web.interface import SearchEngine, Filter
-from dossier.web.search_engines import random as engine_random
-from dossier.web.search_engines import plain_index_scan as engine_index_scan
-from dossier.web.search_engines import streaming_sample
+
+from __future__ import absolute_import, division, print_function
+
+import importlib
+import sys
+import types
+
+#: Maps each public name to the module and attribute it comes from.
+#: Importing ``dossier.web`` doesn't import any of these modules (which
+#: pull in Elasticsearch, ``kvlayer``, etc.). Each is imported the first
+#: time one of its names is used.
+_LAZY_NAMES = {
+    'WebBuilder': ('dossier.web.builder', 'WebBuilder'),
+    'add_cli_arguments': ('dossier.web.builder', 'add_cli_arguments'),
+    'Config': ('dossier.web.config', 'Config'),
+    'filter_already_labeled': ('dossier.web.filters', 'already_labeled'),
+    'filter_nilsimsa_near_duplicates':
+        ('dossier.web.filters', 'nilsimsa_near_duplicates'),
+    'Folders': ('dossier.web.folder', 'Folders'),
+    'SearchEngine': ('dossier.web.interface', 'SearchEngine'),
+    'Filter': ('dossier.web.interface', 'Filter'),
+    'engine_random': ('dossier.web.search_engines', 'random'),
+    'engine_index_scan': ('dossier.web.search_engines', 'plain_index_scan'),
+    'streaming_sample': ('dossier.web.search_engines', 'streaming_sample'),
+}
 
 __all__ = [
     'WebBuilder', 'add_cli_arguments',
@@ -46,3 +77,38 @@ __all__ = [
     'engine_random', 'engine_index_scan',
     'streaming_sample',
 ]
+
+
+class _LazyModule(types.ModuleType):
+    '''The ``dossier.web`` package, with its public names loaded lazily.
+
+    Python 2 has no module level ``__getattr__``, so the package module
+    is replaced in ``sys.modules`` by an instance of this class.
+    '''
+    def __getattr__(self, name):
+        try:
+            modname, attr = _LAZY_NAMES[name]
+        except KeyError:
+            raise AttributeError(
+                "module '%s' has no attribute '%s'" % (self.__name__, name))
+        value = getattr(importlib.import_module(modname), attr)
+        setattr(self, name, value)
+        return value
+
+    def __dir__(self):
+        return sorted(set(self.__dict__) | set(_LAZY_NAMES))
+
+
+def _install():
+    this = sys.modules[__name__]
+    lazy = _LazyModule(__name__, __doc__)
+    for k, v in vars(this).items():
+        if k not in _LAZY_NAMES:
+            setattr(lazy, k, v)
+    # Keep the original module alive. Otherwise, Python 2 clears its
+    # globals (which the functions above need) when it is collected.
+    lazy._module = this
+    sys.modules[__name__] = lazy
+
+
+_install()
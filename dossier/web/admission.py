@@ -0,0 +1,256 @@
+'''Admission control and load shedding.
+
+.. This software is released under an MIT/X11 open source license.
+   Copyright 2012-2015 Diffeo, Inc.
+
+Some routes, like searches and recursive folder listings, can take
+seconds and hold backend connections the whole time. Under load, they
+can use up every thread of a server, so that cheap routes, like
+fetching a single feature collection or suggesting tags, have to wait
+behind them.
+
+Admission control puts each route into a *group*, and limits the
+number of requests of each group that run at once. When a group is at
+its limit, up to ``queue`` more requests wait for up to ``timeout``
+seconds. Any other request is *shed*: it fails right away with
+``status`` (``503`` by default, or e.g. ``429``) and a
+``Retry-After`` header.
+
+A group can also be a *priority* group. Priority groups are not
+counted against the ``total`` limit shared by all other groups, so
+they always have their own lane. By default, tag suggestions (used
+for autocomplete) are in the ``autocomplete`` priority group.
+
+Admission control is enabled with
+:meth:`dossier.web.WebBuilder.enable_admission_control`::
+
+    app = WebBuilder().enable_admission_control(total=32, groups={
+        'search': {'limit': 8, 'queue': 16, 'timeout': 2},
+    }).get_app()
+
+A route chooses its group with the ``admission`` route option, e.g.,
+``@app.get('/path', admission='search')``. Routes without this option
+are in the ``default`` group, and routes with ``admission=False`` are
+never limited. Requests of groups that have no settings are only
+limited by ``total``.
+
+The counters of each group, including the number of requests shed
+and the time spent waiting in the queue, are reported by
+:func:`dossier.web.routes.v1_status`.
+
+.. autoclass:: AdmissionControl
+.. autoclass:: AdmissionPlugin
+.. autodata:: DEFAULT_GROUPS
+'''
+from __future__ import absolute_import, division, print_function
+
+import logging
+import threading
+import time
+import types
+
+import bottle
+
+
+logger = logging.getLogger(__name__)
+
+#: The settings of each group used when no groups are given to
+#: :meth:`dossier.web.WebBuilder.enable_admission_control`.
+DEFAULT_GROUPS = {
+    'search': {'limit': 8, 'queue': 16, 'timeout': 2},
+    'folders': {'limit': 8, 'queue': 16, 'timeout': 2},
+    'autocomplete': {'limit': 16, 'queue': 32, 'timeout': 0.5,
+                     'priority': True},
+    'default': {'limit': 32, 'queue': 64, 'timeout': 2},
+}
+
+
+class Group(object):
+    '''The limits and counters of one group of routes.'''
+    def __init__(self, name, limit=None, queue=0, timeout=1, priority=False,
+                 status=503, retry_after=1):
+        self.name = name
+        self.limit = limit
+        self.queue = queue
+        self.timeout = timeout
+        self.priority = priority
+        self.status = status
+        self.retry_after = retry_after
+        self.running = 0
+        self.waiting = 0
+        self.admitted = 0
+        self.queued = 0
+        self.shed = 0
+        self.wait_seconds = 0.0
+        self.max_wait_seconds = 0.0
+
+    def stats(self):
+        return {
+            'limit': self.limit,
+            'queue': self.queue,
+            'priority': self.priority,
+            'running': self.running,
+            'waiting': self.waiting,
+            'admitted': self.admitted,
+            'queued': self.queued,
+            'shed': self.shed,
+            'wait_seconds': self.wait_seconds,
+            'max_wait_seconds': self.max_wait_seconds,
+        }
+
+
+class Shed(Exception):
+    '''Raised when a request is not admitted.'''
+    def __init__(self, group, reason):
+        super(Shed, self).__init__(
+            '%s: "%s" requests are being shed' % (reason, group.name))
+        self.group = group
+
+
+class AdmissionControl(object):
+    '''Limits the number of concurrent requests of each group.
+
+    .. automethod:: __init__
+    .. automethod:: admit
+    .. automethod:: release
+    .. automethod:: stats
+    '''
+    def __init__(self, groups=None, total=None, clock=time.time):
+        '''Create new admission control.
+
+        :param dict groups: Maps group names to dictionaries of
+                            settings: ``limit`` (the maximum number of
+                            requests running at once), ``queue`` (the
+                            maximum number of requests waiting),
+                            ``timeout`` (seconds a request may wait),
+                            ``priority``, ``status`` (of responses to
+                            shed requests) and ``retry_after`` (seconds).
+                            If this is ``None`` or empty, then no group
+                            is limited.
+        :param int total: The maximum number of requests, of all groups
+                          except priority groups, running at once.
+        :param clock: A function returning the current time.
+        '''
+        self.total = total
+        self.clock = clock
+        self.groups = dict((name, Group(name, **settings))
+                           for name, settings in (groups or {}).items())
+        self.running = 0
+        self.lock = threading.Lock()
+        self.released = threading.Condition(self.lock)
+
+    @property
+    def enabled(self):
+        return len(self.groups) > 0 or self.total is not None
+
+    def admit(self, name):
+        '''Wait until a request of group ``name`` may run.
+
+        Every call that returns must be followed by a call to
+        :meth:`release` with the group that is returned.
+
+        :raises Shed: if the request should be rejected.
+        :rtype: ``Group`` or ``None``
+        '''
+        with self.lock:
+            group = self.groups.get(name)
+            if group is None:
+                if self.total is None:
+                    return None
+                group = self.groups[name] = Group(name)
+            if self._has_room(group):
+                return self._take(group, 0)
+            if group.waiting >= group.queue:
+                group.shed += 1
+                raise Shed(group, 'queue full')
+            start = self.clock()
+            deadline = start + group.timeout
+            group.waiting += 1
+            group.queued += 1
+            try:
+                while not self._has_room(group):
+                    remaining = deadline - self.clock()
+                    if remaining <= 0:
+                        group.shed += 1
+                        raise Shed(group, 'timed out in queue')
+                    self.released.wait(remaining)
+            finally:
+                group.waiting -= 1
+            return self._take(group, self.clock() - start)
+
+    def release(self, group):
+        '''Mark a request admitted by :meth:`admit` as finished.'''
+        if group is None:
+            return
+        with self.lock:
+            group.running -= 1
+            if not group.priority:
+                self.running -= 1
+            self.released.notify_all()
+
+    def stats(self):
+        '''Return the counters of every group as a dictionary.'''
+        with self.lock:
+            return dict((name, g.stats()) for name, g in self.groups.items())
+
+    def _has_room(self, group):
+        if group.limit is not None and group.running >= group.limit:
+            return False
+        if group.priority or self.total is None:
+            return True
+        return self.running < self.total
+
+    def _take(self, group, waited):
+        group.running += 1
+        group.admitted += 1
+        group.wait_seconds += waited
+        group.max_wait_seconds = max(group.max_wait_seconds, waited)
+        if not group.priority:
+            self.running += 1
+        return group
+
+
+class AdmissionPlugin(object):
+    '''A Bottle plugin that applies :class:`AdmissionControl`.
+
+    The group of a request is released once the route returns or, for
+    streamed responses, once the body has been sent.
+    '''
+    api = 2
+    name = 'admission'
+
+    def __init__(self, admission):
+        self.admission = admission
+
+    def apply(self, callback, route):
+        name = route.config.get('admission', 'default')
+        if name is False:
+            return callback
+
+        def _(*args, **kwargs):
+            try:
+                group = self.admission.admit(name)
+            except Shed as e:
+                logger.debug('%s', e)
+                raise bottle.HTTPError(e.group.status, str(e), headers={
+                    'Retry-After': str(int(e.group.retry_after)),
+                })
+            release = True
+            try:
+                rv = callback(*args, **kwargs)
+                if isinstance(rv, types.GeneratorType):
+                    release = False
+                    return self.release_after(group, rv)
+                return rv
+            finally:
+                if release:
+                    self.admission.release(group)
+        return _
+
+    def release_after(self, group, gen):
+        try:
+            for chunk in gen:
+                yield chunk
+        finally:
+            gen.close()
+            self.admission.release(group)
@@ -0,0 +1,460 @@
+'''Benchmarks of search engines, filters and other hot paths.
+
+.. This software is released under an MIT/X11 open source license.
+   Copyright 2012-2015 Diffeo, Inc.
+
+The benchmarks run offline: feature collections and labels are kept
+in a :class:`dossier.web.memory.MemoryStore` and
+:class:`dossier.web.memory.MemoryLabelStore`, and folders are kept in a
+local (in-process) ``kvlayer`` client. They cover:
+
+* ``search.streaming_sample``, ``search.plain_index_scan`` and
+  ``search.random``, with every candidate matching the query;
+* ``search.setup``, creating a search engine and its filter predicate
+  the way each search request does;
+* ``filter.already_labeled``, ``filter.geotime`` and
+  ``filter.nilsimsa_near_duplicates``, applied to every candidate;
+* ``util.fc_to_json``;
+* ``folders.put``, ``folders.get``, ``folders.list`` and
+  ``folders.move``;
+* ``wsgi.search`` and ``wsgi.fc_get``, full requests through the
+  application built by :class:`dossier.web.WebBuilder`;
+* ``wsgi.inject``, a request to a route that is given a dozen
+  injected services.
+
+Most benchmarks run once for each number of candidates in ``--sizes``
+(1000, 10000 and 100000 by default). The others run at a fixed size.
+Each benchmark is run until it takes at least ``--min-time`` seconds,
+and the best of ``--repeat`` runs is reported as seconds per call.
+
+Results can be written as JSON with ``--output`` and compared with a
+previous run with ``--compare``. If any benchmark is slower than its
+baseline by more than ``--threshold`` (a fraction, ``0.2`` by
+default), then the exit status is ``1``::
+
+    python -m dossier.web.benchmark --output base.json
+    # ... change something ...
+    python -m dossier.web.benchmark --compare base.json
+
+Use ``--only`` to select benchmarks by name prefix, e.g.,
+``--only search. --only wsgi.``. With ``--latency`` and ``--jitter``,
+every call to the store and label store waits, as if they were remote
+(see :mod:`dossier.web.memory`).
+
+.. autofunction:: run
+.. autofunction:: measure
+.. autofunction:: compare
+'''
+from __future__ import absolute_import, division, print_function
+
+import argparse
+from collections import OrderedDict
+from functools import partial
+import json
+import platform
+import random
+import sys
+import time
+import uuid
+
+import bottle
+import kvlayer
+
+from dossier.fc import FeatureCollection, GeoCoords, StringCounter
+from dossier.label import CorefValue, Label
+from dossier.web import search_engines, util
+from dossier.web.builder import WebBuilder
+from dossier.web.filters import already_labeled, geotime, \
+    nilsimsa_near_duplicates
+from dossier.web.folder import Folders
+from dossier.web.memory import MemoryConfig, MemoryLabelStore, \
+    MemoryStore
+from dossier.web.util import wsgi_request
+
+
+#: The default numbers of candidates.
+DEFAULT_SIZES = (1000, 10000, 100000)
+
+#: name -> (function, fixed size or None)
+BENCHMARKS = OrderedDict()
+
+GEO_FEATURE = FeatureCollection.GEOCOORDS_PREFIX + 'both_co_LOC_1'
+QUERY_ID = '0'
+
+
+def benchmark(name, size=None):
+    '''Register a benchmark.
+
+    The decorated function is called with a :class:`Corpus` and
+    returns a function with no arguments to time. If ``size`` is
+    given, then the benchmark only runs with that many candidates.
+    '''
+    def _(fun):
+        BENCHMARKS[name] = (fun, size)
+        return fun
+    return _
+
+
+class Corpus(object):
+    '''Synthetic data with ``n`` candidates for one query.
+
+    Every candidate matches the query's ``NAME``. Candidates fall in
+    50 groups of near duplicates (by nilsimsa hash), a tenth of them
+    are inside the bounding box used by ``filter.geotime``, and up to
+    100 are labeled with the query.
+
+    ``latency`` and ``jitter`` are given to the in-memory store and
+    label store.
+    '''
+    def __init__(self, n, seed=0, latency=0, jitter=0):
+        self.n = n
+        rand = random.Random(seed)
+        bases = ['%064x' % rand.getrandbits(256) for _ in xrange(50)]
+
+        def fc(i):
+            base = bases[i % len(bases)]
+            pos = rand.randrange(len(base))
+            nhash = base[:pos] + rand.choice('0123456789abcdef') \
+                + base[pos + 1:]
+            inside = i % 10 == 0
+            return FeatureCollection({
+                u'NAME': StringCounter({u'q': 1, u'name%d' % (i % 100): 1}),
+                u'#nilsimsa_all': StringCounter({nhash: 1}),
+                GEO_FEATURE: GeoCoords({u'place': [(
+                    rand.uniform(0, 10) if inside else rand.uniform(20, 90),
+                    rand.uniform(0, 10), 0, 1e9 + i)]}),
+                u'body': u'candidate %d' % i,
+            })
+
+        self.store = MemoryStore(indexes=[u'NAME'], latency=latency,
+                                 jitter=jitter, seed=seed)
+        self.store.put([(QUERY_ID, fc(0))])
+        self.store.put((str(i), fc(i)) for i in xrange(1, n + 1))
+        self.kvl = kvlayer.client(
+            config={}, storage_type='local', app_name='diffeo',
+            namespace='dossier.web.benchmark.%s' % uuid.uuid4().hex)
+        self.label_store = MemoryLabelStore(latency=latency, jitter=jitter,
+                                            seed=seed)
+        step = max(1, n // 100)
+        self.label_store.put(*[
+            Label(QUERY_ID, str(i), 'benchmark', CorefValue.Negative)
+            for i in xrange(1, n + 1, step)])
+
+    def candidates(self):
+        return [(cid, fc) for cid, fc in self.store.scan()
+                if cid != QUERY_ID]
+
+    def config(self):
+        '''Return a :class:`dossier.web.memory.MemoryConfig` of this.'''
+        return MemoryConfig(store=self.store, label_store=self.label_store,
+                            kvlclient=self.kvl)
+
+    def close(self):
+        self.kvl.delete_namespace()
+        self.kvl.close()
+
+
+def engine(cls, corpus, **params):
+    return (cls(corpus.store)
+            .set_query_id(QUERY_ID)
+            .set_query_params(dict((k, str(v)) for k, v in params.items())))
+
+
+def filtered(corpus, filt, **params):
+    candidates = corpus.candidates()
+    filt.set_query_id(QUERY_ID).set_query_params(
+        dict((k, str(v)) for k, v in params.items()))
+
+    def _():
+        # Predicates can be stateful, so each run gets a new one.
+        pred = filt.create_predicate()
+        return sum(1 for c in candidates if pred(c))
+    return _
+
+
+@benchmark('search.streaming_sample')
+def bench_streaming_sample(corpus):
+    candidates = corpus.candidates()
+    return lambda: search_engines.streaming_sample(
+        candidates, 30, corpus.n)
+
+
+@benchmark('search.plain_index_scan')
+def bench_plain_index_scan(corpus):
+    # `plain_index_scan` considers `limit * 10` results, so this makes
+    # it consider every candidate.
+    e = engine(search_engines.plain_index_scan, corpus,
+               limit=max(1, corpus.n // 10))
+    return e.recommendations
+
+
+@benchmark('search.random')
+def bench_random(corpus):
+    return engine(search_engines.random, corpus).recommendations
+
+
+@benchmark('search.setup', size=1000)
+def bench_search_setup(corpus):
+    config = corpus.config()
+    filters = {
+        'already_labeled': already_labeled,
+        'geotime': geotime,
+        'nilsimsa_near_duplicates': nilsimsa_near_duplicates,
+    }
+
+    def _():
+        # The same as `v1_search`, without running the search.
+        e = (config.create(search_engines.plain_index_scan)
+                   .set_query_id(QUERY_ID)
+                   .set_query_params({}))
+        for name, filt in filters.items():
+            e.add_lazy_filter(name, partial(config.create, filt))
+        return e.create_filter_predicate()
+    return _
+
+
+@benchmark('filter.already_labeled')
+def bench_already_labeled(corpus):
+    return filtered(corpus, already_labeled(corpus.label_store))
+
+
+@benchmark('filter.geotime')
+def bench_geotime(corpus):
+    return filtered(corpus, geotime(), min_lon=0, max_lon=10,
+                    min_lat=0, max_lat=10)
+
+
+@benchmark('filter.nilsimsa_near_duplicates', size=1000)
+def bench_nilsimsa(corpus):
+    return filtered(corpus, nilsimsa_near_duplicates(corpus.label_store,
+                                                     corpus.store))
+
+
+@benchmark('util.fc_to_json')
+def bench_fc_to_json(corpus):
+    fcs = [fc for _, fc in corpus.candidates()]
+    return lambda: [util.fc_to_json(fc) for fc in fcs]
+
+
+def folders(corpus, n=100):
+    if getattr(corpus, 'folders', None) is None:
+        corpus.folders = Folders(corpus.kvl)
+        for i in xrange(n):
+            corpus.folders.put('/items/item%d' % i)
+    return corpus.folders
+
+
+@benchmark('folders.put', size=1000)
+def bench_folders_put(corpus):
+    f = folders(corpus)
+    count = [0]
+
+    def _():
+        count[0] += 1
+        f.put('/puts/item%d' % count[0])
+    return _
+
+
+@benchmark('folders.get', size=1000)
+def bench_folders_get(corpus):
+    f = folders(corpus)
+    return lambda: f.get('/items/item50')
+
+
+@benchmark('folders.list', size=1000)
+def bench_folders_list(corpus):
+    f = folders(corpus)
+    return lambda: list(f.list('/items'))
+
+
+@benchmark('folders.move', size=1000)
+def bench_folders_move(corpus):
+    f = folders(corpus)
+    f.put('/from/item')
+    paths = ['/from/item', '/to/item']
+
+    def _():
+        f.move(paths[0], paths[1])
+        paths.reverse()
+    return _
+
+
+def app(corpus):
+    return WebBuilder().set_config(corpus.config()).get_app()
+
+
+@benchmark('wsgi.search', size=1000)
+def bench_wsgi_search(corpus):
+    a = app(corpus)
+    path = '/dossier/v1/feature-collection/%s/search/plain_index_scan' \
+        % QUERY_ID
+    return lambda: wsgi_request(a, 'GET', path, query='limit=30')
+
+
+@benchmark('wsgi.fc_get', size=1000)
+def bench_wsgi_fc_get(corpus):
+    a = app(corpus)
+    return lambda: wsgi_request(a, 'GET', '/dossier/v1/feature-collection/1')
+
+
+@benchmark('wsgi.inject', size=1000)
+def bench_wsgi_inject(corpus):
+    names = ['service%d' % i for i in xrange(12)]
+    routes = bottle.Bottle()
+
+    @routes.get('/all')
+    def all(service0, service1, service2, service3, service4, service5,
+            service6, service7, service8, service9, service10, service11):
+        return 'all'
+
+    builder = WebBuilder(add_default_routes=False).add_routes(routes)
+    for name in names:
+        builder.inject(name, lambda name=name: name)
+    a = builder.set_config(corpus.config()).get_app()
+    return lambda: wsgi_request(a, 'GET', '/all')
+
+
+def measure(fun, repeat=5, min_time=0.1, clock=time.time):
+    '''Return the seconds per call of ``fun``.
+
+    ``fun`` is called ``number`` times in a row, where ``number`` is
+    doubled until that takes at least ``min_time`` seconds. This is
+    done ``repeat`` times. Returns ``(number, [seconds per call])``.
+    '''
+    def run(number):
+        start = clock()
+        for _ in xrange(number):
+            fun()
+        return (clock() - start) / number
+
+    number = 1
+    times = [run(number)]
+    while times[0] * number < min_time:
+        number *= 2
+        times = [run(number)]
+    times.extend(run(number) for _ in xrange(repeat - 1))
+    return number, times
+
+
+def run(sizes=DEFAULT_SIZES, only=None, repeat=5, min_time=0.1,
+        latency=0, jitter=0, log=None):
+    '''Run benchmarks and return their results.
+
+    Results are keyed by ``name/size``, e.g.,
+    ``search.random/10000``. If ``only`` is given, then only the
+    benchmarks whose names start with one of its prefixes are run.
+    ``latency`` and ``jitter`` are given to each :class:`Corpus`.
+    Each result is logged by ``log`` as soon as it is done.
+    '''
+    selected = [(name, fun, size) for name, (fun, size) in BENCHMARKS.items()
+                if not only or any(name.startswith(p) for p in only)]
+    corpus_sizes = set()
+    for _, _, size in selected:
+        corpus_sizes.update([size] if size is not None else sizes)
+
+    results = OrderedDict()
+    for n in sorted(corpus_sizes):
+        corpus = Corpus(n, latency=latency, jitter=jitter)
+        try:
+            for name, fun, size in selected:
+                if (size is not None and size != n) \
+                        or (size is None and n not in sizes):
+                    continue
+                number, times = measure(fun(corpus), repeat=repeat,
+                                        min_time=min_time)
+                times.sort()
+                key = '%s/%d' % (name, n)
+                results[key] = OrderedDict([
+                    ('name', name),
+                    ('size', n),
+                    ('seconds', times[0]),
+                    ('median', times[len(times) // 2]),
+                    ('number', number),
+                    ('repeat', repeat),
+                ])
+                if log is not None:
+                    log(key, results[key])
+        finally:
+            corpus.close()
+    return results
+
+
+def compare(baseline, results, threshold=0.2):
+    '''Compare ``results`` with ``baseline``.
+
+    Both are dictionaries like those returned by :func:`run`. Returns
+    a list of ``(key, baseline seconds, seconds, ratio, regressed)``
+    for each benchmark in both, where ``regressed`` is true if the
+    benchmark got slower by more than the fraction ``threshold``.
+    '''
+    rows = []
+    for key, result in results.items():
+        if key not in baseline:
+            continue
+        old, new = baseline[key]['seconds'], result['seconds']
+        ratio = new / old if old > 0 else float('inf')
+        rows.append((key, old, new, ratio, ratio > 1 + threshold))
+    return rows
+
+
+def main():
+    p = argparse.ArgumentParser(
+        description='Benchmark dossier.web without external services.')
+    p.add_argument('--sizes', default=','.join(map(str, DEFAULT_SIZES)),
+                   help='comma separated numbers of candidates')
+    p.add_argument('--only', action='append', default=[],
+                   help='only run benchmarks with this name prefix')
+    p.add_argument('--repeat', type=int, default=5)
+    p.add_argument('--min-time', type=float, default=0.1,
+                   help='minimum seconds of each run')
+    p.add_argument('--latency', type=float, default=0,
+                   help='seconds each store call waits')
+    p.add_argument('--jitter', type=float, default=0,
+                   help='maximum random seconds added to --latency')
+    p.add_argument('--output', help='write results as JSON to this file')
+    p.add_argument('--compare', metavar='BASELINE',
+                   help='compare with the results in this JSON file')
+    p.add_argument('--threshold', type=float, default=0.2,
+                   help='fraction slower than the baseline that is a '
+                        'regression')
+    p.add_argument('--list', action='store_true',
+                   help='list the benchmarks and exit')
+    args = p.parse_args()
+
+    if args.list:
+        for name, (_, size) in BENCHMARKS.items():
+            print(name if size is None else '%s (size %d)' % (name, size))
+        return
+
+    def log(key, result):
+        print('%-45s %12.6f s  (%d x %d)' % (
+            key, result['seconds'], result['repeat'], result['number']))
+        sys.stdout.flush()
+
+    sizes = [int(s) for s in args.sizes.split(',') if s.strip()]
+    results = run(sizes=sizes, only=args.only, repeat=args.repeat,
+                  min_time=args.min_time, latency=args.latency,
+                  jitter=args.jitter, log=log)
+    if args.output is not None:
+        with open(args.output, 'w') as f:
+            json.dump(OrderedDict([
+                ('python', platform.python_version()),
+                ('created', time.time()),
+                ('results', results),
+            ]), f, indent=2)
+            f.write('\n')
+    if args.compare is not None:
+        with open(args.compare) as f:
+            baseline = json.load(f)['results']
+        rows = compare(baseline, results, threshold=args.threshold)
+        print()
+        for key, old, new, ratio, regressed in rows:
+            print('%-45s %12.6f -> %12.6f  %+6.1f%%%s' % (
+                key, old, new, 100 * (ratio - 1),
+                '  REGRESSION' if regressed else ''))
+        if any(row[4] for row in rows):
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,145 @@
+'''Circuit breakers for backend services.
+
+.. This software is released under an MIT/X11 open source license.
+   Copyright 2012-2015 Diffeo, Inc.
+
+When a backend like Elasticsearch or ``kvlayer`` is down, creating a
+client for it can take a long time to fail (for example,
+:class:`dossier.web.Tags` waits up to a minute). Without a circuit
+breaker, every request would pay that cost again.
+
+:class:`dossier.web.Config` keeps a :class:`CircuitBreaker` for each
+service. After ``breaker_threshold`` consecutive failures to create a
+client, the breaker *opens* and requests that need the service fail
+right away with ``503``. After a backoff delay, one request is allowed
+to try again (the breaker is *half open*). If it succeeds, the breaker
+closes. If it fails, the breaker opens again and the delay doubles, up
+to ``breaker_max_backoff`` seconds.
+
+The thresholds are set in the ``dossier.web`` configuration::
+
+    dossier.web:
+      breaker_threshold: 2      # consecutive failures
+      breaker_backoff: 1        # seconds before the first retry
+      breaker_max_backoff: 60   # maximum seconds between retries
+
+The state of every breaker is reported by
+:func:`dossier.web.routes.v1_status`.
+
+.. autoclass:: CircuitBreaker
+'''
+from __future__ import absolute_import, division, print_function
+
+import threading
+import time
+
+
+class CircuitBreaker(object):
+    '''A circuit breaker with exponential backoff.
+
+    .. automethod:: __init__
+    .. automethod:: allow
+    .. automethod:: success
+    .. automethod:: failure
+    .. automethod:: cancel
+    .. automethod:: status
+    '''
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half_open'
+
+    def __init__(self, name, threshold=2, backoff=1, max_backoff=60,
+                 clock=time.time):
+        '''Create a new closed circuit breaker.
+
+        :param str name: The name of the service.
+        :param int threshold: The number of consecutive failures that
+                              open the breaker.
+        :param float backoff: Seconds to wait before the first retry.
+        :param float max_backoff: The maximum seconds between retries.
+        :param clock: A function returning the current time.
+        '''
+        self.name = name
+        self.threshold = max(1, threshold)
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.clock = clock
+        self.lock = threading.Lock()
+        self.state = self.CLOSED
+        self.failures = 0
+        self.delay = 0
+        self.retry_at = None
+        self.last_error = None
+        self.rejected = 0
+
+    def allow(self):
+        '''Returns true if the service should be tried.
+
+        When the breaker is open and its delay has passed, this returns
+        true for exactly one caller, which must then report the outcome
+        with :meth:`success` or :meth:`failure`.
+        '''
+        with self.lock:
+            if self.state == self.CLOSED:
+                return True
+            if self.state == self.OPEN and self.clock() >= self.retry_at:
+                self.state = self.HALF_OPEN
+                return True
+            self.rejected += 1
+            return False
+
+    def success(self):
+        '''Record a successful use of the service.'''
+        with self.lock:
+            self.state = self.CLOSED
+            self.failures = 0
+            self.delay = 0
+            self.retry_at = None
+
+    def failure(self, error=None):
+        '''Record a failed use of the service.
+
+        :param error: The exception or message describing the failure.
+        '''
+        with self.lock:
+            self.failures += 1
+            if error is not None:
+                self.last_error = str(error)
+            if self.state == self.OPEN:
+                # A concurrent attempt that started before the breaker
+                # opened. It doesn't change when the next retry is.
+                return
+            if self.state == self.HALF_OPEN:
+                self.delay = min(self.delay * 2, self.max_backoff)
+            elif self.failures >= self.threshold:
+                self.delay = self.backoff
+            else:
+                return
+            self.state = self.OPEN
+            self.retry_at = self.clock() + self.delay
+
+    def cancel(self):
+        '''Record that the service was not actually tried.
+
+        This is for callers of :meth:`allow` that gave up for reasons
+        unrelated to the health of the service. If this caller was the
+        one allowed to retry an open breaker, then the next caller may
+        retry instead.
+        '''
+        with self.lock:
+            if self.state == self.HALF_OPEN:
+                self.state = self.OPEN
+
+    def status(self):
+        '''Return the state of this breaker as a dictionary.'''
+        with self.lock:
+            retry_in = None
+            if self.state == self.OPEN:
+                retry_in = max(0, self.retry_at - self.clock())
+            return {
+                'state': self.state,
+                'failures': self.failures,
+                'last_error': self.last_error,
+                'retry_in': retry_in,
+                'rejected': self.rejected,
+            }
@@ -5,17 +5,27 @@
 '''
 from __future__ import absolute_import, division, print_function
 
+from collections import OrderedDict
 import inspect
-import json
 import logging
+import types
 
 import bottle
 
 from dossier.web import search_engines as builtin_engines
+from dossier.web.admission import (
+    DEFAULT_GROUPS, AdmissionControl, AdmissionPlugin)
+from dossier.web.metrics import MetricsPlugin, observe_backend
+from dossier.web.profiling import ProfilePlugin
+from dossier.web.slowlog import SlowLogPlugin
+from dossier.web.timing import TimingPlugin
+from dossier.web.compression import CompressionPlugin
 from dossier.web.config import Config
 from dossier.web.filters import already_labeled
 from dossier.web.routes import app as default_app
 from dossier.web.tags import app as tags_app
+from dossier.web import timing, util
+from dossier.web.warmup import Warmup
 
 
 logger = logging.getLogger(__name__)
@@ -41,6 +51,13 @@ class WebBuilder(object):
     .. automethod:: add_routes
     .. automethod:: inject
     .. automethod:: enable_cors
+    .. automethod:: enable_compression
+    .. automethod:: enable_warmup
+    .. automethod:: enable_admission_control
+    .. automethod:: enable_timing
+    .. automethod:: enable_metrics
+    .. automethod:: enable_profiling
+    .. automethod:: enable_slow_log
     '''
     def __init__(self, add_default_routes=True):
         '''Introduce a new builder.
@@ -71,6 +88,14 @@ class WebBuilder(object):
         }
         self.mount_prefix = None
         self.config = None
+        self.injections = OrderedDict()
+        self.warmup = None
+        self.warmup_background = None
+        self.admission = AdmissionControl()
+        self.timing = None
+        self.metrics = None
+        self.profiling = None
+        self.slow_log = None
         if add_default_routes:
             self.add_routes(default_app)
             self.add_routes(tags_app)
@@ -93,11 +118,38 @@ class WebBuilder(object):
         if self.mount_prefix is None:
             self.mount_prefix = self.config.config.get('url_prefix')
 
+        if self.timing is None and self.config.config.get('timing'):
+            self.timing = TimingPlugin(
+                log=self.config.config['timing'] == 'log')
+        if self.metrics is None and self.config.config.get('metrics'):
+            self.metrics = MetricsPlugin()
+        conf = self.config.config
+        if self.slow_log is None and conf.get('slow_request_seconds'):
+            self.enable_slow_log(
+                conf['slow_request_seconds'],
+                path=conf.get('slow_request_log'),
+                max_per_minute=conf.get('slow_request_max_per_minute', 60))
+        wrap = unwrapped
+        if self.timing is not None or self.metrics is not None \
+                or self.slow_log is not None:
+            observe = observe_backend if self.metrics is not None else None
+
+            def wrap(name, service):
+                return timing.timed(name, service, observe=observe)
+            self.config.wrap_service = wrap
+
         self.inject('config', lambda: self.config)
-        self.inject('kvlclient', lambda: self.config.kvlclient)
-        self.inject('store', lambda: self.config.store)
-        self.inject('label_store', lambda: self.config.label_store)
-        self.inject('tags', lambda: self.config.tags)
+        self.inject('kvlclient',
+                    lambda: wrap('kvlclient', self.config.kvlclient))
+        self.inject('store', lambda: wrap('store', self.config.store))
+        self.inject('label_store',
+                    lambda: wrap('label_store', self.config.label_store))
+        self.inject('tags', lambda: wrap('tags', self.config.tags))
+        self.inject('versions', lambda: self.config.versions)
+        self.warmup = Warmup(self.config, search_engines=self.search_engines,
+                             filters=self.filters)
+        self.inject('warmup', lambda: self.warmup)
+        self.inject('admission', lambda: self.admission)
         self.inject('search_engines', lambda: self.search_engines)
         self.inject('filters', lambda: self.filters)
         self.inject('request', lambda: bottle.request)
@@ -110,6 +162,11 @@ class WebBuilder(object):
         # Also DEPRECATED.
         self.inject('label_hooks', lambda: [])
 
+        # Choose a JSON library, e.g., `json_backends: [ujson, json]`.
+        if 'json_backends' in self.config.config:
+            util.set_json_encoder(
+                util.JsonEncoder(self.config.config['json_backends']))
+
         # Load routes defined in entry points.
         for extroute in self.config.config.get('external_routes', []):
             mod, fun_name = extroute.split(':')
@@ -117,6 +174,35 @@ class WebBuilder(object):
             fun = getattr(__import__(mod, fromlist=[fun_name]), fun_name)
             self.add_routes(fun())
 
+        # Metrics are collected by the outermost plugins, so that shed
+        # requests are counted too (and time spent waiting in the
+        # queue counts towards slow requests). Admission control comes
+        # next, so that shed requests never touch a backend service.
+        if self.metrics is not None:
+            self.app.install(self.metrics)
+        if self.slow_log is not None:
+            self.app.install(self.slow_log)
+        if self.admission.enabled:
+            self.app.install(AdmissionPlugin(self.admission))
+        if self.profiling is None and self.config.config.get('profile_token'):
+            self.enable_profiling(
+                self.config.config['profile_token'],
+                directory=self.config.config.get('profile_directory'))
+        if self.profiling is not None:
+            self.app.install(self.profiling)
+        if self.timing is not None:
+            self.app.install(self.timing)
+
+        # In pooled mode, services checked out during a request go back
+        # to their pools once the response has been sent.
+        if getattr(self.config, 'pooled', False):
+            self.app.install(ReleasePlugin(self.config))
+
+        # All services are injected by a single plugin, so that a request
+        # only goes through one wrapper no matter how many services a
+        # route asks for.
+        self.app.install(create_injectors(self.injections.items()))
+
         # This adds the `json=True` feature on routes, which always coerces
         # the output to JSON. Bottle, by default, only permits dictionaries
         # to be JSON, which is the correct behavior. (Because returning JSON
@@ -125,6 +211,15 @@ class WebBuilder(object):
         # So we should fix the routes and then remove this. ---AG
         self.app.install(JsonPlugin())
 
+        if self.warmup_background is None and self.config.config.get('warmup'):
+            self.warmup_background = True
+        if self.warmup_background is None:
+            self.warmup.skip()
+        elif self.warmup_background:
+            self.warmup.start()
+        else:
+            self.warmup.run()
+
         # Throw away the app and return it. Because this is elimination!
         app = self.app
         self.app = None
@@ -241,11 +336,15 @@ class WebBuilder(object):
         of construction for objects. For example, you may want to check
         the health of a database connection.)
 
+        If ``name`` is injected more than once, then the last closure
+        given wins.
+
         :param str name: Parameter name.
         :param function closure: A function with no parameters.
         :rtype: :class:`WebBuilder`
         '''
-        self.app.install(create_injector(name, closure))
+        self.injections.pop(name, None)
+        self.injections[name] = closure
         return self
 
     def enable_cors(self):
@@ -281,6 +380,125 @@ class WebBuilder(object):
         self.app.error_handler[int(405)] = options_response
         return self
 
+    def enable_compression(self, min_size=1024, level=6):
+        '''Enables compression of responses.
+
+        Responses are compressed with ``gzip`` or ``deflate``
+        depending on the ``Accept-Encoding`` header sent by the
+        client. Streamed responses are compressed incrementally.
+
+        See :class:`dossier.web.compression.CompressionPlugin` for
+        which responses are left alone.
+
+        :param int min_size: Responses smaller than this many bytes
+                             are not compressed.
+        :param int level: The ``zlib`` compression level, from
+                          ``1`` (fastest) to ``9`` (smallest).
+        :rtype: :class:`WebBuilder`
+        '''
+        self.app.install(CompressionPlugin(min_size=min_size, level=level))
+        return self
+
+    def enable_warmup(self, background=True):
+        '''Warms up services when the application is created.
+
+        In pooled mode, the pools of backend clients are filled, and in
+        every mode, per-process setup is done and caches are loaded by
+        :meth:`get_app`, so that the first requests don't pay for them.
+        (In thread local mode, each request thread still creates its
+        own clients.) Until warm-up is finished,
+        ``GET /dossier/v1/ready`` responds with ``503``.
+
+        See :mod:`dossier.web.warmup`.
+
+        :param bool background: If true, :meth:`get_app` returns right
+                                away and warm-up runs in another thread.
+                                Otherwise, :meth:`get_app` returns once
+                                warm-up is finished.
+        :rtype: :class:`WebBuilder`
+        '''
+        self.warmup_background = background
+        return self
+
+    def enable_admission_control(self, groups=None, total=None):
+        '''Limits the number of concurrent requests per group of routes.
+
+        Requests over the limits of their group wait in a bounded queue
+        or are rejected right away with a ``Retry-After`` header. See
+        :mod:`dossier.web.admission`.
+
+        :param dict groups: Settings for each group of routes. Defaults
+                            to :data:`dossier.web.admission.DEFAULT_GROUPS`.
+        :param int total: The maximum number of requests of all groups
+                          (except priority groups) running at once.
+        :rtype: :class:`WebBuilder`
+        '''
+        if groups is None:
+            groups = DEFAULT_GROUPS
+        self.admission = AdmissionControl(groups=groups, total=total)
+        return self
+
+    def enable_timing(self, log=False):
+        '''Reports where each request spends its time.
+
+        Calls to backend services and phases of searches are timed,
+        and the totals are sent in a ``Server-Timing`` response header.
+        See :mod:`dossier.web.timing`.
+
+        :param bool log: If true, the timings of every request are also
+                         logged as one line of JSON.
+        :rtype: :class:`WebBuilder`
+        '''
+        self.timing = TimingPlugin(log=log)
+        return self
+
+    def enable_metrics(self):
+        '''Collects request and backend metrics.
+
+        The number of requests, errors and latency of each route, and
+        the latency of calls to each backend service method, are
+        served at ``/dossier/v1/metrics`` in the Prometheus text
+        format. See :mod:`dossier.web.metrics`. Metrics are kept per
+        process, so this is only useful with one worker process.
+
+        :rtype: :class:`WebBuilder`
+        '''
+        self.metrics = MetricsPlugin()
+        return self
+
+    def enable_profiling(self, token, directory=None, top=30):
+        '''Lets administrators profile individual requests.
+
+        A request with a ``_profile`` query parameter and an
+        ``X-Profile-Token: <token>`` header is profiled, and the
+        profile is either returned instead of the response or saved to
+        ``directory``. See :mod:`dossier.web.profiling`.
+
+        :param str token: The secret that allows profiling.
+        :param str directory: Where ``_profile=save`` writes profiles.
+                              Defaults to the current directory.
+        :param int top: The number of functions listed in summaries.
+        :rtype: :class:`WebBuilder`
+        '''
+        self.profiling = ProfilePlugin(token, directory=directory, top=top)
+        return self
+
+    def enable_slow_log(self, threshold=1.0, path=None, max_per_minute=60):
+        '''Logs requests that are slower than ``threshold`` seconds.
+
+        Each slow request is logged as a JSON record with the route,
+        the search parameters, the time spent in each backend service
+        and the size of the response. See :mod:`dossier.web.slowlog`.
+
+        :param float threshold: The minimum seconds to be logged.
+        :param str path: A file that records are also written to.
+        :param int max_per_minute: The maximum records per minute.
+        :rtype: :class:`WebBuilder`
+        '''
+        self.slow_log = SlowLogPlugin(threshold, path=path,
+                                      max_per_minute=max_per_minute)
+        return self
+
     def set_visid_to_dbid(self, f):
         'DEPRECATED. DO NOT USE.'
         self.visid_to_dbid = f
@@ -292,6 +510,10 @@ class WebBuilder(object):
         return self
 
 
+def unwrapped(name, service):
+    return service
+
+
 def create_injector(param_name, fun_param_value):
     '''Dependency injection with Bottle.
 
@@ -308,25 +530,87 @@ def create_injector(param_name, fun_param_value):
     :type fun_param_value: a closure that can be applied with zero
                            arguments
     '''
+    return create_injectors([(param_name, fun_param_value)])
+
+
+def create_injectors(injections):
+    '''Dependency injection of many services with Bottle.
+
+    This is like :func:`create_injector`, except it handles any number
+    of services with a single Bottle plugin. The parameters a route
+    needs are computed once when the plugin is applied to the route,
+    so each request only pays for the services it actually uses.
+
+    Services are resolved in the order given. If any closure returns
+    ``None``, then the request is aborted with a ``503`` error.
+
+    :param injections: parameter names and their closures
+    :type injections: ``[(str, function)]``
+    '''
+    injections = list(injections)
+
     class _(object):
         api = 2
 
         def apply(self, callback, route):
-            if param_name not in inspect.getargspec(route.callback)[0]:
+            argnames = inspect.getargspec(route.callback)[0]
+            needed = [(param_name, fun_param_value)
+                      for param_name, fun_param_value in injections
+                      if param_name in argnames]
+            if len(needed) == 0:
                 return callback
 
             def _(*args, **kwargs):
-                pval = fun_param_value()
-                if pval is None:
-                    logger.error('service "%s" unavailable', param_name)
-                    bottle.abort(503, 'service "%s" unavailable' % param_name)
-                    return
-                kwargs[param_name] = pval
+                for param_name, fun_param_value in needed:
+                    pval = fun_param_value()
+                    if pval is None:
+                        logger.error('service "%s" unavailable', param_name)
+                        bottle.abort(
+                            503, 'service "%s" unavailable' % param_name)
+                        return
+                    kwargs[param_name] = pval
                 return callback(*args, **kwargs)
             return _
     return _()
 
 
+class ReleasePlugin(object):
+    '''Releases pooled services at the end of each request.
+
+    Services are released by calling ``config.release()`` after the
+    route returns. If the route returns a generator, then services
+    are released once the generator is exhausted or closed, since
+    streamed responses use services while the body is being sent.
+    '''
+    api = 2
+    name = 'release'
+
+    def __init__(self, config):
+        self.config = config
+
+    def apply(self, callback, route):
+        def _(*args, **kwargs):
+            release = True
+            try:
+                rv = callback(*args, **kwargs)
+                if isinstance(rv, types.GeneratorType):
+                    release = False
+                    return self.release_after(rv)
+                return rv
+            finally:
+                if release:
+                    self.config.release()
+        return _
+
+    def release_after(self, gen):
+        try:
+            for chunk in gen:
+                yield chunk
+        finally:
+            gen.close()
+            self.config.release()
+
+
 class JsonPlugin(object):
     '''A custom JSON plugin for Bottle.
 
@@ -335,19 +619,36 @@ class JsonPlugin(object):
     programmer to write `json=True` into the route decorator, which
     causes the response to *always* be JSON.
 
-    Basically, it just wraps the return value in ``json.dumps`` and
-    sets the HTTP content type header appropriately.
+    Basically, it just encodes the return value as compact JSON and
+    sets the HTTP content type header appropriately. Indented JSON is
+    returned if the request has a ``pretty=1`` query parameter.
+
+    The encoder defaults to :data:`dossier.web.util.json_encoder`.
+
+    If the client prefers ``application/cbor`` in its ``Accept``
+    header, then the return value is encoded as CBOR instead.
     '''
     api = 2
     name = 'json_response'
 
+    def __init__(self, encoder=None):
+        self.encoder = encoder
+
     def apply(self, callback, route):
         if not route.config.get('json', False):
             return callback
 
         def _(*args, **kwargs):
-            bottle.response.content_type = 'application/json'
-            return json.dumps(callback(*args, **kwargs), indent=2)
+            rv = callback(*args, **kwargs)
+            bottle.response.add_header('Vary', 'Accept')
+            with timing.phase('encode'):
+                if util.negotiate_format(bottle.request) == 'cbor':
+                    bottle.response.content_type = util.CBOR_MIME
+                    return util.cbor_dumps(rv)
+                encoder = self.encoder or util.json_encoder
+                bottle.response.content_type = 'application/json'
+                return encoder.dumps(rv,
+                                     pretty=util.wants_pretty(bottle.request))
         return _
 
 
@@ -358,6 +659,20 @@ def add_cli_arguments(p):
                    help='Enable Bottle\'s reloading functionality.')
     p.add_argument('--port', type=int, default=8080)
     p.add_argument('--host', default='localhost')
+    p.add_argument('--warmup', action='store_true',
+                   help='Warm up services before reporting ready. '
+                        'Clients are only kept in pooled mode.')
+    p.add_argument('--workers', type=int, default=None,
+                   help='Serve with the built-in production server, using '
+                        'this many worker processes. (0 means serve from '
+                        'a single process without forking.)')
+    p.add_argument('--threads', type=int, default=None,
+                   help='The number of threads in each worker of the '
+                        'built-in production server.')
+    p.add_argument('--max-requests', type=int, default=0,
+                   help='Replace a worker of the built-in production '
+                        'server after it has served this many requests.')
     p.add_argument('--server', default='wsgiref',
-                   help='The web server to use. You only need to change this '
-                        'if you\'re running a production server.')
+                   help='The Bottle server adapter to use when neither '
+                        '--workers nor --threads is given (e.g., paste or '
+                        'cherrypy, if installed).')
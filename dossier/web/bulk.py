@@ -0,0 +1,231 @@
+'''Helpers for bulk web services.
+
+.. This software is released under an MIT/X11 open source license.
+   Copyright 2012-2015 Diffeo, Inc.
+
+Bulk routes like :func:`dossier.web.routes.v1_fc_put_many` read a
+stream of records from the request body and write them to a backend
+in batches. The functions here parse request bodies incrementally (so
+that a large upload is never held in memory all at once) and write
+batches concurrently with a bound on the number of batches in flight.
+
+.. autofunction:: body_reader
+.. autofunction:: iter_records
+.. autoclass:: BatchWriter
+'''
+from __future__ import absolute_import, division, print_function
+
+import json
+import logging
+import threading
+
+import cbor
+
+from dossier.web import util
+
+
+logger = logging.getLogger(__name__)
+
+#: The size of reads from the request body.
+READ_SIZE = 64 * 1024
+
+
+class BodyReader(object):
+    '''A file-like view of a request body.
+
+    This reads at most ``length`` bytes from ``fp``, and supports
+    peeking to find the end of the body (which CBOR decoding needs).
+    '''
+    def __init__(self, fp, length=None):
+        self.fp = fp
+        self.remaining = length
+        self.buf = b''
+
+    def _fill(self, size):
+        while len(self.buf) < size:
+            n = READ_SIZE if self.remaining is None \
+                else min(READ_SIZE, self.remaining)
+            if n <= 0:
+                break
+            data = self.fp.read(n)
+            if not data:
+                self.remaining = 0
+                break
+            if self.remaining is not None:
+                self.remaining -= len(data)
+            self.buf += data
+
+    def read(self, size):
+        self._fill(size)
+        data, self.buf = self.buf[:size], self.buf[size:]
+        return data
+
+    def at_eof(self):
+        self._fill(1)
+        return len(self.buf) == 0
+
+    def __iter__(self):
+        '''Iterate over the lines of the body.'''
+        while True:
+            i = self.buf.find(b'\n')
+            while i == -1:
+                before = len(self.buf)
+                self._fill(before + READ_SIZE)
+                if len(self.buf) == before:
+                    break
+                i = self.buf.find(b'\n', before)
+            if i == -1:
+                if len(self.buf) > 0:
+                    line, self.buf = self.buf, b''
+                    yield line
+                return
+            line, self.buf = self.buf[:i + 1], self.buf[i + 1:]
+            yield line
+
+
+def body_reader(request):
+    '''Return a file-like reader of the request body.
+
+    When the request has a ``Content-Length``, the body is read
+    straight from the WSGI input stream, so it is not buffered by
+    Bottle first. Otherwise (e.g., for chunked requests), Bottle's
+    buffered body is used.
+
+    :param request: The web request.
+    :type request: :class:`bottle.Request`
+    :rtype: :class:`BodyReader`
+    '''
+    length = request.environ.get('CONTENT_LENGTH', '')
+    if length.isdigit() and 'bottle.request.body' not in request.environ:
+        return BodyReader(request.environ['wsgi.input'], int(length))
+    return BodyReader(request.body)
+
+
+def iter_records(request):
+    '''Incrementally decode records in the request body.
+
+    If the ``Content-Type`` is ``application/cbor-seq`` or
+    ``application/cbor``, then the body is decoded as a sequence of
+    concatenated CBOR values. Otherwise, it is decoded as newline
+    delimited JSON, where blank lines are skipped.
+
+    This yields pairs of ``(record, error)``, where exactly one of
+    them is ``None``. Decoding stops at the first CBOR error, since
+    there is no way to resynchronize with the stream.
+    '''
+    reader = body_reader(request)
+    if request.content_type.startswith(util.CBOR_MIME):
+        while not reader.at_eof():
+            try:
+                yield cbor.load(reader), None
+            except Exception as e:
+                yield None, 'invalid CBOR: %s' % e
+                return
+    else:
+        for line in reader:
+            if len(line.strip()) == 0:
+                continue
+            try:
+                yield json.loads(line), None
+            except ValueError as e:
+                yield None, 'invalid JSON: %s' % e
+
+
+class BatchWriter(object):
+    '''Write items in batches, concurrently.
+
+    Items are added one at a time with :meth:`add`. Once
+    ``batch_size`` items have been added, they are handed to
+    ``write`` in a separate thread. At most ``max_in_flight`` batches
+    are written at the same time. When that many are in flight,
+    :meth:`add` blocks until one finishes, which in turn stops the
+    caller from reading more of its input.
+
+    Each item added has a key, which is used to report errors and
+    successes.
+
+    ``write`` is called in writer threads, never in the thread that
+    adds items. Backend clients are not thread safe, so a ``write``
+    that uses the caller's client must only be given to a writer with
+    ``max_in_flight=1`` (the default), and the caller must not use the
+    client until :meth:`close` returns. With more batches in flight,
+    ``write`` must get a client of its own in each call (e.g., by
+    checking one out of a :class:`dossier.web.pool.Pool`).
+
+    .. automethod:: __init__
+    .. automethod:: add
+    .. automethod:: finished
+    .. automethod:: close
+    '''
+    def __init__(self, write, batch_size=500, max_in_flight=1):
+        '''Create a new batch writer.
+
+        :param write: A function that accepts a list of items. If it
+                      raises an exception, then every item in the batch
+                      is considered failed.
+        :param int batch_size: The number of items in each batch.
+        :param int max_in_flight: The maximum number of batches that
+                                  can be written at once.
+        '''
+        self.write = write
+        self.batch_size = max(1, batch_size)
+        self.max_in_flight = max(1, max_in_flight)
+        self.batch = []
+        self.threads = []
+        self.slots = threading.Semaphore(self.max_in_flight)
+        self.lock = threading.Lock()
+        self.written = []
+        self.errors = []
+
+    def add(self, key, item):
+        '''Add an item to be written.
+
+        :param key: An identifier for ``item``.
+        :param item: The item to write.
+        '''
+        self.batch.append((key, item))
+        if len(self.batch) >= self.batch_size:
+            self._submit()
+
+    def finished(self):
+        '''Return and forget keys of items written so far.
+
+        :rtype: list
+        '''
+        with self.lock:
+            written, self.written = self.written, []
+        return written
+
+    def close(self):
+        '''Write any remaining items and wait for all batches.
+
+        :return: A list of ``(key, error message)`` for every item
+                 that failed.
+        '''
+        if len(self.batch) > 0:
+            self._submit()
+        for t in self.threads:
+            t.join()
+        self.threads = []
+        return self.errors
+
+    def _submit(self):
+        batch, self.batch = self.batch, []
+        self.slots.acquire()
+        self.threads = [t for t in self.threads if t.is_alive()]
+        t = threading.Thread(target=self._write, args=(batch,))
+        t.daemon = True
+        t.start()
+        self.threads.append(t)
+
+    def _write(self, batch):
+        try:
+            self.write([item for _, item in batch])
+            with self.lock:
+                self.written.extend(key for key, _ in batch)
+        except Exception as e:
+            logger.error('batch of %d failed', len(batch), exc_info=True)
+            with self.lock:
+                self.errors.extend((key, str(e)) for key, _ in batch)
+        finally:
+            self.slots.release()
@@ -0,0 +1,197 @@
+'''Response compression for dossier.web.
+
+.. This software is released under an MIT/X11 open source license.
+   Copyright 2012-2015 Diffeo, Inc.
+
+This provides a Bottle plugin that compresses response bodies with
+``gzip`` or ``deflate`` when the client says it can handle it in its
+``Accept-Encoding`` header. It is enabled with
+:meth:`dossier.web.WebBuilder.enable_compression`.
+
+.. autoclass:: CompressionPlugin
+'''
+from __future__ import absolute_import, division, print_function
+
+import zlib
+
+import bottle
+
+from dossier.web import util
+
+
+#: Content type prefixes that are not worth compressing because they
+#: are (almost always) compressed already.
+INCOMPRESSIBLE_TYPES = (
+    'image/', 'audio/', 'video/',
+    'application/zip', 'application/gzip', 'application/x-gzip',
+    'application/octet-stream',
+)
+
+
+class CompressionPlugin(object):
+    '''A Bottle plugin for compressing responses.
+
+    Bodies smaller than ``min_size`` bytes are sent as is, as are
+    bodies that already have a ``Content-Encoding``, bodies of an
+    incompressible content type and file bodies (like static files).
+    Every other response has ``Vary: Accept-Encoding``, whether or not
+    it was compressed for this client.
+
+    Streamed bodies (generators) are compressed incrementally. Each
+    chunk is flushed as soon as it is compressed, so clients still see
+    results as they are produced. A stream is only compressed if its
+    first ``min_size`` bytes arrive before it ends.
+
+    Dictionaries returned by routes are encoded as JSON here (Bottle
+    would otherwise do it after this plugin runs).
+    '''
+    api = 2
+    name = 'compression'
+
+    def __init__(self, min_size=1024, level=6):
+        self.min_size = min_size
+        self.level = level
+
+    def apply(self, callback, route):
+        def _(*args, **kwargs):
+            rv = callback(*args, **kwargs)
+            if isinstance(rv, bottle.HTTPResponse):
+                if isinstance(rv.body, basestring):
+                    rv.body = self.compress(rv.body, rv)
+                return rv
+            return self.compress(rv, bottle.response)
+        return _
+
+    def compress(self, body, response):
+        '''Compress ``body`` for the current request if possible.
+
+        ``response`` is the response whose headers are used and
+        updated. The (possibly) compressed body is returned.
+        '''
+        if isinstance(body, dict):
+            response.content_type = 'application/json'
+            body = util.json_dumps(body)
+        if not self.compressible(body, response):
+            return body
+        encoding = negotiate_encoding(
+            bottle.request.headers.get('Accept-Encoding', ''))
+        if isinstance(body, basestring):
+            if isinstance(body, unicode):
+                body = body.encode(response.charset)
+            if len(body) < self.min_size:
+                return body
+            # Uncompressed responses vary too, so that caches don't
+            # give them to clients that accept compressed ones (or the
+            # other way around).
+            add_vary(response, 'Accept-Encoding')
+            if encoding is None:
+                return body
+            set_encoding_headers(response, encoding)
+            compressor = new_compressor(encoding, self.level)
+            return compressor.compress(body) + compressor.flush()
+        # A stream's headers are sent before it is known if it's long
+        # enough to compress, so they always vary.
+        add_vary(response, 'Accept-Encoding')
+        if encoding is None:
+            return body
+        return self.compress_stream(body, response, encoding)
+
+    def compress_stream(self, chunks, response, encoding):
+        '''Compress an iterable of chunks.
+
+        Headers are only decided once the first ``min_size`` bytes
+        have been read, which Bottle waits for before it sends them.
+        '''
+        chunks = iter(chunks)
+        buffered, size = [], 0
+        for chunk in chunks:
+            if isinstance(chunk, unicode):
+                chunk = chunk.encode(response.charset)
+            buffered.append(chunk)
+            size += len(chunk)
+            if size >= self.min_size:
+                break
+        else:
+            if len(buffered) > 0:
+                yield b''.join(buffered)
+            return
+
+        set_encoding_headers(response, encoding)
+        compressor = new_compressor(encoding, self.level)
+        yield compressor.compress(b''.join(buffered)) \
+            + compressor.flush(zlib.Z_SYNC_FLUSH)
+        for chunk in chunks:
+            if isinstance(chunk, unicode):
+                chunk = chunk.encode(response.charset)
+            if len(chunk) == 0:
+                continue
+            yield compressor.compress(chunk) \
+                + compressor.flush(zlib.Z_SYNC_FLUSH)
+        yield compressor.flush()
+
+    def compressible(self, body, response):
+        if not body or hasattr(body, 'read'):
+            return False
+        if isinstance(body, (list, tuple)):
+            return False
+        if response.status_code in (204, 304):
+            return False
+        if 'Content-Encoding' in response.headers:
+            return False
+        ctype = response.headers.get('Content-Type', '')
+        return not ctype.startswith(INCOMPRESSIBLE_TYPES)
+
+
+def negotiate_encoding(accept_encoding):
+    '''Pick a content encoding given an ``Accept-Encoding`` header.
+
+    Returns ``'gzip'``, ``'deflate'`` or ``None`` if neither is
+    acceptable. ``gzip`` is preferred when both have the same quality.
+    '''
+    quality = {}
+    for part in accept_encoding.split(','):
+        fields = part.strip().split(';')
+        coding = fields[0].strip().lower()
+        if not coding:
+            continue
+        q = 1.0
+        for param in fields[1:]:
+            name, _, value = param.strip().partition('=')
+            if name.strip() == 'q':
+                try:
+                    q = float(value)
+                except ValueError:
+                    q = 0.0
+        quality[coding] = q
+    star = quality.get('*', 0.0)
+    best, best_q = None, 0.0
+    for coding in ('gzip', 'deflate'):
+        q = quality.get(coding, star)
+        if q > best_q:
+            best, best_q = coding, q
+    return best
+
+
+def new_compressor(encoding, level):
+    if encoding == 'gzip':
+        return zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    return zlib.compressobj(level)
+
+
+def add_vary(response, header):
+    '''Add ``header`` to the ``Vary`` header of ``response``.'''
+    for value in response.headers.getall('Vary'):
+        if header.lower() in (v.strip().lower() for v in value.split(',')):
+            return
+    response.headers.append('Vary', header)
+
+
+def set_encoding_headers(response, encoding):
+    response.headers['Content-Encoding'] = encoding
+    if 'Content-Length' in response.headers:
+        del response.headers['Content-Length']
+    # The compressed body is not byte-for-byte the same representation,
+    # so a strong entity tag must be weakened.
+    etag = response.headers.get('ETag')
+    if etag is not None and not etag.startswith('W/'):
+        response.headers['ETag'] = 'W/' + etag
@@ -10,10 +10,16 @@ import traceback
 
 from dossier.label import LabelStore
 from dossier.store import ElasticStore
+from dossier.web.breaker import CircuitBreaker
+from dossier.web.metrics import cache_lookup
+from dossier.web.pool import Pool, PoolTimeout
 from dossier.web.tags import Tags
+from dossier.web.versions import Versions
+from dossier.web.write_behind import LabelWriteQueue, WriteBehindLabelStore
 import kvlayer
 import yakonfig
 import yakonfig.factory
+from yakonfig.factory import AutoConfigured
 
 
 logger = logging.getLogger(__name__)
@@ -27,6 +33,12 @@ def safe_service(attr, default_value=None):
     requested (like a database connection), then ``safe_service`` will
     log any errors and set the given attribute to ``default_value``.
 
+    If the object has a ``circuit_breaker`` method, then it is called
+    with the service name (``attr`` without leading underscores) to
+    get a :class:`dossier.web.breaker.CircuitBreaker`. While the
+    breaker is open, creating the service isn't attempted and
+    ``default_value`` is returned immediately.
+
     :param str attr: attribute name
     :param object default_value: default value to set
     :rtype: decorator
@@ -34,11 +46,34 @@ def safe_service(attr, default_value=None):
     def _(fun):
         @functools.wraps(fun)
         def run(self):
-            try:
+            if getattr(self, attr, None) is not None:
                 return fun(self)
-            except:
+            breaker = None
+            if hasattr(self, 'circuit_breaker'):
+                breaker = self.circuit_breaker(attr.lstrip('_'))
+                if not breaker.allow():
+                    return default_value
+            try:
+                value = fun(self)
+            except PoolTimeout as e:
+                # A busy pool says nothing about the health of the backend.
+                logger.warn('%s: %s', attr.lstrip('_'), e)
+                if breaker is not None:
+                    breaker.cancel()
+                setattr(self, attr, default_value)
+                return default_value
+            except Exception as e:
                 logger.error(traceback.format_exc())
+                if breaker is not None:
+                    breaker.failure(e)
                 setattr(self, attr, default_value)
+                return default_value
+            if breaker is not None:
+                if value is None:
+                    breaker.failure('unavailable')
+                else:
+                    breaker.success()
+            return value
         return run
     return _
 
@@ -63,15 +98,34 @@ class Config(yakonfig.factory.AutoFactory):
     '''Configuration for dossier.web.
 
     .. automethod:: dossier.web.Config.create
+    .. automethod:: dossier.web.Config.construction_plan
     .. autoattribute:: dossier.web.Config.kvlclient
     .. autoattribute:: dossier.web.Config.store
     .. autoattribute:: dossier.web.Config.label_store
+    .. autoattribute:: dossier.web.Config.label_queue
+    .. autoattribute:: dossier.web.Config.versions
+    .. autoattribute:: dossier.web.Config.pooled
+    .. automethod:: dossier.web.Config.release
+    .. automethod:: dossier.web.Config.pool_stats
+    .. automethod:: dossier.web.Config.warm
+    .. automethod:: dossier.web.Config.circuit_breaker
+    .. automethod:: dossier.web.Config.breaker_status
+    .. autoattribute:: dossier.web.Config.wrap_service
     '''
-    _THREAD_LOCALS = ['store', 'label_store', 'kvlclient', 'tags']
+    #: If set, a function ``wrap_service(name, service)`` that returns
+    #: the service given to objects made by :meth:`create` (for example,
+    #: :func:`dossier.web.timing.timed`).
+    wrap_service = None
+
+    _THREAD_LOCALS = ['store', 'label_store', 'kvlclient', 'tags',
+                      'versions']
     for n in _THREAD_LOCALS:
         locals()['_' + n] = thread_local_property(n)
 
     def __init__(self, *args, **kwargs):
+        # Maps a configurable (usually a search engine or filter class)
+        # to its cached `AutoConfigured` plan. See `construction_plan`.
+        self._construction_plans = {}
         super(Config, self).__init__(*args, **kwargs)
         self.new_config()
 
@@ -80,10 +134,66 @@ class Config(yakonfig.factory.AutoFactory):
         for n in self._THREAD_LOCALS:
             setattr(self, '_thread_local_' + n, threading.local())
 
+        # Circuit breakers by service name. See `circuit_breaker`.
+        self._breakers = {}
+        self._breakers_lock = threading.Lock()
+
+        # Service pools are shared by every thread. See `_service`.
+        self._pools = None
+        self._pools_lock = threading.Lock()
+
+        # The write-behind label queue is shared by every thread.
+        self._label_queue = None
+        self._label_queue_lock = threading.Lock()
+        # Only used by the queue's flushing thread.
+        self._flusher_versions = None
+
     def new_config(self):
         super(Config, self).new_config()
         self._idx_map = None
 
+    def create(self, configurable, config=None, **kwargs):
+        '''Create a sub-object of this factory.
+
+        This is the same as :meth:`yakonfig.factory.AutoFactory.create`,
+        except the introspection of ``configurable`` is only done once.
+        Subsequent calls use the cached plan returned by
+        :meth:`construction_plan`. Injected services are passed through
+        :attr:`wrap_service`, if it is set.
+        '''
+        if not isinstance(configurable, (basestring, AutoConfigured)):
+            configurable = self.construction_plan(configurable)
+        if self.wrap_service is not None \
+                and isinstance(configurable, AutoConfigured):
+            for name in configurable.services:
+                if name != 'config' and name not in kwargs:
+                    kwargs[name] = self.wrap_service(name,
+                                                     getattr(self, name))
+        return super(Config, self).create(configurable, config=config,
+                                          **kwargs)
+
+    def construction_plan(self, configurable):
+        '''Return the cached construction plan for ``configurable``.
+
+        A construction plan records the argument names of
+        ``configurable`` that are filled from configuration and the
+        names of the services that are injected from this config
+        instance. Computing it requires inspecting ``configurable``,
+        so it is done at most once per configurable.
+
+        :param configurable: A class or function to construct.
+        :rtype: :class:`yakonfig.factory.AutoConfigured`
+        '''
+        try:
+            plan = self._construction_plans[configurable]
+            cache_lookup('construction_plan', True)
+            return plan
+        except KeyError:
+            cache_lookup('construction_plan', False)
+            plan = AutoConfigured.from_obj(configurable)
+            self._construction_plans[configurable] = plan
+            return plan
+
     @property
     def config_name(self):
         return 'dossier.web'
@@ -96,45 +206,211 @@ class Config(yakonfig.factory.AutoFactory):
     def auto_config(self):
         return [ElasticStore, LabelStore]
 
+    @property
+    def pooled(self):
+        '''True if services are checked out of shared pools.
+
+        This is set with ``service_mode: pooled`` in the ``dossier.web``
+        configuration. See :mod:`dossier.web.pool`.
+        '''
+        return self.config.get('service_mode', 'thread_local') == 'pooled'
+
+    def release(self):
+        '''Return services used by the current thread to their pools.
+
+        This is called at the end of every request. In the default
+        thread local mode, it does nothing.
+        '''
+        if self._pools is None:
+            return
+        for n in self._THREAD_LOCALS:
+            client = getattr(self, '_' + n)
+            if client is not None:
+                setattr(self, '_' + n, None)
+                self._pools[n].checkin(client)
+
+    def pool_stats(self):
+        '''Return statistics for each service pool.
+
+        :rtype: ``{service name: dict}``
+        '''
+        if self._pools is None:
+            return {}
+        return {name: pool.stats() for name, pool in self._pools.items()}
+
+    def circuit_breaker(self, name):
+        '''Return the circuit breaker for a service.
+
+        :param str name: The service name, e.g., ``store``.
+        :rtype: :class:`dossier.web.breaker.CircuitBreaker`
+        '''
+        try:
+            return self._breakers[name]
+        except KeyError:
+            pass
+        with self._breakers_lock:
+            if name not in self._breakers:
+                conf = self._config or {}
+                self._breakers[name] = CircuitBreaker(
+                    name,
+                    threshold=conf.get('breaker_threshold', 2),
+                    backoff=conf.get('breaker_backoff', 1),
+                    max_backoff=conf.get('breaker_max_backoff', 60))
+            return self._breakers[name]
+
+    def breaker_status(self):
+        '''Return the status of every circuit breaker.
+
+        :rtype: ``{service name: dict}``
+        '''
+        return {name: breaker.status()
+                for name, breaker in self._breakers.items()}
+
+    def warm(self, name, n=None):
+        '''Create clients for a service ahead of time.
+
+        In pooled mode, this fills the service's pool with ``n`` idle
+        clients (all of them, by default). In thread local mode, no
+        client is kept: a client of the current thread would not be
+        used by request threads. The service is created and dropped,
+        which only runs any once-per-process setup (like the schema
+        checks in :class:`dossier.web.Tags`).
+
+        :param str name: The service name, e.g., ``store``.
+        :return: ``True`` if the service is available.
+        '''
+        if getattr(self, name) is None:
+            return False
+        if self._pools is not None and name in self._pools:
+            self.release()
+            pool = self._pools[name]
+            pool.fill(pool.size if n is None else n)
+        elif not self.pooled and name in self._THREAD_LOCALS:
+            setattr(self, '_' + name, None)
+        return True
+
+    def _service(self, name, create):
+        '''Create a new service client or check one out of a pool.'''
+        if not self.pooled:
+            return create()
+        with self._pools_lock:
+            if self._pools is None:
+                self._pools = {}
+            if name not in self._pools:
+                self._pools[name] = Pool(
+                    create,
+                    size=self.config.get('pool_size', 8),
+                    timeout=self.config.get('pool_timeout', 5),
+                    max_idle=self.config.get('pool_max_idle', 300),
+                    check_idle=self.config.get('pool_check_idle', 10))
+            pool = self._pools[name]
+        return pool.checkout()
+
     @property
     @safe_service('_tags')
     def tags(self):
-        'Return a thread local :class:`dossier.web.Tags` client.'
+        'Return a :class:`dossier.web.Tags` client for this thread.'
         if self._tags is None:
-            config = global_config('dossier.tags')
-            self._tags = self.create(Tags, config=config)
+            self._tags = self._service('tags', self.new_tags)
         return self._tags
 
+    def new_tags(self):
+        config = global_config('dossier.tags')
+        return self.create(Tags, config=config)
+
     @property
     @safe_service('_store')
     def store(self):
-        '''Return a thread local :class:`dossier.store.Store` client.'''
+        '''Return a :class:`dossier.store.Store` client for this thread.'''
         if self._store is None:
-            config = global_config('dossier.store')
-            self._store = self.create(ElasticStore, config=config)
+            self._store = self._service('store', self.new_store)
         return self._store
 
+    def new_store(self):
+        config = global_config('dossier.store')
+        return self.create(ElasticStore, config=config)
+
     @property
     @safe_service('_label_store')
     def label_store(self):
-        '''Return a thread local :class:`dossier.label.LabelStore` client.'''
+        '''Return a :class:`dossier.label.LabelStore` for this thread.
+
+        If ``label_write_behind`` is configured, then the label store
+        is wrapped in a
+        :class:`dossier.web.write_behind.WriteBehindLabelStore`.
+        '''
         if self._label_store is None:
-            config = global_config('dossier.label')
-            if 'kvlayer' in config:
-                kvl = kvlayer.client(config=config['kvlayer'])
-                self._label_store = LabelStore(kvl)
-            else:
-                self._label_store = self.create(LabelStore, config=config)
+            self._label_store = self._service('label_store',
+                                              self._new_label_service)
         return self._label_store
 
+    def _new_label_service(self):
+        label_store = self.new_label_store()
+        if self.label_queue is not None:
+            label_store = WriteBehindLabelStore(label_store,
+                                                self.label_queue)
+        return label_store
+
+    def new_label_store(self):
+        config = global_config('dossier.label')
+        if 'kvlayer' in config:
+            kvl = kvlayer.client(config=config['kvlayer'])
+            return LabelStore(kvl)
+        else:
+            return self.create(LabelStore, config=config)
+
+    @property
+    def label_queue(self):
+        '''Return the process wide write-behind label queue.
+
+        This is ``None`` unless ``label_write_behind`` is configured.
+        See :mod:`dossier.web.write_behind`.
+        '''
+        conf = self.config.get('label_write_behind')
+        if not conf:
+            return None
+        with self._label_queue_lock:
+            if self._label_queue is None:
+                self._label_queue = LabelWriteQueue(
+                    self.new_label_store, conf['path'],
+                    flush_ms=conf.get('flush_ms', 50),
+                    max_batch=conf.get('max_batch', 500),
+                    fsync=conf.get('fsync', True),
+                    on_write=self._labels_written)
+        return self._label_queue
+
+    def _labels_written(self, *labels):
+        # Called by the queue's flushing thread. That thread never
+        # releases services like a request does, so it has its own
+        # version client instead of checking one out of a pool.
+        if self._flusher_versions is None:
+            self._flusher_versions = self.new_versions()
+        self._flusher_versions.bump_labels(*labels)
+
     @property
     @safe_service('_kvlclient')
     def kvlclient(self):
-        '''Return a thread local ``kvlayer`` client.'''
+        '''Return a ``kvlayer`` client for this thread.'''
         if self._kvlclient is None:
-            self._kvlclient = kvlayer.client()
+            self._kvlclient = self._service('kvlclient', kvlayer.client)
         return self._kvlclient
 
+    @property
+    @safe_service('_versions')
+    def versions(self):
+        '''Return a :class:`dossier.web.versions.Versions` client.'''
+        if self._versions is None:
+            self._versions = self._service('versions', self.new_versions)
+        return self._versions
+
+    def new_versions(self):
+        # A pooled `Versions` needs its own client, since the thread's
+        # `kvlclient` goes back to its pool separately.
+        kvl = kvlayer.client() if self.pooled else self.kvlclient
+        if kvl is None:
+            return None
+        return Versions(kvl)
+
 
 def global_config(name):
     try:
@@ -0,0 +1,200 @@
+'''Running blocking backend calls in the background.
+
+.. This software is released under an MIT/X11 open source license.
+   Copyright 2012-2015 Diffeo, Inc.
+
+Most of the time spent by search and label routes is spent waiting on
+Elasticsearch, ``kvlayer`` and the label store. Within one request,
+some of that waiting can overlap: for example,
+:class:`dossier.web.search_engines.plain_index_scan` fetches the next
+batch of feature collections while it is still scanning indexes and
+filtering the previous batch.
+
+Background calls run on a process wide :class:`Executor` with a fixed
+number of threads, so the number of concurrent backend calls made this
+way is bounded no matter how many requests are being served. The size
+is :data:`DEFAULT_MAX_WORKERS` unless changed with
+:func:`set_executor`.
+
+.. autoclass:: Executor
+.. autofunction:: get_executor
+.. autofunction:: set_executor
+.. autofunction:: prefetch
+'''
+from __future__ import absolute_import, division, print_function
+
+import atexit
+from collections import deque
+import os
+import Queue
+import sys
+import threading
+
+from dossier.web import timing
+
+
+#: The number of threads in the default executor.
+DEFAULT_MAX_WORKERS = 16
+
+
+class Future(object):
+    '''The eventual result of a call submitted to an :class:`Executor`.'''
+    def __init__(self):
+        self.done = threading.Event()
+        self.value = None
+        self.exc_info = None
+
+    def result(self, timeout=None):
+        '''Wait for the call and return its result.
+
+        If the call raised an exception, it is raised here.
+        '''
+        if not self.done.wait(timeout):
+            raise RuntimeError('call did not finish in %r seconds' % timeout)
+        if self.exc_info is not None:
+            raise self.exc_info[0], self.exc_info[1], self.exc_info[2]
+        return self.value
+
+
+class Executor(object):
+    '''A bounded pool of threads for blocking calls.
+
+    Threads are started the first time they are needed, and again after
+    a fork (since threads do not survive one). Calls made on behalf of
+    a request are counted in its :mod:`dossier.web.timing`.
+
+    .. automethod:: __init__
+    .. automethod:: submit
+    .. automethod:: shutdown
+    '''
+    def __init__(self, max_workers=DEFAULT_MAX_WORKERS):
+        '''Create a new executor.
+
+        :param int max_workers: The maximum number of calls that run at
+                                the same time.
+        '''
+        self.max_workers = max(1, max_workers)
+        self.lock = threading.Lock()
+        self.pid = None
+        self.tasks = None
+        self.threads = []
+
+    def submit(self, fun, *args, **kwargs):
+        '''Call ``fun(*args, **kwargs)`` in a background thread.
+
+        :rtype: :class:`Future`
+        '''
+        future = Future()
+        self._tasks().put((future, timing.current(), fun, args, kwargs))
+        return future
+
+    def _tasks(self):
+        with self.lock:
+            if self.pid != os.getpid():
+                self.pid = os.getpid()
+                self.tasks = Queue.Queue()
+                self.threads = []
+                for i in xrange(self.max_workers):
+                    t = threading.Thread(target=self._work, args=(self.tasks,),
+                                         name='dossier-executor-%d' % i)
+                    t.daemon = True
+                    t.start()
+                    self.threads.append(t)
+            return self.tasks
+
+    def shutdown(self, timeout=1):
+        '''Stop the threads once they finish the calls already submitted.
+
+        Waits up to ``timeout`` seconds for each thread. Threads are
+        started again if more calls are submitted.
+        '''
+        with self.lock:
+            if self.pid != os.getpid():
+                return
+            tasks, threads = self.tasks, self.threads
+            self.pid, self.tasks, self.threads = None, None, []
+        for _ in threads:
+            tasks.put(None)
+        for t in threads:
+            t.join(timeout)
+
+    def _work(self, tasks):
+        while True:
+            task = tasks.get()
+            if task is None:
+                return
+            future, timings, fun, args, kwargs = task
+            timing.set_current(timings)
+            try:
+                future.value = fun(*args, **kwargs)
+            except BaseException:
+                future.exc_info = sys.exc_info()
+            finally:
+                timing.set_current(None)
+                future.done.set()
+
+
+_executor = None
+_executor_lock = threading.Lock()
+
+
+def get_executor():
+    '''Return the process wide executor.
+
+    :rtype: :class:`Executor`
+    '''
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            _executor = Executor()
+        return _executor
+
+
+def set_executor(executor):
+    '''Replace the process wide executor.
+
+    :param executor: The new executor, or ``None`` to use a new default
+                     executor the next time one is needed.
+    :type executor: :class:`Executor`
+    '''
+    global _executor
+    with _executor_lock:
+        _executor = executor
+
+
+@atexit.register
+def _shutdown():
+    # Idle daemon threads can wake up while the interpreter is tearing
+    # down modules and fail noisily, so they are stopped first.
+    with _executor_lock:
+        executor = _executor
+    if executor is not None:
+        executor.shutdown()
+
+
+def prefetch(fun, args_seq, depth=1, executor=None):
+    '''Call ``fun`` on each element of ``args_seq``, in the background.
+
+    This yields ``fun(args)`` for every ``args`` in ``args_seq``, in
+    order. Up to ``depth`` calls run ahead of the consumer, so that the
+    consumer, reading ``args_seq`` and the calls all overlap. If
+    ``depth`` is ``0``, then every call is made in the current thread.
+
+    :param fun: A function of one argument.
+    :param args_seq: An iterable of arguments for ``fun``.
+    :param int depth: The maximum number of calls in flight.
+    :param executor: Defaults to :func:`get_executor`.
+    :type executor: :class:`Executor`
+    '''
+    if depth <= 0:
+        for args in args_seq:
+            yield fun(args)
+        return
+    executor = executor or get_executor()
+    pending = deque()
+    for args in args_seq:
+        pending.append(executor.submit(fun, args))
+        if len(pending) > depth:
+            yield pending.popleft().result()
+    while len(pending) > 0:
+        yield pending.popleft().result()
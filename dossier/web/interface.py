@@ -10,16 +10,20 @@ Search engine and filter interfaces
 .. autoclass:: Filter
     :show-inheritance:
 .. autoclass:: Queryable
+.. autoclass:: Explanation
 '''
 
 from __future__ import absolute_import, division, print_function
 
 import abc
-import json
+from collections import OrderedDict
+from contextlib import contextmanager
+import threading
+import time
 
 import bottle
 
-from dossier.web import util
+from dossier.web import timing, util
 
 
 class Queryable(object):
@@ -222,13 +226,23 @@ class SearchEngine(Queryable):
     .. automethod:: results
     .. automethod:: respond
     .. automethod:: add_filter
+    .. automethod:: add_lazy_filter
+    .. automethod:: get_filter
     .. automethod:: create_filter_predicate
+
+    If the ``explain`` parameter is set, then :meth:`results` includes
+    an ``explain`` key with a trace of the search (see
+    :class:`Explanation`). While a search is being explained, the
+    ``explanation`` attribute is the :class:`Explanation` that search
+    engines should record their steps in. Otherwise, it is ``None``.
     '''
     __metaclass__ = abc.ABCMeta
 
     param_schema = {
         'limit': {'type': 'int', 'default': 30, 'min': 0, 'max': 1000000},
         'omit_fc': {'type': 'bool', 'default': 0},
+        'pretty': {'type': 'bool', 'default': 0},
+        'explain': {'type': 'bool', 'default': 0},
     }
 
     def __init__(self):
@@ -254,6 +268,7 @@ class SearchEngine(Queryable):
         '''
         super(SearchEngine, self).__init__()
         self._filters = {}
+        self.explanation = None
 
     def add_filter(self, name, filter):
         '''Add a filter to this search engine.
@@ -265,6 +280,34 @@ class SearchEngine(Queryable):
         self._filters[name] = filter
         return self
 
+    def add_lazy_filter(self, name, create):
+        '''Add a filter that is created when it is first used.
+
+        ``create`` is only called if the filter is selected by
+        :meth:`create_filter_predicate`.
+
+        :param create: A function with no parameters that returns a
+                       filter.
+        :type create: ``() -> Filter``
+        :rtype: :class:`SearchEngine`
+        '''
+        self._filters[name] = LazyFilter(create)
+        return self
+
+    def get_filter(self, name):
+        '''Return the filter added with the given name.
+
+        If the filter was added with :meth:`add_lazy_filter`, then it
+        is created here (exactly once).
+
+        :param str name: The name of the filter.
+        :rtype: :class:`Filter`
+        '''
+        filter = self._filters[name]
+        if isinstance(filter, LazyFilter):
+            filter = self._filters[name] = filter.create()
+        return filter
+
     def create_filter_predicate(self):
         '''Creates a filter predicate.
 
@@ -287,12 +330,16 @@ class SearchEngine(Queryable):
         filter_names = self.query_params.getlist('filter')
         if len(filter_names) == 0 and 'already_labeled' in self._filters:
             filter_names = ['already_labeled']
-        init_filters = [(n, self._filters[n]) for n in filter_names]
+        timing.annotate(filters=filter_names)
+        init_filters = [(n, self.get_filter(n)) for n in filter_names]
         preds = [lambda _: True]
         for name, p in init_filters:
             preds.append(p.set_query_id(self.query_content_id)
                           .set_query_params(self.query_params)
                           .create_predicate())
+        if self.explanation is not None:
+            return self.explanation.filter_predicate(
+                zip(filter_names, preds[1:]))
         return lambda (cid, fc): fc is not None and all(p((cid, fc))
                                                         for p in preds)
 
@@ -314,23 +361,39 @@ class SearchEngine(Queryable):
         the results returned into JSON encodable values. Namely,
         feature collections are slimmed down to only features that
         are useful to an end-user.
+
+        The time spent in each step is counted towards the ``recommend``
+        and ``transform`` phases of :mod:`dossier.web.timing`.
         '''
-        results = self.recommendations()
-        transformed = []
-        for t in results['results']:
-            if len(t) == 2:
-                cid, fc = t
-                info = {}
-            elif len(t) == 3:
-                cid, fc, info = t
-            else:
-                bottle.abort(500, 'Invalid search result: "%r"' % t)
-            result = info
-            result['content_id'] = cid
-            if not self.params['omit_fc']:
-                result['fc'] = util.fc_to_json(fc)
-            transformed.append(result)
-        results['results'] = transformed
+        if self.params.get('explain'):
+            self.explanation = Explanation()
+        timing.annotate(params=self.params)
+        start = time.time()
+        with timing.phase('recommend'):
+            results = self.recommendations()
+        recommended = time.time()
+        with timing.phase('transform'):
+            transformed = []
+            for t in results['results']:
+                if len(t) == 2:
+                    cid, fc = t
+                    info = {}
+                elif len(t) == 3:
+                    cid, fc, info = t
+                else:
+                    bottle.abort(500, 'Invalid search result: "%r"' % t)
+                result = info
+                result['content_id'] = cid
+                if not self.params['omit_fc']:
+                    result['fc'] = util.fc_to_json(fc)
+                transformed.append(result)
+            results['results'] = transformed
+        if self.explanation is not None:
+            ex = self.explanation
+            ex.add_seconds('recommend', recommended - start)
+            ex.add_seconds('transform', time.time() - recommended)
+            ex.add('results', len(transformed))
+            results['explain'] = self.explanation.to_dict()
         return results
 
     def respond(self, response):
@@ -340,12 +403,131 @@ class SearchEngine(Queryable):
         but implementors may choose to implement this differently
         (e.g., with a cache).
 
+        The JSON is compact unless the ``pretty`` parameter is set. If
+        the client prefers ``application/cbor`` in its ``Accept``
+        header, then the results are encoded as CBOR instead.
+
         :param response: A web response object.
         :type response: :class:`bottle.Response`
         :rtype: `str`
         '''
-        response.content_type = 'application/json'
-        return json.dumps(self.results())
+        response.add_header('Vary', 'Accept')
+        results = self.results()
+        with timing.phase('encode'):
+            if util.negotiate_format(bottle.request) == 'cbor':
+                response.content_type = util.CBOR_MIME
+                return util.cbor_dumps(results)
+            response.content_type = 'application/json'
+            return util.json_dumps(results, pretty=self.params['pretty'])
+
+
+class Explanation(object):
+    '''A trace of the steps of one search.
+
+    Search engines record what they do while explaining a search, and
+    the trace is returned with the results by
+    :meth:`SearchEngine.results`. It is a dictionary with these keys:
+
+    * **scans** lists each index scan, with its ``index``, ``value``,
+      ``hits`` (ids returned by the index), ``new`` (ids not already
+      seen) and ``seconds``.
+    * **filters** maps each filter to the number of results it
+      rejected. Results without a feature collection are counted as
+      rejected by ``missing``.
+    * **counts** has other counts, such as ``fetched`` (feature
+      collections fetched), ``sampled`` (results seen by
+      :func:`dossier.web.streaming_sample`) and ``results``.
+    * **seconds** has the time spent in each step, such as ``fetch``,
+      ``recommend`` and ``transform`` (converting results to JSON
+      values). Steps that run concurrently overlap.
+
+    All methods may be called from any thread.
+
+    .. automethod:: scan
+    .. automethod:: add
+    .. automethod:: add_seconds
+    .. automethod:: timer
+    .. automethod:: counted
+    .. automethod:: filter_predicate
+    .. automethod:: to_dict
+    '''
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.scans = []
+        self.filters = OrderedDict()
+        self.counts = OrderedDict()
+        self.seconds = OrderedDict()
+
+    def scan(self, idx_name, value):
+        '''Record the start of an index scan.
+
+        This returns a dictionary whose ``hits``, ``new`` and
+        ``seconds`` should be updated as the scan proceeds.
+        '''
+        entry = OrderedDict([('index', idx_name), ('value', value),
+                             ('hits', 0), ('new', 0), ('seconds', 0.0)])
+        with self.lock:
+            self.scans.append(entry)
+        return entry
+
+    def add(self, name, n=1):
+        '''Add ``n`` to the count ``name``.'''
+        with self.lock:
+            self.counts[name] = self.counts.get(name, 0) + n
+
+    def add_seconds(self, name, seconds):
+        '''Add ``seconds`` to the time spent in ``name``.'''
+        with self.lock:
+            self.seconds[name] = self.seconds.get(name, 0.0) + seconds
+
+    @contextmanager
+    def timer(self, name):
+        '''Add the time spent in a ``with`` block to ``name``.'''
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.add_seconds(name, time.time() - start)
+
+    def counted(self, name, it):
+        '''Yield from ``it``, counting each item towards ``name``.'''
+        for x in it:
+            self.add(name)
+            yield x
+
+    def filter_predicate(self, preds):
+        '''Combine named predicates, counting what each rejects.
+
+        :param preds: Pairs of filter names and predicates.
+        :rtype: A predicate of ``(content_id, FC)``.
+        '''
+        with self.lock:
+            for name, _ in preds:
+                self.filters.setdefault(name, 0)
+
+        def reject(name):
+            with self.lock:
+                self.filters[name] = self.filters.get(name, 0) + 1
+            return False
+
+        def predicate((cid, fc)):
+            if fc is None:
+                return reject('missing')
+            for name, p in preds:
+                if not p((cid, fc)):
+                    return reject(name)
+            return True
+        return predicate
+
+    def to_dict(self):
+        '''Return the trace as a JSON encodable dictionary.'''
+        with self.lock:
+            return OrderedDict([
+                ('scans', [dict(s) for s in self.scans]),
+                ('filters', dict(self.filters)),
+                ('counts', dict(self.counts)),
+                ('seconds', dict(self.seconds)),
+            ])
 
 
 class Filter(Queryable):
@@ -373,6 +555,15 @@ class Filter(Queryable):
         raise NotImplementedError()
 
 
+class LazyFilter(object):
+    '''A filter that hasn't been created yet.
+
+    See :meth:`SearchEngine.add_lazy_filter`.
+    '''
+    def __init__(self, create):
+        self.create = create
+
+
 def as_multi_dict(d):
     'Coerce a dictionary to a bottle.MultiDict'
     if isinstance(d, bottle.MultiDict):
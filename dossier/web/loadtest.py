@@ -0,0 +1,435 @@
+'''Load testing dossier.web.
+
+.. This software is released under an MIT/X11 open source license.
+   Copyright 2012-2015 Diffeo, Inc.
+
+The ``dossier.web.loadtest`` command sends requests to dossier.web
+from ``--concurrency`` threads and reports the throughput and the
+50th, 95th and 99th percentile latency of each route. Requests either
+go to a running server given by ``--url``, or straight to the WSGI
+application built by :class:`dossier.web.WebBuilder` in the same
+process (with the same configuration as ``dossier.web``). With
+``--synthetic N``, the in-process application is backed by the
+in-memory data of :mod:`dossier.web.benchmark` with ``N`` candidates,
+so nothing else needs to be running. Add ``--latency`` and
+``--jitter`` to make every call to the in-memory store and label store
+wait as if they were remote (see :mod:`dossier.web.memory`).
+
+Requests are either a synthetic mix, given as weights with
+``--mix``::
+
+    dossier.web.loadtest --synthetic 10000 --mix search=6,fc_get=3,status=1
+
+or replayed from access logs in the common or combined log format
+with ``--replay``. Only ``GET`` and ``HEAD`` requests are replayed,
+since the bodies of other requests aren't in the log::
+
+    dossier.web.loadtest --url http://localhost:8080 --replay access.log
+
+The synthetic requests are ``search`` (with the search engine given by
+``--engine``), ``fc_get``, ``label_direct``, ``label_connected``,
+``folders`` and ``status``. All but the last two need content ids,
+which are given with ``--ids`` (a file with one content id per line),
+or are those of the synthetic data.
+
+Each run sends ``--requests`` requests, or runs for ``--duration``
+seconds. Requests are grouped by the route they match (e.g.,
+``GET /dossier/v1/feature-collection/<cid>``). A request is an error
+if it fails or its status is ``5xx``. The report can also be written
+as JSON with ``--output``.
+
+.. autofunction:: run
+.. autofunction:: synthetic
+.. autofunction:: replay
+.. autoclass:: Report
+'''
+from __future__ import absolute_import, division, print_function
+
+import argparse
+from collections import OrderedDict
+import httplib
+from itertools import cycle
+import json
+import math
+import random
+import re
+import sys
+import threading
+import time
+import urllib
+import urlparse
+
+import bottle
+import dblogger
+import kvlayer
+import yakonfig
+
+from dossier.web import benchmark
+from dossier.web.builder import WebBuilder
+from dossier.web.config import Config
+from dossier.web.routes import app as default_app
+from dossier.web.tags import app as tags_app
+from dossier.web.util import wsgi_request
+
+
+#: The default weights of synthetic requests.
+DEFAULT_MIX = 'search=6,fc_get=2,label_direct=1,folders=1'
+
+ACCESS_LOG = re.compile(r'"(?P<method>[A-Z]+) (?P<target>\S+) HTTP/[0-9.]+"')
+
+
+def quote(s):
+    return urllib.quote(s, safe='')
+
+
+#: name -> (needs content ids, (rand, content ids, engine) -> request)
+SYNTHETIC = OrderedDict([
+    ('search', (True, lambda rand, ids, engine: (
+        'GET', '/dossier/v1/feature-collection/%s/search/%s'
+        % (quote(rand.choice(ids)), engine), 'limit=30'))),
+    ('fc_get', (True, lambda rand, ids, engine: (
+        'GET', '/dossier/v1/feature-collection/%s'
+        % quote(rand.choice(ids)), ''))),
+    ('label_direct', (True, lambda rand, ids, engine: (
+        'GET', '/dossier/v1/label/%s/direct' % quote(rand.choice(ids)), ''))),
+    ('label_connected', (True, lambda rand, ids, engine: (
+        'GET', '/dossier/v1/label/%s/connected'
+        % quote(rand.choice(ids)), ''))),
+    ('folders', (False, lambda rand, ids, engine: (
+        'GET', '/dossier/v1/folder', ''))),
+    ('status', (False, lambda rand, ids, engine: (
+        'GET', '/dossier/v1/status', ''))),
+])
+
+
+def parse_mix(s):
+    '''Parse weights like ``search=6,fc_get=3``.'''
+    mix = OrderedDict()
+    for part in s.split(','):
+        name, _, weight = part.strip().partition('=')
+        if name not in SYNTHETIC:
+            raise ValueError('unknown request %r (expected one of %s)'
+                             % (name, ', '.join(SYNTHETIC)))
+        mix[name] = float(weight or 1)
+    return mix
+
+
+def synthetic(mix, content_ids=(), engine='plain_index_scan', seed=None):
+    '''Return an endless iterator of random ``(method, path, query)``.
+
+    ``mix`` maps the names of synthetic requests to their relative
+    weights. :exc:`ValueError` is raised if a request in the mix needs
+    content ids and there are none.
+    '''
+    rand = random.Random(seed)
+    content_ids = list(content_ids)
+    names, weights = zip(*mix.items())
+    for name in names:
+        if SYNTHETIC[name][0] and len(content_ids) == 0:
+            raise ValueError('%r requests need content ids' % name)
+    total = sum(weights)
+
+    def requests():
+        while True:
+            x = rand.uniform(0, total)
+            for name, weight in zip(names, weights):
+                x -= weight
+                if x <= 0:
+                    break
+            yield SYNTHETIC[name][1](rand, content_ids, engine)
+    return requests()
+
+
+def replay(lines, prefix='', methods=('GET', 'HEAD')):
+    '''Yield ``(method, path, query)`` requests from access log lines.
+
+    Lines that aren't requests, and requests whose method isn't in
+    ``methods``, are skipped. ``prefix`` is removed from paths.
+    '''
+    for line in lines:
+        m = ACCESS_LOG.search(line)
+        if m is None or m.group('method') not in methods:
+            continue
+        path, _, query = m.group('target').partition('?')
+        if prefix and path.startswith(prefix):
+            path = path[len(prefix):] or '/'
+        yield m.group('method'), path, query
+
+
+class InProcess(object):
+    '''Sends requests straight to a WSGI application.'''
+    def __init__(self, app, prefix=''):
+        self.app = app
+        self.prefix = prefix
+
+    def __call__(self, method, path, query):
+        status, _, _ = wsgi_request(
+            self.app, method, self.prefix + urllib.unquote(path), query=query)
+        return status
+
+
+class Remote(object):
+    '''Sends requests to a server, with one connection per thread.'''
+    def __init__(self, url, timeout=60):
+        parts = urlparse.urlsplit(url)
+        self.https = parts.scheme == 'https'
+        self.netloc = parts.netloc
+        self.prefix = parts.path.rstrip('/')
+        self.timeout = timeout
+        self.local = threading.local()
+
+    def connection(self):
+        conn = getattr(self.local, 'conn', None)
+        if conn is None:
+            cls = httplib.HTTPSConnection if self.https \
+                else httplib.HTTPConnection
+            conn = self.local.conn = cls(self.netloc, timeout=self.timeout)
+        return conn
+
+    def __call__(self, method, path, query):
+        target = self.prefix + path + ('?' + query if query else '')
+        conn = self.connection()
+        try:
+            conn.request(method, target)
+            resp = conn.getresponse()
+            resp.read()
+            return resp.status
+        except Exception:
+            conn.close()
+            self.local.conn = None
+            raise
+
+
+def route_of(method, path):
+    '''Return the route of dossier.web that matches a request.
+
+    The path is matched before it is unquoted, so that ids with
+    slashes in them still match. If no route matches, then the path
+    itself is returned.
+    '''
+    environ = {'REQUEST_METHOD': method, 'PATH_INFO': path}
+    for app in (default_app, tags_app):
+        try:
+            route, _ = app.router.match(environ)
+            return '%s %s' % (method, route.rule)
+        except bottle.HTTPError:
+            pass
+    return '%s %s' % (method, path)
+
+
+class Report(object):
+    '''The latencies and statuses of requests, by route.
+
+    .. automethod:: add
+    .. automethod:: summary
+    '''
+    def __init__(self):
+        self.lock = threading.Lock()
+        # route -> {'seconds': [...], 'statuses': {status: count}}
+        self.routes = {}
+        self.elapsed = 0.0
+
+    def add(self, route, status, seconds):
+        '''Record a request. ``status`` is ``None`` if it failed.'''
+        with self.lock:
+            r = self.routes.setdefault(route, {'seconds': [], 'statuses': {}})
+            r['seconds'].append(seconds)
+            r['statuses'][status] = r['statuses'].get(status, 0) + 1
+
+    def summary(self):
+        '''Return the statistics of each route, and of ``all`` routes.
+
+        Latencies are in milliseconds, and ``rps`` is the number of
+        requests per second.
+        '''
+        out = OrderedDict()
+        everything = {'seconds': [], 'statuses': {}}
+        for route in sorted(self.routes):
+            r = self.routes[route]
+            out[route] = self.stats(r)
+            everything['seconds'].extend(r['seconds'])
+            for status, count in r['statuses'].items():
+                everything['statuses'][status] = \
+                    everything['statuses'].get(status, 0) + count
+        out['all'] = self.stats(everything)
+        return out
+
+    def stats(self, r):
+        secs = sorted(r['seconds'])
+        errors = sum(count for status, count in r['statuses'].items()
+                     if status is None or status >= 500)
+        ms = [1000 * s for s in secs]
+        return OrderedDict([
+            ('requests', len(secs)),
+            ('errors', errors),
+            ('rps', len(secs) / self.elapsed if self.elapsed > 0 else 0.0),
+            ('mean_ms', sum(ms) / len(ms) if ms else 0.0),
+            ('p50_ms', percentile(ms, 50)),
+            ('p95_ms', percentile(ms, 95)),
+            ('p99_ms', percentile(ms, 99)),
+            ('max_ms', ms[-1] if ms else 0.0),
+            ('statuses', dict((str(k), v)
+                              for k, v in sorted(r['statuses'].items()))),
+        ])
+
+
+def percentile(values, p):
+    '''Return the ``p``-th percentile of sorted ``values``.
+
+    This is the nearest rank: the smallest value that is at least as
+    large as ``p`` percent of the values.
+    '''
+    if len(values) == 0:
+        return 0.0
+    rank = int(math.ceil(p / 100 * len(values))) - 1
+    return values[min(len(values) - 1, max(0, rank))]
+
+
+def run(send, requests, concurrency=8, total=1000, duration=None,
+        clock=time.time):
+    '''Send ``requests`` from ``concurrency`` threads.
+
+    ``send`` is called with ``(method, path, query)`` and returns the
+    response status. ``requests`` is an iterable of those triples.
+    This stops after ``total`` requests, after ``duration`` seconds if
+    it is given, or when ``requests`` runs out.
+
+    :rtype: :class:`Report`
+    '''
+    report = Report()
+    requests = iter(requests)
+    lock = threading.Lock()
+    sent = [0]
+    start = clock()
+    deadline = None if duration is None else start + duration
+
+    def next_request():
+        with lock:
+            if deadline is None and sent[0] >= total:
+                return None
+            if deadline is not None and clock() >= deadline:
+                return None
+            sent[0] += 1
+            return next(requests, None)
+
+    def worker():
+        while True:
+            req = next_request()
+            if req is None:
+                return
+            began = clock()
+            try:
+                status = send(*req)
+            except Exception:
+                status = None
+            report.add(route_of(req[0], req[1]), status, clock() - began)
+
+    threads = [threading.Thread(target=worker, name='dossier-loadtest')
+               for _ in xrange(concurrency)]
+    for t in threads:
+        t.daemon = True
+        t.start()
+    for t in threads:
+        t.join()
+    report.elapsed = clock() - start
+    return report
+
+
+def print_summary(summary, out=sys.stdout):
+    width = max(len(route) for route in summary)
+    print('%-*s %8s %6s %9s %9s %9s %9s' % (
+        width, 'route', 'requests', 'errors', 'req/s',
+        'p50 ms', 'p95 ms', 'p99 ms'), file=out)
+    for route, s in summary.items():
+        print('%-*s %8d %6d %9.1f %9.1f %9.1f %9.1f' % (
+            width, route, s['requests'], s['errors'], s['rps'],
+            s['p50_ms'], s['p95_ms'], s['p99_ms']), file=out)
+
+
+def main():
+    config = Config()
+    p = argparse.ArgumentParser(
+        description='Measure the throughput and latency of dossier.web.')
+    p.add_argument('--url', help='send requests to the server at this URL '
+                                 'instead of an in-process application')
+    p.add_argument('--synthetic', type=int, metavar='N',
+                   help='serve in-process from N synthetic candidates '
+                        'held in memory')
+    p.add_argument('--latency', type=float, default=0,
+                   help='with --synthetic, seconds each store call waits')
+    p.add_argument('--jitter', type=float, default=0,
+                   help='with --synthetic, maximum random seconds added '
+                        'to --latency')
+    p.add_argument('--concurrency', type=int, default=8)
+    p.add_argument('--requests', type=int, default=1000,
+                   help='the number of requests to send')
+    p.add_argument('--duration', type=float,
+                   help='send requests for this many seconds instead')
+    p.add_argument('--mix', default=DEFAULT_MIX,
+                   help='weights of synthetic requests (default: %s)'
+                        % DEFAULT_MIX)
+    p.add_argument('--engine', default='plain_index_scan',
+                   help='the search engine of synthetic searches')
+    p.add_argument('--ids', help='a file of content ids, one per line')
+    p.add_argument('--replay', action='append', default=[],
+                   metavar='ACCESS_LOG',
+                   help='replay the requests in this access log')
+    p.add_argument('--seed', type=int)
+    p.add_argument('--output', help='write the report as JSON to this file')
+    args = yakonfig.parse_args(p, [config, dblogger, kvlayer, yakonfig])
+
+    corpus = None
+    content_ids = []
+    if args.url is not None:
+        send = Remote(args.url)
+        prefix = send.prefix
+    elif args.synthetic is not None:
+        corpus = benchmark.Corpus(args.synthetic, latency=args.latency,
+                                  jitter=args.jitter)
+        content_ids = [str(i) for i in xrange(1, args.synthetic + 1)]
+        send = InProcess(benchmark.app(corpus))
+        prefix = ''
+    else:
+        prefix = config.config.get('url_prefix') or ''
+        send = InProcess(WebBuilder().set_config(config).get_app(),
+                         prefix=prefix)
+    if args.ids is not None:
+        with open(args.ids) as f:
+            content_ids = [line.strip() for line in f if line.strip()]
+
+    try:
+        if args.replay:
+            logged = []
+            for path in args.replay:
+                with open(path) as f:
+                    logged.extend(replay(f, prefix=prefix))
+            if len(logged) == 0:
+                p.error('no GET or HEAD requests found in %s'
+                        % ', '.join(args.replay))
+            requests = cycle(logged)
+        else:
+            try:
+                requests = synthetic(parse_mix(args.mix), content_ids,
+                                     engine=args.engine, seed=args.seed)
+            except ValueError as e:
+                p.error(str(e))
+        report = run(send, requests, concurrency=args.concurrency,
+                     total=args.requests, duration=args.duration)
+    finally:
+        if corpus is not None:
+            corpus.close()
+
+    summary = report.summary()
+    print_summary(summary)
+    if args.output is not None:
+        with open(args.output, 'w') as f:
+            json.dump(OrderedDict([
+                ('concurrency', args.concurrency),
+                ('seconds', report.elapsed),
+                ('routes', summary),
+            ]), f, indent=2)
+            f.write('\n')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,383 @@
+'''In-memory backends for benchmarks and tests.
+
+.. This software is released under an MIT/X11 open source license.
+   Copyright 2012-2015 Diffeo, Inc.
+
+:class:`MemoryStore` implements the parts of
+:class:`dossier.store.ElasticStore` that dossier.web uses, and
+:class:`MemoryLabelStore` implements :class:`dossier.label.LabelStore`,
+without Elasticsearch or a ``kvlayer`` backend, so that search engines,
+filters and routes can be run and measured on a laptop.
+
+Both can simulate a remote service: every call waits ``latency``
+seconds, plus a random extra of up to ``jitter`` seconds. ``latency``
+can also be a dictionary from method names (e.g., ``get_many`` or
+``directly_connected``) to seconds, for methods that are slower than
+others. Calls of methods that return an iterator wait before returning
+it. Methods of :class:`MemoryLabelStore` that follow labels, like
+``connected_component`` and ``negative_inference``, wait in each call
+of ``directly_connected`` that they make. The number of calls of each
+method is counted in ``calls``::
+
+    store = MemoryStore(latency={'get': 0.002, 'index_scan': 0.01},
+                        jitter=0.005)
+    label_store = MemoryLabelStore(latency=0.003)
+    ...
+    assert store.calls['get_many'] == 1
+
+:class:`MemoryConfig` gives these (or any other services) to routes,
+search engines and filters in place of the configured ones::
+
+    app = WebBuilder().set_config(MemoryConfig(store=store)).get_app()
+
+.. autoclass:: MemoryStore
+.. autoclass:: MemoryLabelStore
+.. autoclass:: MemoryConfig
+'''
+from __future__ import absolute_import, division, print_function
+
+from collections import Counter, defaultdict
+from fnmatch import fnmatchcase
+import random
+import threading
+import time
+import uuid
+
+import kvlayer
+
+from dossier.fc import FeatureCollection, StringCounter
+from dossier.label import Label, LabelStore
+from dossier.web.config import Config
+from dossier.web.versions import Versions
+
+
+class Delay(object):
+    '''Waits and counts calls, like a remote service.'''
+    def __init__(self, latency=0, jitter=0, seed=None, sleep=time.sleep):
+        self.latency = latency
+        self.jitter = jitter
+        self.rand = random.Random(seed)
+        self.sleep = sleep
+        self.calls = Counter()
+        self.lock = threading.Lock()
+
+    def __call__(self, method):
+        if isinstance(self.latency, dict):
+            secs = self.latency.get(method, 0)
+        else:
+            secs = self.latency
+        with self.lock:
+            self.calls[method] += 1
+            if self.jitter:
+                secs += self.rand.uniform(0, self.jitter)
+        if secs > 0:
+            self.sleep(secs)
+
+
+class MemoryStore(object):
+    '''An in-memory feature collection store.
+
+    Feature collections are kept in a dictionary, and each index is
+    kept as a dictionary from values to content ids (in the order they
+    were added). Like ``ElasticStore``, an index is named after the
+    feature it indexes.
+
+    .. automethod:: __init__
+    .. automethod:: get
+    .. automethod:: get_many
+    .. automethod:: put
+    .. automethod:: delete
+    .. automethod:: delete_all
+    .. automethod:: scan
+    .. automethod:: scan_ids
+    .. automethod:: index_names
+    .. automethod:: index_scan
+    .. automethod:: index_scan_ids
+    '''
+    def __init__(self, indexes=(u'NAME',), latency=0, jitter=0, seed=None):
+        '''Create an empty store.
+
+        :param indexes: The names of the features to index.
+        :param latency: Seconds that each call waits, or a dictionary
+                        from method names to seconds.
+        :param float jitter: The maximum random seconds added to
+                             ``latency``.
+        :param seed: The seed of the random jitter.
+        '''
+        self.indexes = list(indexes)
+        self.lock = threading.Lock()
+        self.fcs = {}
+        self.index = dict((name, defaultdict(list)) for name in indexes)
+        self.delay = Delay(latency, jitter, seed=seed)
+        self.calls = self.delay.calls
+
+    def get(self, content_id, feature_names=None):
+        '''Return the feature collection ``content_id``, or ``None``.
+
+        If ``feature_names`` is given, then only those features
+        (which may have wildcards) are returned.
+        '''
+        self.delay('get')
+        return select_features(self.fcs.get(content_id), feature_names)
+
+    def get_many(self, content_ids, feature_names=None):
+        '''Return ``(content_id, FC)`` for each id, in order.
+
+        ``FC`` is ``None`` if there is no feature collection with
+        that id. ``feature_names`` is the same as in :meth:`get`.
+        '''
+        self.delay('get_many')
+        return iter([(cid, select_features(self.fcs.get(cid), feature_names))
+                     for cid in content_ids])
+
+    def put(self, items, indexes=True):
+        '''Add ``(content_id, FC)`` pairs to the store.'''
+        self.delay('put')
+        with self.lock:
+            for cid, fc in items:
+                if cid in self.fcs:
+                    self._unindex(cid)
+                self.fcs[cid] = fc
+                if indexes:
+                    for name in self.indexes:
+                        for val in feature_values(fc.get(name)):
+                            self.index[name][val].append(cid)
+
+    def delete(self, content_id):
+        '''Delete a feature collection, if it exists.'''
+        self.delay('delete')
+        with self.lock:
+            if content_id in self.fcs:
+                self._unindex(content_id)
+                del self.fcs[content_id]
+
+    def delete_all(self):
+        '''Delete every feature collection.'''
+        self.delay('delete_all')
+        with self.lock:
+            self.fcs.clear()
+            for idx in self.index.values():
+                idx.clear()
+
+    def scan(self, *key_ranges, **kwargs):
+        '''Return every ``(content_id, FC)`` in content id order.
+
+        ``key_ranges`` are ignored.
+        '''
+        self.delay('scan')
+        with self.lock:
+            return iter(sorted(self.fcs.items()))
+
+    def scan_ids(self, *key_ranges, **kwargs):
+        '''Return every content id, in order.
+
+        ``key_ranges`` are ignored.
+        '''
+        self.delay('scan_ids')
+        with self.lock:
+            return iter(sorted(self.fcs))
+
+    def index_names(self):
+        '''Return the names of the indexes.'''
+        self.delay('index_names')
+        return list(self.indexes)
+
+    def index_scan(self, idx_name, val):
+        '''Return the content ids with ``val`` in ``idx_name``.'''
+        self.delay('index_scan')
+        return self._index_scan(idx_name, val)
+
+    def index_scan_ids(self, fname, val):
+        '''The same as :meth:`index_scan`.'''
+        self.delay('index_scan_ids')
+        return self._index_scan(fname, val)
+
+    def _index_scan(self, idx_name, val):
+        with self.lock:
+            return iter(list(self.index.get(idx_name, {}).get(val, [])))
+
+    def _unindex(self, cid):
+        fc = self.fcs[cid]
+        for name in self.indexes:
+            for val in feature_values(fc.get(name)):
+                cids = self.index[name].get(val)
+                if cids is not None and cid in cids:
+                    cids.remove(cid)
+
+
+class MemoryLabelStore(LabelStore):
+    '''An in-memory label store.
+
+    Like :class:`dossier.label.LabelStore`, every label that is put is
+    kept, and only the most recent label for each pair of identifiers
+    and annotator is returned unless deleted labels are asked for.
+    Connected components, expansion and negative inference are
+    inherited from :class:`dossier.label.LabelStore`, so they make the
+    same calls to :meth:`directly_connected` (each of which waits) as
+    with any other backend.
+
+    .. automethod:: __init__
+    .. automethod:: put
+    .. automethod:: get
+    .. automethod:: directly_connected
+    .. automethod:: everything
+    .. automethod:: delete
+    .. automethod:: delete_all
+    '''
+    def __init__(self, latency=0, jitter=0, seed=None):
+        '''Create an empty label store.
+
+        The parameters are the same as :meth:`MemoryStore.__init__`.
+        '''
+        self.lock = threading.Lock()
+        # (cid1, cid2, subid1, subid2, annotator, epoch ticks) -> label
+        self.rows = {}
+        # content id -> set of keys of `rows`
+        self.by_cid = defaultdict(set)
+        self.delay = Delay(latency, jitter, seed=seed)
+        self.calls = self.delay.calls
+
+    def put(self, *labels):
+        '''Add new labels to the store.'''
+        self.delay('put')
+        with self.lock:
+            for lab in labels:
+                key = label_key(lab)
+                self.rows[key] = lab
+                self.by_cid[lab.content_id1].add(key)
+                self.by_cid[lab.content_id2].add(key)
+
+    def get(self, cid1, cid2, annotator_id, subid1='', subid2=''):
+        '''Return the most recent label with the given parts.
+
+        :raises: :exc:`KeyError` if there is no such label.
+        '''
+        self.delay('get')
+        want = label_key(Label(cid1, cid2, annotator_id, 0,
+                               subtopic_id1=subid1, subtopic_id2=subid2))[:5]
+        with self.lock:
+            found = [lab for key, lab in self.rows.items()
+                     if key[:5] == want]
+        if len(found) == 0:
+            raise KeyError((cid1, cid2, subid1, subid2, annotator_id))
+        return max(found, key=lambda lab: lab.epoch_ticks)
+
+    def directly_connected(self, ident):
+        '''Return the labels connected to ``ident``.
+
+        ``ident`` may be a ``content_id`` or a ``(content_id,
+        subtopic_id)``.
+        '''
+        self.delay('directly_connected')
+        return super(MemoryLabelStore, self).directly_connected(ident)
+
+    def everything(self, include_deleted=False, content_id=None,
+                   subtopic_id=None, prefix=None):
+        '''Return labels in sorted order, most recent first.
+
+        The parameters are the same as
+        :meth:`dossier.label.LabelStore.everything`.
+        '''
+        with self.lock:
+            if content_id is not None:
+                keys = self.by_cid.get(content_id, ())
+                labels = [self.rows[k] for k in keys]
+            else:
+                labels = list(self.rows.values())
+        if content_id is not None and subtopic_id is not None:
+            labels = [lab for lab in labels
+                      if (lab.content_id1, lab.subtopic_id1)
+                      == (content_id, subtopic_id)
+                      or (lab.content_id2, lab.subtopic_id2)
+                      == (content_id, subtopic_id)]
+        elif content_id is None and prefix is not None:
+            labels = [lab for lab in labels
+                      if lab.content_id1.startswith(prefix)
+                      or lab.content_id2.startswith(prefix)]
+        labels.sort()
+        if not include_deleted:
+            return Label.most_recent(labels)
+        return iter(labels)
+
+    def delete(self, *labels):
+        '''Delete ``labels`` from the store.
+
+        :raises: :exc:`KeyError` if any of the labels can't be found.
+        '''
+        self.delay('delete')
+        with self.lock:
+            for lab in labels:
+                key = label_key(lab)
+                del self.rows[key]
+                for cid in (lab.content_id1, lab.content_id2):
+                    self.by_cid[cid].discard(key)
+
+    def delete_all(self):
+        '''Delete every label.'''
+        self.delay('delete_all')
+        with self.lock:
+            self.rows.clear()
+            self.by_cid.clear()
+
+
+class MemoryConfig(Config):
+    '''A configuration with the services it is given.
+
+    The services are shared by every thread, instead of being created
+    for each thread from the global configuration.
+
+    .. automethod:: __init__
+    '''
+    # These replace the thread local properties of `Config`.
+    store = label_store = kvlclient = versions = None
+
+    def __init__(self, store=None, label_store=None, kvlclient=None,
+                 config=None):
+        '''Create a configuration.
+
+        :param store: Defaults to a new :class:`MemoryStore`.
+        :param label_store: Defaults to a new :class:`MemoryLabelStore`.
+        :param kvlclient: Defaults to a new local ``kvlayer`` client
+                          with a namespace of its own.
+        :param dict config: The ``dossier.web`` configuration.
+        '''
+        super(MemoryConfig, self).__init__(config=config or {})
+        if kvlclient is None:
+            kvlclient = kvlayer.client(
+                config={}, storage_type='local', app_name='diffeo',
+                namespace='dossier.web.memory.%s' % uuid.uuid4().hex)
+        self.store = MemoryStore() if store is None else store
+        self.label_store = MemoryLabelStore() if label_store is None \
+            else label_store
+        self.kvlclient = kvlclient
+        self.versions = Versions(kvlclient)
+
+
+def label_key(lab):
+    return (lab.content_id1, lab.content_id2, lab.subtopic_id1,
+            lab.subtopic_id2, lab.annotator_id, lab.epoch_ticks)
+
+
+def select_features(fc, feature_names):
+    '''Return ``fc`` with only the features in ``feature_names``.
+
+    Like :meth:`dossier.store.ElasticStore.get`, feature names may
+    have wildcards, and every feature is kept if ``feature_names``
+    is ``None``.
+    '''
+    if fc is None or feature_names is None:
+        return fc
+    return FeatureCollection(dict(
+        (name, feat) for name, feat in fc.iteritems()
+        if any(fnmatchcase(name, pat) for pat in feature_names)))
+
+
+def feature_values(feat):
+    '''Return the indexable values of a feature.'''
+    if feat is None:
+        return []
+    if isinstance(feat, basestring):
+        return [feat]
+    if isinstance(feat, (dict, StringCounter)):
+        return list(feat.iterkeys())
+    return []
@@ -0,0 +1,370 @@
+'''Request and backend metrics in Prometheus text format.
+
+.. This software is released under an MIT/X11 open source license.
+   Copyright 2012-2015 Diffeo, Inc.
+
+Metrics are kept in a process wide :class:`Registry` and served by
+:func:`dossier.web.routes.v1_metrics` at ``/dossier/v1/metrics`` in the
+Prometheus text format. Each labelled series has its own lock, so
+threads serving different routes or calling different backends don't
+contend.
+
+Metrics are not aggregated across processes. With the pre-forking
+server in :mod:`dossier.web.server`, each worker process has its own
+registry, and a scrape gets the metrics of whichever worker accepts
+it. Counters would then appear to jump backwards between scrapes, so
+``/dossier/v1/metrics`` is only valid with ``--workers 1`` (use
+``--threads`` for concurrency). The ``dossier.web`` command logs a
+warning if metrics are enabled with more than one worker.
+
+These are always collected:
+
+* ``dossier_web_cache_requests_total{cache, result}``: hits and misses
+  of in-process caches (``etag`` for conditional requests answered
+  with ``304``, ``construction_plan`` and ``pool`` for idle clients
+  reused by :mod:`dossier.web.pool`). The hit ratio of a cache is
+  ``hit / (hit + miss)``.
+* the state of every circuit breaker, client pool and admission
+  control group, as gauges collected when the metrics are served.
+
+These are collected once enabled with
+:meth:`dossier.web.WebBuilder.enable_metrics` (or ``metrics: true`` in
+the ``dossier.web`` configuration):
+
+* ``dossier_web_requests_total{route, method, status}``
+* ``dossier_web_request_errors_total{route, method}``, for responses
+  with a ``5xx`` status
+* ``dossier_web_request_seconds{route}``, a histogram
+* ``dossier_web_active_requests``, a gauge (streamed responses are
+  active until their body has been sent)
+* ``dossier_web_backend_seconds{service, method}``, a histogram of the
+  calls made to each method of ``store``, ``label_store``,
+  ``kvlclient`` and ``tags`` (e.g., ``store.index_scan``,
+  ``store.get_many`` or ``label_store.directly_connected``)
+
+.. autoclass:: Registry
+.. autoclass:: MetricsPlugin
+.. autofunction:: cache_lookup
+.. autofunction:: observe_backend
+.. autofunction:: status_registry
+'''
+from __future__ import absolute_import, division, print_function
+
+from bisect import bisect_left
+import threading
+import time
+import types
+
+import bottle
+
+
+#: The upper bounds of latency histogram buckets, in seconds.
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25,
+                   0.5, 1, 2.5, 5, 10)
+
+#: The content type of the Prometheus text format.
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+
+class Metric(object):
+    '''A family of series with the same name and label names.'''
+    kind = None
+
+    def __init__(self, name, doc, labels=()):
+        self.name = name
+        self.doc = doc
+        self.label_names = tuple(labels)
+        self.lock = threading.Lock()
+        self.children = {}
+
+    def labels(self, *values):
+        '''Return the series with the given label values.'''
+        child = self.children.get(values)
+        if child is None:
+            assert len(values) == len(self.label_names), \
+                'expected labels %r' % (self.label_names,)
+            with self.lock:
+                child = self.children.setdefault(values, self.new_child())
+        return child
+
+    def render(self):
+        lines = ['# HELP %s %s' % (self.name, self.doc),
+                 '# TYPE %s %s' % (self.name, self.kind)]
+        for values, child in sorted(self.children.items()):
+            labels = zip(self.label_names, values)
+            lines.extend(child.render(self.name, labels))
+        return lines
+
+
+class Value(object):
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.value = 0
+
+    def inc(self, n=1):
+        with self.lock:
+            self.value += n
+
+    def dec(self, n=1):
+        with self.lock:
+            self.value -= n
+
+    def set(self, value):
+        self.value = value
+
+    def render(self, name, labels):
+        return ['%s%s %s' % (name, format_labels(labels),
+                             format_value(self.value))]
+
+
+class Counter(Metric):
+    '''A value that only goes up.'''
+    kind = 'counter'
+
+    def new_child(self):
+        return Value()
+
+
+class Gauge(Metric):
+    '''A value that goes up and down.'''
+    kind = 'gauge'
+
+    def new_child(self):
+        return Value()
+
+
+class HistogramValue(object):
+    def __init__(self, buckets):
+        self.lock = threading.Lock()
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+
+    def observe(self, value):
+        i = bisect_left(self.buckets, value)
+        with self.lock:
+            self.counts[i] += 1
+            self.sum += value
+
+    def render(self, name, labels):
+        with self.lock:
+            counts, total = list(self.counts), self.sum
+        lines = []
+        cumulative = 0
+        for bound, count in zip(self.buckets + ('+Inf',), counts):
+            cumulative += count
+            le = bound if bound == '+Inf' else format_value(bound)
+            lines.append('%s_bucket%s %d' % (
+                name, format_labels(labels + [('le', le)]), cumulative))
+        lines.append('%s_sum%s %s' % (name, format_labels(labels),
+                                      format_value(total)))
+        lines.append('%s_count%s %d' % (name, format_labels(labels),
+                                        cumulative))
+        return lines
+
+
+class Histogram(Metric):
+    '''Counts of observations in buckets.'''
+    kind = 'histogram'
+
+    def __init__(self, name, doc, labels=(), buckets=LATENCY_BUCKETS):
+        super(Histogram, self).__init__(name, doc, labels)
+        self.buckets = tuple(sorted(buckets))
+
+    def new_child(self):
+        return HistogramValue(self.buckets)
+
+
+class Registry(object):
+    '''A collection of metrics.
+
+    .. automethod:: counter
+    .. automethod:: gauge
+    .. automethod:: histogram
+    .. automethod:: render
+    '''
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.metrics = {}
+
+    def counter(self, name, doc, labels=()):
+        '''Return the counter ``name``, creating it if needed.'''
+        return self._get(Counter, name, doc, labels=labels)
+
+    def gauge(self, name, doc, labels=()):
+        '''Return the gauge ``name``, creating it if needed.'''
+        return self._get(Gauge, name, doc, labels=labels)
+
+    def histogram(self, name, doc, labels=(), buckets=LATENCY_BUCKETS):
+        '''Return the histogram ``name``, creating it if needed.'''
+        return self._get(Histogram, name, doc, labels=labels,
+                         buckets=buckets)
+
+    def render(self):
+        '''Return every metric in the Prometheus text format.'''
+        lines = []
+        for name in sorted(self.metrics):
+            lines.extend(self.metrics[name].render())
+        return '\n'.join(lines) + '\n'
+
+    def _get(self, cls, name, doc, **kwargs):
+        with self.lock:
+            if name not in self.metrics:
+                self.metrics[name] = cls(name, doc, **kwargs)
+            metric = self.metrics[name]
+        assert isinstance(metric, cls), '%s is a %s' % (name, metric.kind)
+        return metric
+
+
+#: The registry of this process.
+REGISTRY = Registry()
+
+CACHE_REQUESTS = REGISTRY.counter(
+    'dossier_web_cache_requests_total',
+    'Lookups in in-process caches.', labels=('cache', 'result'))
+REQUESTS = REGISTRY.counter(
+    'dossier_web_requests_total', 'Requests served.',
+    labels=('route', 'method', 'status'))
+REQUEST_ERRORS = REGISTRY.counter(
+    'dossier_web_request_errors_total', 'Requests that failed with 5xx.',
+    labels=('route', 'method'))
+REQUEST_SECONDS = REGISTRY.histogram(
+    'dossier_web_request_seconds', 'Time spent serving requests.',
+    labels=('route',))
+ACTIVE_REQUESTS = REGISTRY.gauge(
+    'dossier_web_active_requests', 'Requests being served.').labels()
+BACKEND_SECONDS = REGISTRY.histogram(
+    'dossier_web_backend_seconds', 'Time spent in backend calls.',
+    labels=('service', 'method'))
+
+
+def cache_lookup(cache, hit):
+    '''Count a hit (or miss, if ``hit`` is false) of ``cache``.'''
+    CACHE_REQUESTS.labels(cache, 'hit' if hit else 'miss').inc()
+
+
+def observe_backend(service, method, seconds):
+    '''Count a call of ``seconds`` to ``service.method``.'''
+    BACKEND_SECONDS.labels(service, method).observe(seconds)
+
+
+def status_registry(config, admission=None):
+    '''Return a new registry with the state of services as gauges.
+
+    This includes the circuit breakers and pools of ``config`` and the
+    groups of ``admission`` (a
+    :class:`dossier.web.admission.AdmissionControl`).
+    '''
+    reg = Registry()
+    states = ['closed', 'open', 'half_open']
+    breaker_state = reg.gauge(
+        'dossier_web_breaker_state',
+        'Whether a circuit breaker is in a state (1) or not (0).',
+        labels=('service', 'state'))
+    breaker_rejected = reg.counter(
+        'dossier_web_breaker_rejected_total',
+        'Requests rejected by an open circuit breaker.',
+        labels=('service',))
+    for name, status in getattr(config, 'breaker_status', dict)().items():
+        for state in states:
+            breaker_state.labels(name, state).set(
+                int(status['state'] == state))
+        breaker_rejected.labels(name).set(status['rejected'])
+
+    pool_keys = ['size', 'clients', 'idle', 'in_use', 'waiting']
+    pool_gauge = reg.gauge('dossier_web_pool_clients',
+                           'Clients of each service pool.',
+                           labels=('service', 'kind'))
+    for name, stats in getattr(config, 'pool_stats', dict)().items():
+        for key in pool_keys:
+            pool_gauge.labels(name, key).set(stats[key])
+
+    if admission is not None:
+        running = reg.gauge('dossier_web_admission_running',
+                            'Admitted requests running in each group.',
+                            labels=('group',))
+        waiting = reg.gauge('dossier_web_admission_waiting',
+                            'Requests waiting in the queue of each group.',
+                            labels=('group',))
+        shed = reg.counter('dossier_web_admission_shed_total',
+                           'Requests shed by each group.', labels=('group',))
+        wait = reg.counter('dossier_web_admission_wait_seconds_total',
+                           'Time spent waiting in the queue of each group.',
+                           labels=('group',))
+        for name, stats in admission.stats().items():
+            running.labels(name).set(stats['running'])
+            waiting.labels(name).set(stats['waiting'])
+            shed.labels(name).set(stats['shed'])
+            wait.labels(name).set(stats['wait_seconds'])
+    return reg
+
+
+class MetricsPlugin(object):
+    '''A Bottle plugin that counts and times requests.'''
+    api = 2
+    name = 'metrics'
+
+    def apply(self, callback, route):
+        rule = route.rule
+        seconds = REQUEST_SECONDS.labels(rule)
+
+        def finish(start, status):
+            method = bottle.request.method
+            seconds.observe(time.time() - start)
+            REQUESTS.labels(rule, method, str(status)).inc()
+            if status >= 500:
+                REQUEST_ERRORS.labels(rule, method).inc()
+            ACTIVE_REQUESTS.dec()
+
+        def _(*args, **kwargs):
+            start = time.time()
+            ACTIVE_REQUESTS.inc()
+            try:
+                rv = callback(*args, **kwargs)
+            except bottle.HTTPResponse as e:
+                finish(start, e.status_code)
+                raise
+            except Exception:
+                finish(start, 500)
+                raise
+            if isinstance(rv, bottle.HTTPResponse):
+                # E.g., from `bottle.static_file`.
+                status = rv.status_code
+            else:
+                status = bottle.response.status_code
+            if isinstance(rv, types.GeneratorType):
+                return self.finish_after(rv, start, finish, status)
+            finish(start, status)
+            return rv
+        return _
+
+    def finish_after(self, gen, start, finish, status):
+        try:
+            for chunk in gen:
+                yield chunk
+        except Exception:
+            status = 500
+            raise
+        finally:
+            gen.close()
+            finish(start, status)
+
+
+def format_labels(labels):
+    if len(labels) == 0:
+        return ''
+    return '{%s}' % ','.join('%s="%s"' % (k, escape(v)) for k, v in labels)
+
+
+def escape(v):
+    if not isinstance(v, basestring):
+        v = str(v)
+    if isinstance(v, unicode):
+        v = v.encode('utf-8')
+    return v.replace('\\', r'\\').replace('\n', r'\n').replace('"', r'\"')
+
+
+def format_value(v):
+    if isinstance(v, float):
+        return repr(v)
+    return str(v)
@@ -0,0 +1,228 @@
+'''Bounded pools of backend clients.
+
+.. This software is released under an MIT/X11 open source license.
+   Copyright 2012-2015 Diffeo, Inc.
+
+By default, :class:`dossier.web.Config` creates one client per thread
+for each backend service (Elasticsearch, ``kvlayer``, etc.). A server
+with many threads therefore holds many connections to each backend.
+
+In pooled mode, each service instead has a :class:`Pool` with a fixed
+maximum number of clients. A thread checks out a client the first time
+it uses a service during a request, and every client is checked back
+in when the request finishes. A client is only ever used by one thread
+at a time, so clients do not need to be thread safe. (For the same
+reason, :class:`dossier.web.search_engines.plain_index_scan` doesn't
+fetch in background threads in pooled mode, unless a search asks for
+it with the ``prefetch`` parameter. That requires a thread safe
+store.) If every client of a pool is in use, a request waits up to
+``pool_timeout`` seconds for one to be returned before the service is
+reported as unavailable.
+
+Pooled mode is enabled in the ``dossier.web`` configuration::
+
+    dossier.web:
+      service_mode: pooled  # the default is `thread_local`
+      pool_size: 8          # per service
+      pool_timeout: 5       # seconds to wait for a free client
+      pool_max_idle: 300    # seconds before an idle client is closed
+      pool_check_idle: 10   # seconds idle before a client is pinged
+
+.. autoclass:: Pool
+'''
+from __future__ import absolute_import, division, print_function
+
+from collections import deque
+import logging
+import threading
+import time
+
+from dossier.web.metrics import cache_lookup
+
+
+logger = logging.getLogger(__name__)
+
+
+class Pool(object):
+    '''A bounded pool of clients.
+
+    .. automethod:: __init__
+    .. automethod:: checkout
+    .. automethod:: checkin
+    .. automethod:: discard
+    .. automethod:: fill
+    .. automethod:: stats
+    '''
+    def __init__(self, create, size=8, timeout=5, max_idle=300,
+                 check_idle=10, check=None, close=None):
+        '''Create a new pool.
+
+        :param create: A function that creates a new client.
+        :param int size: The maximum number of clients.
+        :param float timeout: Seconds :meth:`checkout` waits for a
+                              client when all are in use.
+        :param float max_idle: Clients that have been idle for this many
+                               seconds are closed instead of reused.
+        :param float check_idle: Clients that have been idle for this
+                                 many seconds are checked with ``check``
+                                 before they are reused.
+        :param check: A function that returns true if a client is
+                      healthy. It may also raise an exception if the
+                      client is not healthy. Defaults to
+                      :func:`ping_client`.
+        :param close: A function that closes a client. Defaults to
+                      :func:`close_client`.
+        '''
+        self.create = create
+        self.size = max(1, size)
+        self.timeout = timeout
+        self.max_idle = max_idle
+        self.check_idle = check_idle
+        self.check = check or ping_client
+        self.close = close or close_client
+        self.lock = threading.Lock()
+        self.returned = threading.Condition(self.lock)
+        # (client, time of check in), most recently returned last.
+        self.idle = deque()
+        self.num_clients = 0
+        self.waiting = 0
+
+    def checkout(self):
+        '''Return a client for the exclusive use of the caller.
+
+        Idle clients are reused before new ones are created.
+
+        :raises PoolTimeout: if no client becomes available within
+                             ``timeout`` seconds.
+        '''
+        deadline = time.time() + self.timeout
+        while True:
+            with self.lock:
+                client, idle_since = self._take(deadline)
+            if client is None:
+                break
+            idle = time.time() - idle_since
+            if idle >= self.max_idle:
+                self.discard(client)
+                continue
+            if idle >= self.check_idle and not self._healthy(client):
+                self.discard(client)
+                continue
+            cache_lookup('pool', True)
+            return client
+        cache_lookup('pool', False)
+        # There is room for a new client. Create it outside the lock,
+        # since connecting can be slow.
+        try:
+            return self.create()
+        except Exception:
+            with self.lock:
+                self.num_clients -= 1
+                self.returned.notify()
+            raise
+
+    def checkin(self, client):
+        '''Return a client to the pool.'''
+        with self.lock:
+            self.idle.append((client, time.time()))
+            self.returned.notify()
+
+    def discard(self, client):
+        '''Close a checked out client instead of returning it.'''
+        with self.lock:
+            self.num_clients -= 1
+            self.returned.notify()
+        try:
+            self.close(client)
+        except Exception:
+            logger.warn('could not close %r', client, exc_info=True)
+
+    def fill(self, n):
+        '''Create idle clients until there are at least ``n`` clients.
+
+        This never creates more than ``size`` clients.
+        '''
+        while True:
+            with self.lock:
+                if self.num_clients >= min(n, self.size):
+                    return
+                self.num_clients += 1
+            try:
+                client = self.create()
+            except Exception:
+                with self.lock:
+                    self.num_clients -= 1
+                    self.returned.notify()
+                raise
+            self.checkin(client)
+
+    def stats(self):
+        '''Return a dictionary of statistics about this pool.
+
+        The keys are ``size``, ``clients``, ``idle``, ``in_use`` and
+        ``waiting``.
+        '''
+        with self.lock:
+            return {
+                'size': self.size,
+                'clients': self.num_clients,
+                'idle': len(self.idle),
+                'in_use': self.num_clients - len(self.idle),
+                'waiting': self.waiting,
+            }
+
+    def _take(self, deadline):
+        '''Take an idle client or reserve room for a new one.
+
+        Returns ``(client, idle_since)``, or ``(None, None)`` if the
+        caller should create a new client. This must be called with
+        the lock held.
+        '''
+        while True:
+            if len(self.idle) > 0:
+                return self.idle.pop()
+            if self.num_clients < self.size:
+                self.num_clients += 1
+                return None, None
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                raise PoolTimeout('no client available after %0.1f seconds'
+                                  % self.timeout)
+            self.waiting += 1
+            try:
+                self.returned.wait(remaining)
+            finally:
+                self.waiting -= 1
+
+    def _healthy(self, client):
+        try:
+            return self.check(client)
+        except Exception:
+            logger.warn('health check of %r failed', client, exc_info=True)
+            return False
+
+
+class PoolTimeout(Exception):
+    '''Raised when a pool has no client available.'''
+    pass
+
+
+def ping_client(client):
+    '''Ping the Elasticsearch connection of a client, if it has one.'''
+    conn = getattr(client, 'conn', None)
+    if conn is not None and hasattr(conn, 'ping'):
+        return conn.ping()
+    return True
+
+
+def close_client(client):
+    '''Close a client's connections, if it knows how.'''
+    if hasattr(client, 'close'):
+        client.close()
+        return
+    conn = getattr(client, 'conn', None)
+    if conn is not None and hasattr(conn, 'transport'):
+        conn.transport.close()
+    kvl = getattr(client, 'kvl', None)
+    if kvl is not None and hasattr(kvl, 'close'):
+        kvl.close()
@@ -0,0 +1,189 @@
+'''Profiling individual requests on demand.
+
+.. This software is released under an MIT/X11 open source license.
+   Copyright 2012-2015 Diffeo, Inc.
+
+When a particular request is slow (say, a search for one profile), it
+is most useful to profile exactly that request. Once enabled with
+:meth:`dossier.web.WebBuilder.enable_profiling` (or ``profile_token``
+in the ``dossier.web`` configuration), any request with a
+``_profile`` query parameter and an ``X-Profile-Token`` header that
+matches the configured token is run under :mod:`cProfile` and a
+sampling profiler at the same time:
+
+* ``_profile=1`` responds with the ``top`` functions sorted by
+  cumulative time, instead of the route's normal response.
+* ``_profile=collapsed`` responds with the sampled stacks in the
+  "collapsed" format read by ``flamegraph.pl`` and speedscope.
+* ``_profile=save`` responds normally, and saves ``.prof`` (for
+  :mod:`pstats`), ``.txt`` and ``.collapsed`` files to ``directory``.
+  Their path (without the extension) is sent in the ``X-Profile``
+  header.
+
+Requests with ``_profile`` and no valid token are rejected with
+``403``. When profiling is not enabled, nothing is installed, so there
+is no overhead at all.
+
+The sampling profiler is a thread that records the stack of the
+request's thread every ``interval`` seconds, so it needs nothing
+beyond the standard library.
+
+.. autoclass:: ProfilePlugin
+.. autoclass:: Sampler
+'''
+from __future__ import absolute_import, division, print_function
+
+from collections import Counter
+import cProfile
+import hmac
+import logging
+import os
+import os.path
+import pstats
+import StringIO
+import sys
+import threading
+import time
+import types
+
+import bottle
+
+
+logger = logging.getLogger(__name__)
+
+
+class Sampler(object):
+    '''Samples the stack of one thread at a fixed interval.
+
+    .. automethod:: __init__
+    .. automethod:: start
+    .. automethod:: stop
+    .. automethod:: collapsed
+    '''
+    def __init__(self, thread_id=None, interval=0.005):
+        '''Prepare to sample a thread.
+
+        :param int thread_id: The thread to sample. Defaults to the
+                              current thread.
+        :param float interval: Seconds between samples.
+        '''
+        if thread_id is None:
+            thread_id = threading.current_thread().ident
+        self.thread_id = thread_id
+        self.interval = interval
+        self.stacks = Counter()
+        self.stopped = threading.Event()
+        self.thread = None
+
+    def start(self):
+        '''Start sampling in a background thread.'''
+        self.thread = threading.Thread(target=self.run,
+                                       name='dossier-profile-sampler')
+        self.thread.daemon = True
+        self.thread.start()
+        return self
+
+    def stop(self):
+        '''Stop sampling.'''
+        self.stopped.set()
+        if self.thread is not None:
+            self.thread.join()
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            if frame is None:
+                return
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append('%s (%s:%d)' % (code.co_name, code.co_filename,
+                                             code.co_firstlineno))
+                frame = frame.f_back
+            self.stacks[';'.join(reversed(stack))] += 1
+
+    def collapsed(self):
+        '''Return the samples in the collapsed stack format.
+
+        Each line is a stack of semicolon separated frames, outermost
+        first, followed by the number of samples with that stack.
+        '''
+        return ''.join('%s %d\n' % (stack, count)
+                       for stack, count in sorted(self.stacks.items()))
+
+
+class ProfilePlugin(object):
+    '''A Bottle plugin that profiles requests that ask for it.
+
+    See :mod:`dossier.web.profiling`.
+    '''
+    api = 2
+    name = 'profile'
+
+    def __init__(self, token, directory=None, top=30, interval=0.005):
+        self.token = token
+        self.directory = directory
+        self.top = top
+        self.interval = interval
+
+    def apply(self, callback, route):
+        def _(*args, **kwargs):
+            mode = bottle.request.query.get('_profile')
+            if mode is None:
+                return callback(*args, **kwargs)
+            self.check_token()
+            return self.profile(mode, callback, args, kwargs)
+        return _
+
+    def check_token(self):
+        given = bottle.request.headers.get('X-Profile-Token', '')
+        if not self.token or not hmac.compare_digest(str(given),
+                                                     str(self.token)):
+            bottle.abort(403, 'profiling requires a valid X-Profile-Token')
+
+    def profile(self, mode, callback, args, kwargs):
+        profiler = cProfile.Profile()
+        sampler = Sampler(interval=self.interval).start()
+        start = time.time()
+        try:
+            rv = profiler.runcall(callback, *args, **kwargs)
+            if isinstance(rv, types.GeneratorType):
+                # A streamed body is produced after the route returns,
+                # so it has to be produced here to be profiled.
+                rv = profiler.runcall(list, rv)
+        finally:
+            elapsed = time.time() - start
+            sampler.stop()
+        summary = self.summary(profiler, elapsed)
+        if mode == 'save':
+            path = self.save(profiler, summary, sampler.collapsed())
+            bottle.response.set_header('X-Profile', path)
+            return rv
+        bottle.response.content_type = 'text/plain; charset=utf-8'
+        if mode == 'collapsed':
+            return sampler.collapsed()
+        return summary
+
+    def summary(self, profiler, elapsed):
+        out = StringIO.StringIO()
+        out.write('%s %s: %0.3f seconds\n\n' % (
+            bottle.request.method, bottle.request.fullpath, elapsed))
+        stats = pstats.Stats(profiler, stream=out)
+        stats.sort_stats('cumulative').print_stats(self.top)
+        return out.getvalue()
+
+    def save(self, profiler, summary, collapsed):
+        directory = self.directory or '.'
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        path = os.path.join(directory, 'profile-%s-%d-%s' % (
+            time.strftime('%Y%m%d-%H%M%S'), os.getpid(),
+            threading.current_thread().ident))
+        profiler.dump_stats(path + '.prof')
+        with open(path + '.txt', 'w') as f:
+            f.write(summary)
+        with open(path + '.collapsed', 'w') as f:
+            f.write(collapsed)
+        logger.info('saved profile of %s to %s',
+                    bottle.request.fullpath, path)
+        return path
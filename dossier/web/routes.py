@@ -20,8 +20,11 @@ The API end points are documented as functions in this module.
 .. autofunction:: v1_search_engines
 .. autofunction:: v1_fc_get
 .. autofunction:: v1_fc_put
+.. autofunction:: v1_fc_get_many
+.. autofunction:: v1_fc_put_many
 .. autofunction:: v1_random_fc_get
 .. autofunction:: v1_label_put
+.. autofunction:: v1_labels_put
 .. autofunction:: v1_label_direct
 .. autofunction:: v1_label_connected
 .. autofunction:: v1_label_expanded
@@ -67,25 +70,43 @@ disallowed).
 .. autofunction:: v1_subtopic_list
 .. autofunction:: v1_folder_delete
 .. autofunction:: v1_folder_rename
+
+
+Service status
+==============
+
+These end points are for operators and monitoring systems rather
+than for the user interface.
+
+.. autofunction:: v1_status
+.. autofunction:: v1_ready
+.. autofunction:: v1_metrics
 '''
 from __future__ import absolute_import, division, print_function
 from functools import partial
 from itertools import groupby, imap, ifilter, islice
 import json
 import logging
+import mimetypes
 from operator import attrgetter
 import os
 import os.path as path
+import time
 import urllib
 import urlparse
 
 import bottle
+import cbor
 
 from dossier.fc import FeatureCollection
 from dossier.label import Label, CorefValue
 from dossier.label.run import label_to_dict
+from dossier.web import bulk
+from dossier.web.compression import negotiate_encoding
 from dossier.web.folder import Folders
+from dossier.web import metrics, timing
 from dossier.web.search_engines import streaming_sample
+from dossier.web.versions import Versions, check_etag
 from dossier.web import util
 import yakonfig
 
@@ -94,14 +115,40 @@ app = bottle.Bottle()
 logger = logging.getLogger(__name__)
 web_static_path = path.join(path.split(__file__)[0], 'static')
 
+#: The maximum number of content ids accepted by `v1_fc_get_many`.
+FC_GET_MANY_MAX = 100000
+#: The default number of FCs `v1_fc_get_many` fetches per store request.
+FC_GET_MANY_CHUNK_SIZE = 100
+#: The maximum `chunk_size` accepted by `v1_fc_get_many`.
+FC_GET_MANY_MAX_CHUNK_SIZE = 1000
+#: The maximum number of errors listed in responses of bulk routes.
+MAX_REPORTED_ERRORS = 1000
+
 
 @app.get('/dossier/v1/static/<name:path>')
-def v1_static(name):
-    return bottle.static_file(name, root=path.join(web_static_path, 'v1'))
+def v1_static(request, name):
+    root = path.join(web_static_path, 'v1')
+    # Serve a precompressed variant (e.g., `Dossier.js.gz`) if there is
+    # one and the client accepts it.
+    if not path.isfile(path.join(root, name + '.gz')):
+        return bottle.static_file(name, root=root)
+    accept = request.headers.get('Accept-Encoding', '')
+    if negotiate_encoding(accept) == 'gzip':
+        mimetype = mimetypes.guess_type(name)[0] \
+            or 'application/octet-stream'
+        resp = bottle.static_file(name + '.gz', root=root, mimetype=mimetype)
+        resp.set_header('Content-Encoding', 'gzip')
+    else:
+        resp = bottle.static_file(name, root=root)
+    # Both variants say so, or caches could serve either one to anybody.
+    resp.add_header('Vary', 'Accept-Encoding')
+    return resp
 
 
-@app.get('/dossier/v1/feature-collection/<cid>/search/<engine_name>')
-@app.post('/dossier/v1/feature-collection/<cid>/search/<engine_name>')
+@app.get('/dossier/v1/feature-collection/<cid>/search/<engine_name>',
+         admission='search')
+@app.post('/dossier/v1/feature-collection/<cid>/search/<engine_name>',
+          admission='search')
 def v1_search(request, response, visid_to_dbid, config,
               search_engines, filters, cid, engine_name):
     '''Search feature collections.
@@ -122,14 +169,21 @@ def v1_search(request, response, visid_to_dbid, config,
     the objects each have ``content_id`` and ``fc`` attributes.
     ``content_id`` is the unique identifier for the result returned,
     and ``fc`` is a JSON serialization of a feature collection.
+    If the client prefers ``application/cbor`` in its ``Accept``
+    header, then the same payload is returned as CBOR.
 
-    There are also two query parameters:
+    There are also a few query parameters:
 
     * **limit** limits the number of results to the number given.
     * **filter** sets the filtering function. The default
       filter function, ``already_labeled``, will filter out any
       feature collections that have already been labeled with the
       query ``content_id``.
+    * **explain**, if ``1``, adds an ``explain`` key to the payload
+      with a trace of the search: each index scan with its hits and
+      time, the number of feature collections fetched, the number
+      rejected by each filter and the time spent in each step. See
+      :class:`dossier.web.interface.Explanation`.
     '''
     db_cid = visid_to_dbid(cid)
     try:
@@ -137,11 +191,16 @@ def v1_search(request, response, visid_to_dbid, config,
     except KeyError as e:
         bottle.abort(404, 'Search engine "%s" does not exist.' % e.message)
     query = request.query if request.method == 'GET' else request.forms
-    search_engine = (config.create(search_engine)
-                           .set_query_id(db_cid)
-                           .set_query_params(query))
+    timing.annotate(engine=engine_name, query_content_id=db_cid)
+    search_engine = config.create(search_engine)
+    if config.pooled:
+        # Pooled clients must not be used by executor threads, so
+        # search engines don't prefetch unless asked to.
+        search_engine.config_params.setdefault('prefetch', 0)
+    search_engine.set_query_id(db_cid).set_query_params(query)
     for name, filter in filters.items():
-        search_engine.add_filter(name, config.create(filter))
+        # Filters are only constructed if the search engine uses them.
+        search_engine.add_lazy_filter(name, partial(config.create, filter))
     return search_engine.respond(response)
 
 
@@ -160,24 +219,101 @@ def v1_search_engines(search_engines):
     return sorted(search_engines.keys())
 
 
+@app.get('/dossier/v1/status', json=True, admission=False)
+def v1_status(config, admission):
+    '''Report the health of backend services.
+
+    The route for this endpoint is: ``/dossier/v1/status``.
+
+    This returns a JSON object with these keys:
+
+    * **ok** is ``true`` when no circuit breaker is open.
+    * **breakers** maps each service name to the state of its circuit
+      breaker (see :mod:`dossier.web.breaker`). A service only appears
+      once it has been used.
+    * **pools** maps each service name to statistics about its client
+      pool, when services are pooled (see :mod:`dossier.web.pool`).
+    * **admission** maps each group of routes to its counters, when
+      admission control is enabled (see :mod:`dossier.web.admission`).
+
+    This endpoint does not use any backend services itself, so it
+    always responds quickly.
+    '''
+    breakers = getattr(config, 'breaker_status', dict)()
+    return {
+        'ok': all(b['state'] == 'closed' for b in breakers.values()),
+        'breakers': breakers,
+        'pools': getattr(config, 'pool_stats', dict)(),
+        'admission': admission.stats(),
+    }
+
+
+@app.get('/dossier/v1/ready', json=True, admission=False)
+def v1_ready(response, warmup):
+    '''Report whether this process is ready to serve requests.
+
+    The route for this endpoint is: ``/dossier/v1/ready``.
+
+    This responds with ``200`` once warm-up has finished (see
+    :mod:`dossier.web.warmup`), and ``503`` before then. If warm-up
+    is not enabled, then the process is always ready. The body is a
+    JSON object with ``ready``, the ``seconds`` spent warming up and
+    a list of ``errors`` for services that could not be warmed up.
+    (A process is still ready when some services failed, since the
+    circuit breakers in :mod:`dossier.web.breaker` take over.)
+    '''
+    status = warmup.status()
+    if not status['ready']:
+        response.status = 503
+    return status
+
+
+@app.get('/dossier/v1/metrics', admission=False)
+def v1_metrics(response, config, admission):
+    '''Report metrics in the Prometheus text format.
+
+    The route for this endpoint is: ``/dossier/v1/metrics``.
+
+    This includes request counts, error counts and latency histograms
+    for each route, latency histograms for each backend service
+    method, cache hits and misses, and the state of circuit breakers,
+    pools and admission control. See :mod:`dossier.web.metrics` for
+    the full list, and which metrics must be enabled first.
+
+    These are the metrics of the process serving the request only, so
+    they are only valid when there is one worker process.
+    '''
+    response.content_type = metrics.CONTENT_TYPE
+    return (metrics.REGISTRY.render()
+            + metrics.status_registry(config, admission).render())
+
+
 @app.get('/dossier/v1/feature-collection/<cid>', json=True)
-def v1_fc_get(visid_to_dbid, store, cid):
+def v1_fc_get(request, response, visid_to_dbid, store, versions, cid):
     '''Retrieve a single feature collection.
 
     The route for this endpoint is:
     ``/dossier/v1/feature-collections/<content_id>``.
 
     This endpoint returns a JSON serialization of the feature collection
-    identified by ``content_id``.
+    identified by ``content_id``. (Or CBOR, if the client prefers
+    ``application/cbor`` in its ``Accept`` header.)
+
+    The response has an ``ETag`` header, which changes whenever the
+    feature collection is written with :func:`v1_fc_put`. If the
+    request has a matching ``If-None-Match`` header, then ``304`` is
+    returned without a body.
     '''
-    fc = store.get(visid_to_dbid(cid))
+    db_cid = visid_to_dbid(cid)
+    check_etag(request, response, versions.etag(Versions.FC, db_cid))
+    fc = store.get(db_cid)
     if fc is None:
         bottle.abort(404, 'Feature collection "%s" does not exist.' % cid)
     return util.fc_to_json(fc)
 
 
 @app.put('/dossier/v1/feature-collection/<cid>')
-def v1_fc_put(request, response, visid_to_dbid, store, cid):
+def v1_fc_put(request, response, visid_to_dbid, store, versions, cid):
     '''Store a single feature collection.
 
     The route for this endpoint is:
@@ -185,17 +321,194 @@ def v1_fc_put(request, response, visid_to_dbid, store, cid):
 
     ``content_id`` is the id to associate with the given feature
     collection. The feature collection should be in the request
-    body serialized as JSON.
+    body serialized as JSON, or as CBOR if the ``Content-Type`` of
+    the request is ``application/cbor``.
 
     This endpoint returns status ``201`` upon successful storage.
     An existing feature collection with id ``content_id`` is
     overwritten.
     '''
-    fc = FeatureCollection.from_dict(json.load(request.body))
-    store.put([(visid_to_dbid(cid), fc)])
+    if request.content_type.startswith(util.CBOR_MIME):
+        fc = FeatureCollection.from_dict(cbor.load(request.body))
+    else:
+        fc = FeatureCollection.from_dict(json.load(request.body))
+    db_cid = visid_to_dbid(cid)
+    store.put([(db_cid, fc)])
+    versions.bump(Versions.FC, db_cid)
     response.status = 201
 
 
+@app.post('/dossier/v1/feature-collections/get')
+def v1_fc_get_many(request, response, visid_to_dbid, store):
+    '''Retrieve many feature collections at once.
+
+    The route for this endpoint is:
+    ``POST /dossier/v1/feature-collections/get``.
+
+    The request body should be a JSON (or CBOR, if the ``Content-Type``
+    is ``application/cbor``) object with a ``content_ids`` key, which
+    is a list of content ids to retrieve. Optionally, a
+    ``feature_names`` key may be given with a list of features to
+    retrieve. (By default, all features are retrieved.) A plain list
+    of content ids is also accepted.
+
+    The response is a stream of records, one per content id given,
+    in the same order. Each record is an object with ``content_id``
+    and ``fc`` keys. If a feature collection could not be retrieved,
+    then ``fc`` is ``null`` and an ``error`` key describes why. The
+    stream is newline delimited JSON, or a CBOR sequence if the client
+    prefers ``application/cbor``.
+
+    Feature collections are fetched from the store in chunks, whose
+    size may be set with the ``chunk_size`` query parameter. (Default
+    ``100``, at most ``1000``.)
+    '''
+    try:
+        query = util.read_body(request)
+    except ValueError:
+        bottle.abort(400, 'Could not decode request body.')
+    if isinstance(query, dict):
+        cids = query.get('content_ids')
+        feature_names = query.get('feature_names')
+    else:
+        cids, feature_names = query, None
+    if not isinstance(cids, list) \
+            or not all(isinstance(cid, basestring) for cid in cids):
+        bottle.abort(400, '"content_ids" must be a list of strings.')
+    if len(cids) > FC_GET_MANY_MAX:
+        bottle.abort(400, 'At most %d content ids can be retrieved at once.'
+                          % FC_GET_MANY_MAX)
+    chunk_size = str_to_max_int(
+        request.query.get('chunk_size', FC_GET_MANY_CHUNK_SIZE),
+        FC_GET_MANY_MAX_CHUNK_SIZE)
+
+    def records():
+        for chunk in util.chunks(imap(utf8, cids), max(1, chunk_size)):
+            db_cids = map(visid_to_dbid, chunk)
+            fcs = dict(store.get_many(db_cids, feature_names=feature_names))
+            for cid, db_cid in zip(chunk, db_cids):
+                rec = {'content_id': cid, 'fc': None}
+                if db_cid not in fcs:
+                    rec['error'] = 'not retrieved'
+                elif fcs[db_cid] is None:
+                    rec['error'] = 'not found'
+                else:
+                    rec['fc'] = util.fc_to_json(fcs[db_cid])
+                yield rec
+    return util.stream_records(request, response, records())
+
+
+@app.post('/dossier/v1/feature-collections/put', json=True)
+def v1_fc_put_many(request, response, visid_to_dbid, config, store,
+                   versions):
+    '''Store many feature collections at once.
+
+    The route for this endpoint is:
+    ``POST /dossier/v1/feature-collections/put``.
+
+    The request body is a stream of records, where each record is an
+    object with ``content_id`` and ``fc`` keys (the same format
+    returned by :func:`v1_fc_get_many`). A two element array of
+    ``[content_id, fc]`` is also accepted. The stream should be
+    newline delimited JSON, or a CBOR sequence if the ``Content-Type``
+    of the request is ``application/cbor-seq``.
+
+    The body is parsed incrementally and feature collections are
+    written to the store in batches as they are read. The following
+    query parameters control the writing:
+
+    * **batch_size** is the number of feature collections written
+      with each call to the store. (Default ``500``.)
+    * **max_in_flight** is the maximum number of batches written
+      at the same time. Once this many batches are being written,
+      reading the request body pauses until one of them finishes.
+      (Default ``1``.) Each batch written at the same time needs a
+      store client of its own, so this only has an effect when
+      services are pooled (see :mod:`dossier.web.pool`). Otherwise,
+      one batch is written at a time.
+
+    Existing feature collections are overwritten.
+
+    The response is a JSON object with the number of ``records`` read,
+    the number ``written``, the elapsed ``seconds`` and
+    ``records_per_second``. It also has a list of ``errors``, where
+    each error has the ``index`` of the record in the stream, its
+    ``content_id`` (if known) and an ``error`` message. Only the first
+    1000 errors are listed; ``error_count`` has the total.
+    '''
+    start = time.time()
+    batch_size = str_to_max_int(request.query.get('batch_size', 500), 10000)
+    max_in_flight = str_to_max_int(request.query.get('max_in_flight', 1), 8)
+    if config.pooled and max_in_flight > 1:
+        def write(fcs):
+            # Each writer thread checks out a store of its own.
+            try:
+                writer_store = config.store
+                if writer_store is None:
+                    raise IOError('store is unavailable')
+                if config.wrap_service is not None:
+                    writer_store = config.wrap_service('store', writer_store)
+                writer_store.put(fcs)
+            finally:
+                config.release()
+        writer = bulk.BatchWriter(write, batch_size=batch_size,
+                                  max_in_flight=max_in_flight)
+    else:
+        # `store` is this request's client, so only one batch may use
+        # it at a time.
+        writer = bulk.BatchWriter(store.put, batch_size=batch_size)
+    errors, nrecords, nwritten = [], 0, 0
+
+    def add_error(index, cid, msg):
+        if len(errors) < MAX_REPORTED_ERRORS:
+            errors.append({'index': index, 'content_id': cid, 'error': msg})
+
+    def bump_written():
+        written = writer.finished()
+        if len(written) > 0:
+            versions.bump(Versions.FC,
+                          *[db_cid for _, _, db_cid in written])
+        return len(written)
+
+    error_count = 0
+    for index, (rec, err) in enumerate(bulk.iter_records(request)):
+        nrecords += 1
+        cid = None
+        try:
+            if err is not None:
+                raise ValueError(err)
+            if isinstance(rec, dict):
+                cid, fc = rec.get('content_id'), rec.get('fc')
+            elif isinstance(rec, (list, tuple)) and len(rec) == 2:
+                cid, fc = rec
+            else:
+                raise ValueError('record must be an object or a pair')
+            if not isinstance(cid, basestring) or not isinstance(fc, dict):
+                raise ValueError('record needs a "content_id" and an "fc"')
+            db_cid = visid_to_dbid(utf8(cid))
+            writer.add((index, cid, db_cid),
+                       (db_cid, FeatureCollection.from_dict(fc)))
+        except Exception as e:
+            error_count += 1
+            add_error(index, cid, str(e))
+        nwritten += bump_written()
+    for (index, cid, _), msg in writer.close():
+        error_count += 1
+        add_error(index, cid, msg)
+    nwritten += bump_written()
+    errors.sort(key=lambda e: e['index'])
+
+    elapsed = time.time() - start
+    return {
+        'records': nrecords,
+        'written': nwritten,
+        'error_count': error_count,
+        'errors': errors,
+        'seconds': elapsed,
+        'records_per_second': nrecords / elapsed if elapsed > 0 else None,
+    }
+
+
 @app.get('/dossier/v1/random/feature-collection', json=True)
 def v1_random_fc_get(response, dbid_to_visid, store):
     '''Retrieves a random feature collection from the database.
@@ -222,7 +535,7 @@ def v1_random_fc_get(response, dbid_to_visid, store):
 
 @app.put('/dossier/v1/label/<cid1>/<cid2>/<annotator_id>')
 def v1_label_put(request, response, visid_to_dbid, config, label_hooks,
-                 label_store, cid1, cid2, annotator_id):
+                 label_store, versions, cid1, cid2, annotator_id):
     '''Store a single label.
 
     The route for this endpoint is:
@@ -250,13 +563,87 @@ def v1_label_put(request, response, visid_to_dbid, config, label_hooks,
                 subtopic_id1=request.query.get('subtopic_id1'),
                 subtopic_id2=request.query.get('subtopic_id2'))
     label_store.put(lab)
+    versions.bump_labels(lab)
     response.status = 201
 
 
+@app.post('/dossier/v1/labels/put', json=True)
+def v1_labels_put(request, response, visid_to_dbid, label_store, versions):
+    '''Store many labels at once.
+
+    The route for this endpoint is:
+    ``POST /dossier/v1/labels/put``.
+
+    The request body is either a JSON array of labels (when the
+    ``Content-Type`` is ``application/json``) or a stream of labels
+    as newline delimited JSON or a CBOR sequence (as accepted by
+    :func:`v1_fc_put_many`). Each label is an object with these keys:
+
+    * ``content_id1``, ``content_id2`` and ``annotator_id`` (required)
+    * ``value``, which is ``-1``, ``0`` or ``1`` (required)
+    * ``subtopic_id1`` and ``subtopic_id2`` (optional)
+    * ``epoch_ticks`` (optional, defaults to now)
+
+    Every label is validated before any are written. Valid labels are
+    then written in batches of ``batch_size`` (a query parameter that
+    defaults to ``1000``) with one label store write per batch. Any
+    existing labels with the same ids are overwritten.
+
+    The response has the same format as the one from
+    :func:`v1_fc_put_many`, where the ``content_id`` of an error is
+    the ``content_id1`` of the label.
+    '''
+    start = time.time()
+    batch_size = str_to_max_int(request.query.get('batch_size', 1000),
+                                10000)
+    errors, error_count = [], 0
+    labels = []
+    for index, (rec, err) in enumerate(iter_label_records(request)):
+        try:
+            if err is not None:
+                raise ValueError(err)
+            labels.append((index, rec.get('content_id1'),
+                           label_from_dict(rec, visid_to_dbid)))
+        except Exception as e:
+            error_count += 1
+            if len(errors) < MAX_REPORTED_ERRORS:
+                cid = rec.get('content_id1') if isinstance(rec, dict) \
+                    else None
+                errors.append({'index': index, 'content_id': cid,
+                               'error': str(e)})
+    nrecords = len(labels) + error_count
+
+    # `label_store` is this request's client, so only one batch may use
+    # it at a time.
+    writer = bulk.BatchWriter(lambda labs: label_store.put(*labs),
+                              batch_size=batch_size, max_in_flight=1)
+    for index, cid, lab in labels:
+        writer.add((index, cid, lab), lab)
+    for (index, cid, _), msg in writer.close():
+        error_count += 1
+        if len(errors) < MAX_REPORTED_ERRORS:
+            errors.append({'index': index, 'content_id': cid,
+                           'error': msg})
+    written = writer.finished()
+    if len(written) > 0:
+        versions.bump_labels(*[lab for _, _, lab in written])
+    errors.sort(key=lambda e: e['index'])
+
+    elapsed = time.time() - start
+    return {
+        'records': nrecords,
+        'written': len(written),
+        'error_count': error_count,
+        'errors': errors,
+        'seconds': elapsed,
+        'records_per_second': nrecords / elapsed if elapsed > 0 else None,
+    }
+
+
 @app.get('/dossier/v1/label/<cid>/direct', json=True)
 @app.get('/dossier/v1/label/<cid>/subtopic/<subid>/direct', json=True)
 def v1_label_direct(request, response, visid_to_dbid, dbid_to_visid,
-                    label_store, cid, subid=None):
+                    label_store, versions, cid, subid=None):
     '''Return directly connected labels.
 
     The routes for this endpoint are
@@ -271,9 +658,14 @@ def v1_label_direct(request, response, visid_to_dbid, dbid_to_visid,
     dictionary with the following keys: ``content_id1``,
     ``content_id2``, ``subtopic_id1``, ``subtopic_id2``,
     ``annotator_id``, ``epoch_ticks`` and ``value``.
+
+    The response has an ``ETag`` header, which changes whenever a
+    label involving ``cid`` is written with :func:`v1_label_put`.
     '''
+    db_cid = visid_to_dbid(cid)
+    check_etag(request, response, versions.etag(Versions.LABEL, db_cid))
     lab_to_json = partial(label_to_json, dbid_to_visid)
-    ident = make_ident(visid_to_dbid(cid), subid)
+    ident = make_ident(db_cid, subid)
     labs = imap(lab_to_json, label_store.directly_connected(ident))
     return list(paginate(request, response, labs))
 
@@ -281,7 +673,7 @@ def v1_label_direct(request, response, visid_to_dbid, dbid_to_visid,
 @app.get('/dossier/v1/label/<cid>/connected', json=True)
 @app.get('/dossier/v1/label/<cid>/subtopic/<subid>/connected', json=True)
 def v1_label_connected(request, response, visid_to_dbid, dbid_to_visid,
-                       label_store, cid, subid=None):
+                       label_store, versions, cid, subid=None):
     '''Return a connected component of positive labels.
 
     The routes for this endpoint are
@@ -296,7 +688,12 @@ def v1_label_connected(request, response, visid_to_dbid, dbid_to_visid,
     dictionary with the following keys: ``content_id1``,
     ``content_id2``, ``subtopic_id1``, ``subtopic_id2``,
     ``annotator_id``, ``epoch_ticks`` and ``value``.
+
+    The response has an ``ETag`` header, which changes whenever any
+    label is written with :func:`v1_label_put`. (A new label can
+    change the connected component of any content id.)
     '''
+    check_etag(request, response, versions.etag(Versions.LABEL_GRAPH))
     lab_to_json = partial(label_to_json, dbid_to_visid)
     ident = make_ident(visid_to_dbid(cid), subid)
     labs = imap(lab_to_json, label_store.connected_component(ident))
@@ -358,7 +755,7 @@ def v1_label_negative_inference(request, response,
     return list(paginate(request, response, labs))
 
 
-@app.get('/dossier/v1/folder', json=True)
+@app.get('/dossier/v1/folder', json=True, admission='folders')
 def v1_folder_list(request, kvlclient):
     '''Retrieves a list of folders for the current user.
 
@@ -390,7 +787,8 @@ def v1_folder_add(request, response, kvlclient, fid):
     response.status = 201
 
 
-@app.get('/dossier/v1/folder/<fid>/subfolder', json=True)
+@app.get('/dossier/v1/folder/<fid>/subfolder', json=True,
+         admission='folders')
 def v1_subfolder_list(request, response, kvlclient, fid):
     '''Retrieves a list of subfolders in a folder for the current user.
 
@@ -448,7 +846,8 @@ def v1_subfolder_add(request, response, kvlclient,
     response.status = 201
 
 
-@app.get('/dossier/v1/folder/<fid>/subfolder/<sfid>', json=True)
+@app.get('/dossier/v1/folder/<fid>/subfolder/<sfid>', json=True,
+         admission='folders')
 def v1_subtopic_list(request, response, kvlclient, fid, sfid):
     '''Retrieves a list of items in a subfolder.
 
@@ -567,6 +966,53 @@ def get_annotator_id(request):
     return request.query.get('annotator_id', 'unknown')
 
 
+def iter_label_records(request):
+    '''Yields ``(record, error)`` pairs of labels in a request body.
+
+    A JSON array is decoded all at once. Anything else is decoded
+    incrementally with :func:`dossier.web.bulk.iter_records`.
+    '''
+    if not request.content_type.startswith('application/json'):
+        for rec, err in bulk.iter_records(request):
+            yield rec, err
+        return
+    try:
+        recs = json.load(request.body)
+    except ValueError as e:
+        bottle.abort(400, 'invalid JSON: %s' % e)
+    if not isinstance(recs, list):
+        bottle.abort(400, 'expected a JSON array of labels')
+    for rec in recs:
+        yield rec, None
+
+
+def label_from_dict(d, visid_to_dbid):
+    '''Creates a :class:`dossier.label.Label` from a dictionary.
+
+    Raises ``ValueError`` if ``d`` is not a valid label.
+    '''
+    if not isinstance(d, dict):
+        raise ValueError('label must be an object')
+    for k in ('content_id1', 'content_id2', 'annotator_id'):
+        if not isinstance(d.get(k), basestring) or len(d[k]) == 0:
+            raise ValueError('label needs a non-empty "%s"' % k)
+    for k in ('subtopic_id1', 'subtopic_id2'):
+        if not isinstance(d.get(k) or '', basestring):
+            raise ValueError('"%s" must be a string' % k)
+    value = d.get('value')
+    if value not in (-1, 0, 1) or isinstance(value, bool):
+        raise ValueError('"value" must be one of -1, 0 or 1')
+    epoch_ticks = d.get('epoch_ticks')
+    if epoch_ticks is not None and not isinstance(epoch_ticks, (int, long)):
+        raise ValueError('"epoch_ticks" must be an integer')
+    return Label(visid_to_dbid(utf8(d['content_id1'])),
+                 visid_to_dbid(utf8(d['content_id2'])),
+                 utf8(d['annotator_id']), CorefValue(value),
+                 subtopic_id1=utf8(d.get('subtopic_id1')),
+                 subtopic_id2=utf8(d.get('subtopic_id2')),
+                 epoch_ticks=epoch_ticks)
+
+
 def str_to_max_int(s, maximum):
     try:
         return min(maximum, int(s))
@@ -633,6 +1079,12 @@ def dedup(it):
             break
 
 
+def utf8(s):
+    if isinstance(s, unicode):
+        return s.encode('utf-8')
+    return s
+
+
 def new_folders(kvlclient, request):
     try:
         config = yakonfig.get_global_config('dossier.folders')
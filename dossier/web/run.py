@@ -6,12 +6,20 @@
 This is the "main" function of ``dossier.web``. Generally, you won't use
 it directly, but instead import ``get_application`` from ``dossier.web``
 and run your web application from your script.
+
+By default, the application is served with Bottle's server adapter
+given by ``--server``. With ``--workers`` or ``--threads``, it is
+served by the pre-forking, multi-threaded server in
+:mod:`dossier.web.server` instead.
 '''
 
 from __future__ import absolute_import, division, print_function
 
 import argparse
+import logging
+import sys
 
+import bottle
 import dblogger
 import kvlayer
 import yakonfig
@@ -19,22 +27,58 @@ import yakonfig.factory
 
 from dossier.web.builder import WebBuilder, add_cli_arguments
 from dossier.web.config import Config
+from dossier.web.server import serve
+
+
+logger = logging.getLogger(__name__)
 
 
 def default_app():
+    args, config = parse_args()
+    return args, build_app(args, config)
+
+
+def parse_args():
     config = Config()
     p = argparse.ArgumentParser(description='Run DossierStack web services.')
     add_cli_arguments(p)
     args = yakonfig.parse_args(p, [config, dblogger, kvlayer, yakonfig])
-    app = WebBuilder().set_config(config).enable_cors().get_app()
-    return args, app
+    return args, config
+
+
+def build_app(args, config):
+    builder = WebBuilder().set_config(config).enable_cors()
+    if args.warmup:
+        builder.enable_warmup()
+    return builder.get_app()
+
 
+def main(argv=None):
+    '''Run ``dossier.web``.
 
-def main():
-    args, app = default_app()
-    app.run(server='wsgiref', host=args.host, port=args.port,
-            debug=args.bottle_debug, reloader=args.reload)
+    :param list argv: The arguments of the Python command that reloads
+                      the server (see :mod:`dossier.web.server`).
+                      Defaults to ``sys.argv``.
+    '''
+    args, config = parse_args()
+    if args.workers is not None or args.threads is not None:
+        if (args.workers or 1) > 1 and config.config.get('metrics'):
+            logger.warn('metrics are kept per worker process, so '
+                        '/dossier/v1/metrics is only valid with '
+                        '--workers 1')
+        # Each worker process builds its own app after it is forked.
+        bottle.debug(args.bottle_debug)
+        serve(lambda: build_app(args, config), host=args.host,
+              port=args.port,
+              workers=1 if args.workers is None else args.workers,
+              threads=8 if args.threads is None else args.threads,
+              max_requests=args.max_requests, argv=argv)
+    else:
+        app = build_app(args, config)
+        app.run(server=args.server, host=args.host, port=args.port,
+                debug=args.bottle_debug, reloader=args.reload)
 
 
 if __name__ == '__main__':
-    main()
+    # Reload with `python -m`, so this file isn't run as a script.
+    main(argv=['-m', 'dossier.web.run'] + sys.argv[1:])
@@ -5,12 +5,15 @@
 '''
 from __future__ import absolute_import, division, print_function
 
-from itertools import ifilter, islice
+from itertools import chain, ifilter, islice
 import logging
 import random as rand
+import time
 
 from dossier.fc import SparseVector, StringCounter
+from dossier.web.executor import prefetch
 from dossier.web.interface import SearchEngine
+from dossier.web.util import chunks
 
 
 logger = logging.getLogger(__name__)
@@ -36,11 +39,21 @@ class random(SearchEngine):
         fc = self.store.get(self.query_content_id)
         if fc is None:
             raise KeyError(self.query_content_id)
+        ex = self.explanation
         cids = []
         for name in fc.get(u'NAME', {}):
-            cids.extend(self.store.index_scan_ids(u'NAME', name))
+            start = time.time()
+            ids = list(self.store.index_scan_ids(u'NAME', name))
+            if ex is not None:
+                entry = ex.scan(u'NAME', name)
+                entry.update(hits=len(ids), new=len(ids),
+                             seconds=time.time() - start)
+            cids.extend(ids)
         predicate = self.create_filter_predicate()
-        results = list(ifilter(predicate, self.store.get_many(cids)))
+        fcs = self.store.get_many(cids)
+        if ex is not None:
+            fcs = ex.counted('fetched', fcs)
+        results = list(ifilter(predicate, fcs))
         rand.shuffle(results)
         return {'results': results[0:self.params['limit']]}
 
@@ -50,7 +63,27 @@ class plain_index_scan(SearchEngine):
 
     This scans all indexes defined for all values in the query
     corresponding to those indexes.
+
+    Feature collections are fetched ``fetch_size`` at a time. While
+    one batch is being filtered, up to ``prefetch`` more batches are
+    fetched in the background (see :mod:`dossier.web.executor`), so
+    index scans, fetches and filters overlap. This requires a store
+    that can be used by more than one thread at once, which
+    :class:`dossier.store.ElasticStore` can. Set ``prefetch`` to ``0``
+    to do everything in the current thread. (That is the default in
+    pooled mode, where a client is only lent to one thread; see
+    :mod:`dossier.web.pool`.)
+
+    If the store fails to return a batch (``ElasticStore.get_many``
+    returns nothing when its request fails), then the batch is
+    fetched one feature collection at a time, so that a failure is
+    raised instead of silently dropping candidates.
     '''
+    param_schema = dict(SearchEngine.param_schema, **{
+        'fetch_size': {'type': 'int', 'default': 100, 'min': 1, 'max': 10000},
+        'prefetch': {'type': 'int', 'default': 1, 'min': 0, 'max': 8},
+    })
+
     def __init__(self, store):
         super(plain_index_scan, self).__init__()
         self.store = store
@@ -58,12 +91,31 @@ class plain_index_scan(SearchEngine):
     def recommendations(self):
         predicate = self.create_filter_predicate()
         cids = self.streaming_ids(self.query_content_id)
-        results = ifilter(predicate,
-                          ((cid, self.store.get(cid)) for cid in cids))
+        batches = prefetch(self.fetch, chunks(cids, self.params['fetch_size']),
+                           depth=self.params['prefetch'])
+        results = ifilter(predicate, chain.from_iterable(batches))
+        if self.explanation is not None:
+            results = self.explanation.counted('sampled', results)
         sample = streaming_sample(
             results, self.params['limit'], self.params['limit'] * 10)
         return {'results': sample}
 
+    def fetch(self, cids):
+        if self.explanation is None:
+            return self.get_many(cids)
+        with self.explanation.timer('fetch'):
+            fcs = self.get_many(cids)
+        self.explanation.add('fetched', len(fcs))
+        return fcs
+
+    def get_many(self, cids):
+        fcs = list(self.store.get_many(cids))
+        if len(fcs) < len(cids):
+            logger.warn('fetching %d feature collections one at a time',
+                        len(cids))
+            fcs = [(cid, self.store.get(cid)) for cid in cids]
+        return fcs
+
     def get_query_fc(self, content_id):
         query_fc = self.store.get(content_id)
         if query_fc is None:
@@ -72,8 +124,25 @@ class plain_index_scan(SearchEngine):
 
     def streaming_ids(self, content_id):
         def scan(idx_name, val):
-            for cid in self.store.index_scan(idx_name, val):
+            if self.explanation is None:
+                for cid in self.store.index_scan(idx_name, val):
+                    if cid not in cids and cid not in blacklist:
+                        cids.add(cid)
+                        yield cid
+                return
+            entry = self.explanation.scan(idx_name, val)
+            it = iter(self.store.index_scan(idx_name, val))
+            while True:
+                start = time.time()
+                try:
+                    cid = next(it)
+                except StopIteration:
+                    return
+                finally:
+                    entry['seconds'] += time.time() - start
+                entry['hits'] += 1
                 if cid not in cids and cid not in blacklist:
+                    entry['new'] += 1
                     cids.add(cid)
                     yield cid
 
@@ -83,18 +152,13 @@ class plain_index_scan(SearchEngine):
 
         blacklist = set([content_id])
         cids = set()
-        logger.info('starting index scan (query content id: %s)', content_id)
         for idx_name in self.store.index_names():
             feat = query_fc.get(idx_name, None)
             if isinstance(feat, unicode):
-                logger.info('[Unicode index: %s] scanning for "%s"',
-                            idx_name, feat)
                 for cid in scan(idx_name, feat):
                     yield cid
             elif isinstance(feat, (SparseVector, StringCounter)):
                 for name in feat.iterkeys():
-                    logger.info('[StringCounter index: %s] scanning for "%s"',
-                                idx_name, name)
                     for cid in scan(idx_name, name):
                         yield cid
 
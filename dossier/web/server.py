@@ -0,0 +1,389 @@
+'''A pre-forking, multi-threaded WSGI server for dossier.web.
+
+.. This software is released under an MIT/X11 open source license.
+   Copyright 2012-2015 Diffeo, Inc.
+
+Bottle's default ``wsgiref`` server handles one request at a time, so
+one slow search blocks every other user. This module provides a
+production server built only on the standard library:
+
+* A supervisor process opens the listening socket and forks
+  ``workers`` worker processes, which all accept connections from it.
+  Workers that exit are replaced.
+* Each worker serves requests with a fixed pool of ``threads``
+  threads. A worker only accepts a connection when one of its threads
+  is idle, so connections that arrive while every thread is busy wait
+  in the socket's backlog for whichever worker is free first.
+* A worker that has served ``max_requests`` requests stops accepting
+  connections, finishes the requests it has and exits, and is then
+  replaced by a fresh worker (which releases any memory or
+  connections that have built up).
+* Sending ``SIGHUP`` to the supervisor gracefully reloads the server:
+  the workers finish their requests and exit, and then the supervisor
+  runs its command line again (with ``exec``, so it keeps its process
+  id), which picks up new code and configuration. The listening socket
+  is passed on, so connections that arrive in the meantime wait in its
+  backlog instead of being refused. If the new command fails to start,
+  the server is down, so check new configuration before reloading.
+  ``SIGTERM`` or ``SIGINT`` gracefully stops every worker and then the
+  supervisor.
+
+The application is created separately in each worker (after the fork),
+so that no worker shares backend connections or threads with another.
+
+It is used by the ``dossier.web`` command when ``--workers`` or
+``--threads`` is given::
+
+    dossier.web --host 0.0.0.0 --workers 4 --threads 16 \\
+                --max-requests 10000
+
+.. autofunction:: serve
+.. autofunction:: make_server
+'''
+from __future__ import absolute_import, division, print_function
+
+import errno
+import fcntl
+import logging
+import os
+import Queue
+import select
+import signal
+import socket
+import sys
+import threading
+import time
+from wsgiref.simple_server import WSGIRequestHandler, WSGIServer
+
+
+logger = logging.getLogger(__name__)
+
+#: The environment variable that passes the listening socket to the
+#: command run by a reload.
+LISTEN_FD_ENV = 'DOSSIER_WEB_LISTEN_FD'
+
+
+class QuietHandler(WSGIRequestHandler):
+    '''Logs requests through :mod:`logging` instead of to ``stderr``.'''
+    def log_message(self, format, *args):
+        logger.debug('%s - %s', self.address_string(), format % args)
+
+
+class ThreadPoolWSGIServer(WSGIServer):
+    '''A WSGI server that handles requests with a fixed thread pool.
+
+    Accepted connections are handed to ``threads`` handler threads,
+    and :meth:`serve_until` only accepts a connection when one of them
+    is idle. If ``max_requests`` is positive, then it stops accepting
+    connections after that many.
+    '''
+    def __init__(self, sock, app, threads=8, max_requests=0):
+        WSGIServer.__init__(self, sock.getsockname()[:2], QuietHandler,
+                            bind_and_activate=False)
+        self.socket.close()
+        self.socket = sock
+        self.server_address = sock.getsockname()
+        self.server_bind()
+        self.setup_environ()
+        self.set_app(app)
+        self.max_requests = max_requests
+        self.accepted = 0
+        self.connections = Queue.Queue()
+        # The number of connections accepted but not yet handled.
+        self.busy = 0
+        self.freed = threading.Condition()
+        # For `serve_forever` and `shutdown`.
+        self.shutdown_requested = threading.Event()
+        self.is_shut_down = threading.Event()
+        self.handlers = [threading.Thread(target=self.handle_connections,
+                                          name='dossier-web-%d' % i)
+                         for i in xrange(max(1, threads))]
+        for t in self.handlers:
+            t.daemon = True
+            t.start()
+
+    def server_bind(self):
+        # The socket is already bound, but `setup_environ` still needs
+        # these, which are normally set here.
+        host, port = self.server_address[:2]
+        self.server_name = socket.getfqdn(host)
+        self.server_port = port
+
+    def get_request(self):
+        # The listening socket is non-blocking, since every worker waits
+        # for it to be readable but only one of them gets the connection.
+        # (The others get `EAGAIN`, which the caller ignores.)
+        conn, addr = self.socket.accept()
+        conn.setblocking(True)
+        return conn, addr
+
+    def serve_until(self, stopped, poll_interval=0.5):
+        '''Accept connections until ``stopped()`` is true or retired.
+
+        Unlike ``serve_forever``, this can be run in the main thread,
+        since a signal interrupts the wait for a connection.
+        '''
+        while not stopped() and not self.retired:
+            if not self.wait_for_idle_thread(poll_interval):
+                continue
+            try:
+                ready, _, _ = select.select([self.socket], [], [],
+                                            poll_interval)
+            except select.error as e:
+                if e.args[0] == errno.EINTR:
+                    continue
+                raise
+            if ready:
+                self._handle_request_noblock()
+
+    def serve_forever(self, poll_interval=0.5):
+        '''Accept connections until :meth:`shutdown` is called.'''
+        self.is_shut_down.clear()
+        try:
+            self.serve_until(self.shutdown_requested.is_set, poll_interval)
+        finally:
+            self.shutdown_requested.clear()
+            self.is_shut_down.set()
+
+    def shutdown(self):
+        '''Stop :meth:`serve_forever` and wait until it has.'''
+        self.shutdown_requested.set()
+        self.is_shut_down.wait()
+
+    def wait_for_idle_thread(self, timeout):
+        '''Return true once a handler thread is idle, or after timeout.'''
+        with self.freed:
+            if self.busy >= len(self.handlers):
+                self.freed.wait(timeout)
+            return self.busy < len(self.handlers)
+
+    @property
+    def retired(self):
+        return self.max_requests > 0 and self.accepted >= self.max_requests
+
+    def process_request(self, request, client_address):
+        self.accepted += 1
+        with self.freed:
+            self.busy += 1
+        self.connections.put((request, client_address))
+
+    def handle_connections(self):
+        while True:
+            item = self.connections.get()
+            if item is None:
+                return
+            request, client_address = item
+            try:
+                self.finish_request(request, client_address)
+            except Exception:
+                self.handle_error(request, client_address)
+            finally:
+                self.shutdown_request(request)
+                with self.freed:
+                    self.busy -= 1
+                    self.freed.notify()
+
+    def handle_error(self, request, client_address):
+        logger.error('error handling request from %r', client_address,
+                     exc_info=True)
+
+    def drain(self):
+        '''Wait for queued and in-flight requests to finish.'''
+        for _ in self.handlers:
+            self.connections.put(None)
+        for t in self.handlers:
+            t.join()
+
+    def server_close(self):
+        # The listening socket belongs to the supervisor.
+        pass
+
+
+def make_server(host, port, app, threads=8, backlog=128):
+    '''Create a multi-threaded server in this process.
+
+    Call ``serve_forever`` on the server to start it, and ``shutdown``
+    and then ``drain`` (from another thread) to stop it.
+
+    :param str host: The host name or address to listen on.
+    :param int port: The port to listen on. If ``0``, a free port is
+                     chosen, which is in ``server.server_port``.
+    :param app: A WSGI application.
+    :param int threads: The number of request handling threads.
+    :rtype: :class:`ThreadPoolWSGIServer`
+    '''
+    return ThreadPoolWSGIServer(listen(host, port, backlog), app,
+                                threads=threads)
+
+
+def listen(host, port, backlog=128):
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.bind((host, port))
+    sock.listen(backlog)
+    sock.setblocking(False)
+    return sock
+
+
+def inherited_socket():
+    '''Return the listening socket passed on by a reload, if any.'''
+    fd = os.environ.pop(LISTEN_FD_ENV, None)
+    if fd is None:
+        return None
+    sock = socket.fromfd(int(fd), socket.AF_INET, socket.SOCK_STREAM)
+    # `fromfd` duplicates the descriptor.
+    os.close(int(fd))
+    sock.setblocking(False)
+    return sock
+
+
+def serve(app_factory, host='localhost', port=8080, workers=1, threads=8,
+          max_requests=0, backlog=128, argv=None):
+    '''Serve a WSGI application until stopped.
+
+    :param app_factory: A function that returns the WSGI application.
+                        It is called once in each worker process.
+    :param str host: The host name or address to listen on.
+    :param int port: The port to listen on.
+    :param int workers: The number of worker processes. If this is
+                        ``0``, then requests are served by this process
+                        without forking (and ``max_requests`` is
+                        ignored).
+    :param int threads: The number of threads in each worker.
+    :param int max_requests: If positive, workers are replaced after
+                             serving this many requests.
+    :param int backlog: The ``listen`` backlog of the socket.
+    :param list argv: The arguments of the Python command that is run
+                      on ``SIGHUP``. Defaults to ``sys.argv``, i.e.,
+                      the script that is running.
+    '''
+    sock = inherited_socket()
+    if sock is None:
+        sock = listen(host, port, backlog)
+    logger.info('listening on http://%s:%d/ with %d workers of %d threads',
+                host, sock.getsockname()[1], workers, threads)
+    if workers <= 0:
+        run_worker(sock, app_factory, threads, 0)
+    else:
+        Supervisor(sock, app_factory, workers, threads, max_requests,
+                   argv=sys.argv if argv is None else argv).run()
+
+
+def run_worker(sock, app_factory, threads, max_requests):
+    '''Serve requests from ``sock`` until signalled or retired.'''
+    stopping = []
+
+    def stop(signum, frame):
+        stopping.append(signum)
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+    signal.signal(signal.SIGHUP, signal.SIG_DFL)
+
+    server = ThreadPoolWSGIServer(sock, app_factory(), threads=threads,
+                                  max_requests=max_requests)
+    server.serve_until(lambda: len(stopping) > 0)
+    server.drain()
+    logger.info('worker %d exiting after %d requests',
+                os.getpid(), server.accepted)
+
+
+class Supervisor(object):
+    '''Keeps ``workers`` worker processes running.'''
+    def __init__(self, sock, app_factory, workers, threads, max_requests,
+                 argv=None):
+        self.sock = sock
+        self.app_factory = app_factory
+        self.num_workers = workers
+        self.threads = threads
+        self.max_requests = max_requests
+        self.argv = sys.argv if argv is None else argv
+        self.workers = set()
+        self.stopping = False
+        self.reloading = False
+
+    def run(self):
+        signal.signal(signal.SIGTERM, self.on_stop)
+        signal.signal(signal.SIGINT, self.on_stop)
+        signal.signal(signal.SIGHUP, self.on_reload)
+        self.spawn_missing()
+        while len(self.workers) > 0:
+            self.reap()
+            if not self.stopping:
+                self.spawn_missing()
+            time.sleep(0.2)
+        logger.info('all workers stopped')
+        if self.reloading:
+            self.reload()
+
+    def on_stop(self, signum, frame):
+        if not self.stopping:
+            logger.info('stopping workers')
+            self.stopping = True
+            self.signal_workers(signal.SIGTERM)
+
+    def on_reload(self, signum, frame):
+        # Stop like `on_stop`, and then `reload` once the workers are
+        # gone.
+        if not self.stopping:
+            logger.info('stopping workers to reload')
+            self.reloading = True
+            self.on_stop(signum, frame)
+
+    def reload(self):
+        '''Run this server's command again, in this process.'''
+        fd = self.sock.fileno()
+        flags = fcntl.fcntl(fd, fcntl.F_GETFD)
+        fcntl.fcntl(fd, fcntl.F_SETFD, flags & ~fcntl.FD_CLOEXEC)
+        env = dict(os.environ)
+        env[LISTEN_FD_ENV] = str(fd)
+        argv = [sys.executable] + list(self.argv)
+        logger.info('reloading: %s', ' '.join(argv))
+        os.execve(sys.executable, argv, env)
+
+    def spawn_missing(self):
+        for _ in xrange(self.num_workers - len(self.workers)):
+            self.spawn()
+
+    def spawn(self):
+        pid = os.fork()
+        if pid != 0:
+            self.workers.add(pid)
+            return
+        code = 0
+        try:
+            run_worker(self.sock, self.app_factory, self.threads,
+                       self.max_requests)
+        except Exception:
+            logger.critical('worker failed', exc_info=True)
+            code = 1
+        finally:
+            os._exit(code)
+
+    def reap(self):
+        while True:
+            try:
+                pid, status = os.waitpid(-1, os.WNOHANG)
+            except OSError as e:
+                if e.errno == errno.ECHILD:
+                    return
+                raise
+            if pid == 0:
+                return
+            if pid not in self.workers:
+                continue
+            self.workers.discard(pid)
+            if status != 0:
+                logger.warn('worker %d exited with status %d', pid, status)
+                # Don't respawn in a tight loop if workers can't start.
+                time.sleep(1)
+
+    def signal_workers(self, signum):
+        for pid in list(self.workers):
+            self.kill(pid, signum)
+
+    def kill(self, pid, signum):
+        try:
+            os.kill(pid, signum)
+        except OSError as e:
+            if e.errno != errno.ESRCH:
+                raise
@@ -0,0 +1,187 @@
+'''Logging slow requests.
+
+.. This software is released under an MIT/X11 open source license.
+   Copyright 2012-2015 Diffeo, Inc.
+
+Once enabled with :meth:`dossier.web.WebBuilder.enable_slow_log` (or
+``slow_request_seconds`` in the ``dossier.web`` configuration), every
+request that takes longer than a threshold is logged as one line of
+JSON by the ``dossier.web.slowlog`` logger. Normally, that goes
+wherever :mod:`dblogger` sends logs. If a file is given (with
+``slow_request_log``), then the records are also written to it. The
+file is not rotated by dossier.web, since every worker process of
+:mod:`dossier.web.server` appends to it: rotate it with
+``logrotate`` (or similar) instead, and it is reopened once it has
+been moved.
+
+A record has the ``route``, ``method``, ``path``, ``status``,
+``seconds`` and response ``bytes`` of the request, the time spent in
+each backend service (see :mod:`dossier.web.timing`) and, for
+searches, the ``engine``, the ``query_content_id``, the search
+engine's typed ``params`` and the ``filters`` used.
+
+To prevent a flood of records when everything is slow, at most
+``max_per_minute`` records are written each minute. The number of
+slow requests that were not logged is reported in the
+``suppressed`` field of the next record.
+
+The configuration looks like::
+
+    dossier.web:
+      slow_request_seconds: 2
+      slow_request_log: /var/log/dossier/slow.log
+      slow_request_max_per_minute: 60
+
+.. autoclass:: SlowLogPlugin
+'''
+from __future__ import absolute_import, division, print_function
+
+from collections import OrderedDict
+import json
+import logging
+import logging.handlers
+import threading
+import time
+import types
+
+import bottle
+
+from dossier.web import timing
+
+
+logger = logging.getLogger(__name__)
+
+
+class RateLimit(object):
+    '''Allows ``per_minute`` events per minute, with bursts.'''
+    def __init__(self, per_minute, clock=time.time):
+        self.rate = per_minute / 60
+        self.capacity = max(1, per_minute)
+        self.tokens = self.capacity
+        self.clock = clock
+        self.updated = clock()
+        self.suppressed = 0
+        self.lock = threading.Lock()
+
+    def take(self):
+        '''Returns the number of suppressed events, or ``None``.
+
+        ``None`` means this event should be suppressed too.
+        '''
+        with self.lock:
+            now = self.clock()
+            self.tokens = min(self.capacity,
+                              self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            if self.tokens < 1:
+                self.suppressed += 1
+                return None
+            self.tokens -= 1
+            suppressed, self.suppressed = self.suppressed, 0
+            return suppressed
+
+
+class SlowLogPlugin(object):
+    '''A Bottle plugin that logs requests slower than a threshold.
+
+    .. automethod:: __init__
+    '''
+    api = 2
+    name = 'slowlog'
+
+    def __init__(self, threshold=1.0, path=None, max_per_minute=60):
+        '''Create a new slow request logger.
+
+        :param float threshold: Requests that take at least this many
+                                seconds are logged.
+        :param str path: If given, records are also written to this
+                         file, which is reopened if it is moved.
+        :param int max_per_minute: The maximum number of records
+                                   written per minute.
+        '''
+        self.threshold = threshold
+        self.limit = RateLimit(max_per_minute)
+        self.handler = None
+        if path is not None:
+            # The file is opened by the first record written, so that
+            # each worker process has its own file descriptor.
+            self.handler = logging.handlers.WatchedFileHandler(
+                path, delay=True)
+            self.handler.setFormatter(logging.Formatter('%(message)s'))
+
+    def apply(self, callback, route):
+        def _(*args, **kwargs):
+            timings = timing.current()
+            owner = timings is None
+            if owner:
+                timings = timing.Timings()
+                timing.set_current(timings)
+            status = size = None
+            streaming = False
+            try:
+                rv = callback(*args, **kwargs)
+                status = bottle.response.status_code
+                if isinstance(rv, types.GeneratorType):
+                    streaming = True
+                    return self.finish_after(rv, route, timings, status)
+                size = body_size(rv)
+                return rv
+            except bottle.HTTPResponse as e:
+                status = e.status_code
+                raise
+            except Exception:
+                status = 500
+                raise
+            finally:
+                if owner:
+                    timing.set_current(None)
+                if not streaming:
+                    self.finish(route, timings, status, size)
+        return _
+
+    def finish_after(self, gen, route, timings, status):
+        size = 0
+        try:
+            for chunk in gen:
+                size += body_size(chunk) or 0
+                yield chunk
+        except Exception:
+            status = 500
+            raise
+        finally:
+            gen.close()
+            self.finish(route, timings, status, size)
+
+    def finish(self, route, timings, status, size):
+        seconds = timings.total()
+        if seconds < self.threshold:
+            return
+        suppressed = self.limit.take()
+        if suppressed is None:
+            return
+        record = OrderedDict([
+            ('route', route.rule),
+            ('method', bottle.request.method),
+            ('path', bottle.request.path),
+            ('status', status),
+            ('seconds', seconds),
+            ('bytes', size),
+            ('backends', timings.to_dict()),
+        ])
+        record.update(timings.context)
+        record['suppressed'] = suppressed
+        line = json.dumps(record, default=repr)
+        logger.warning('%s', line)
+        if self.handler is not None:
+            self.handler.handle(logging.makeLogRecord({
+                'name': logger.name,
+                'levelno': logging.WARNING,
+                'levelname': logging.getLevelName(logging.WARNING),
+                'msg': line,
+            }))
+
+
+def body_size(body):
+    if isinstance(body, basestring):
+        return len(body)
+    return None
@@ -23,6 +23,7 @@ from __future__ import absolute_import, division, print_function
 
 import json
 import logging
+import threading
 import urllib
 
 import bottle
@@ -33,6 +34,20 @@ import yakonfig
 logger = logging.getLogger(__name__)
 app = bottle.Bottle()
 
+# The indexes and mappings that have already been checked (or created)
+# by this process. Checking them is slow, so it's only done by the first
+# `Tags` instance for each `Tags.schema_key`. Each key has its own lock,
+# held during the check, so that checks of different keys don't wait for
+# each other. `_schema_lock` only guards these two containers.
+_schema_checked = set()
+_schema_locks = {}
+_schema_lock = threading.Lock()
+
+
+def _schema_key_lock(key):
+    with _schema_lock:
+        return _schema_locks.setdefault(key, threading.Lock())
+
 
 @app.post('/dossier/v1/tags/associations/tag/<tag:path>')
 def v1_tag_associate(request, tags, tag):
@@ -90,8 +105,10 @@ def v1_tag_list(tags, tag=''):
     return {'children': tags.list(tag)}
 
 
-@app.get('/dossier/v1/tags/suggest/prefix/<prefix>')
-@app.get('/dossier/v1/tags/suggest/prefix/<prefix>/parent/<parent:path>')
+@app.get('/dossier/v1/tags/suggest/prefix/<prefix>',
+         admission='autocomplete')
+@app.get('/dossier/v1/tags/suggest/prefix/<prefix>/parent/<parent:path>',
+         admission='autocomplete')
 def v1_tag_suggest(request, tags, prefix, parent=''):
     '''Provide fast suggestions for tag components.
 
@@ -181,7 +198,16 @@ class Tags(object):
         self.shards = shards
         self.replicas = replicas
         self.delim = tag_delimiter
+        self.schema_key = (repr(hosts), self.index,
+                           self.type_tag, self.type_assoc)
+
+        with _schema_key_lock(self.schema_key):
+            if self.schema_key not in _schema_checked:
+                self._create_schema()
+                with _schema_lock:
+                    _schema_checked.add(self.schema_key)
 
+    def _create_schema(self):
         created1 = self._create_index()
         created2 = self._create_mappings()
         if created1 or created2:
@@ -275,6 +301,8 @@ class Tags(object):
         This does not destroy the ES index, but instead only
         deletes all tags with the configured doc types.
         '''
+        with _schema_lock:
+            _schema_checked.discard(self.schema_key)
         try:
             self.conn.indices.delete_mapping(
                 index=self.index, doc_type=self.type_tag)
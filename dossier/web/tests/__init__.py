@@ -4,6 +4,8 @@ import pytest
 
 from dossier.label import LabelStore
 from dossier.store import ElasticStoreSync
+from dossier.web.memory import MemoryConfig, select_features
+from dossier.web.versions import Versions
 import kvlayer
 import yakonfig
 
@@ -56,3 +58,51 @@ def store(kvl):
 @pytest.yield_fixture
 def label_store(kvl):
     yield LabelStore(kvl)
+
+
+@pytest.yield_fixture
+def versions(kvl):
+    yield Versions(kvl)
+
+
+class FakeStore(dict):
+    def put(self, items):
+        self.update(items)
+
+    def get_many(self, content_ids, feature_names=None):
+        for cid in content_ids:
+            yield cid, select_features(self.get(cid), feature_names)
+
+
+class FakeLabelStore(object):
+    def __init__(self):
+        self.labels = []
+        self.reads = 0
+
+    def put(self, *labels):
+        self.labels.extend(labels)
+
+    def directly_connected(self, ident):
+        self.reads += 1
+        return [lab for lab in self.labels
+                if ident in (lab.content_id1, lab.content_id2)]
+
+    def connected_component(self, ident):
+        self.reads += 1
+        return list(self.labels)
+
+
+class FakeConfig(MemoryConfig):
+    def __init__(self):
+        super(FakeConfig, self).__init__(
+            store=FakeStore(), label_store=FakeLabelStore(),
+            kvlclient=kvlayer.client(config={}, storage_type='local',
+                                     app_name='diffeo',
+                                     namespace='dossier.web.tests'))
+
+
+@pytest.yield_fixture
+def fake_config():
+    config = FakeConfig()
+    yield config
+    config.kvlclient.delete_namespace()
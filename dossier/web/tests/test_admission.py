@@ -0,0 +1,102 @@
+from __future__ import absolute_import, division, print_function
+
+import json
+import threading
+
+import bottle
+import pytest
+
+from dossier.web.admission import AdmissionControl, Shed
+from dossier.web.builder import WebBuilder
+from dossier.web.config import Config
+from dossier.web.util import wsgi_request
+
+
+def test_limit_and_queue():
+    ac = AdmissionControl({'search': {'limit': 1, 'queue': 1,
+                                      'timeout': 0.01}})
+    held = ac.admit('search')
+    # The queue has room, but the request times out while waiting.
+    with pytest.raises(Shed):
+        ac.admit('search')
+    ac.release(held)
+    ac.release(ac.admit('search'))
+    stats = ac.stats()['search']
+    assert stats['admitted'] == 2
+    assert stats['queued'] == 1
+    assert stats['shed'] == 1
+    assert stats['running'] == 0
+
+
+def test_queued_request_admitted_on_release():
+    ac = AdmissionControl({'search': {'limit': 1, 'queue': 1, 'timeout': 5}})
+    held = ac.admit('search')
+    admitted = []
+    t = threading.Thread(target=lambda: admitted.append(ac.admit('search')))
+    t.start()
+    while ac.stats()['search']['waiting'] == 0:
+        pass
+    ac.release(held)
+    t.join()
+    assert len(admitted) == 1
+    assert ac.stats()['search']['max_wait_seconds'] > 0
+
+
+def test_full_queue_sheds_immediately():
+    ac = AdmissionControl({'search': {'limit': 1, 'queue': 0,
+                                      'timeout': 60}})
+    ac.admit('search')
+    with pytest.raises(Shed):
+        ac.admit('search')
+
+
+def test_priority_lane():
+    ac = AdmissionControl({'autocomplete': {'limit': 1, 'priority': True}},
+                          total=1)
+    ac.admit('default')
+    with pytest.raises(Shed):
+        ac.admit('search')
+    ac.admit('autocomplete')
+    assert ac.stats()['default']['running'] == 1
+
+
+def test_ungrouped_unlimited():
+    ac = AdmissionControl({'search': {'limit': 1}})
+    assert ac.admit('default') is None
+    assert not AdmissionControl().enabled
+
+
+def test_plugin_sheds_with_retry_after():
+    slow = bottle.Bottle()
+    entered, finish = threading.Event(), threading.Event()
+
+    @slow.get('/slow', admission='search')
+    def slow_route():
+        entered.set()
+        finish.wait()
+        return 'done'
+
+    app = (WebBuilder()
+           .set_config(Config(config={}))
+           .add_routes(slow)
+           .enable_admission_control({
+               'search': {'limit': 1, 'queue': 0, 'status': 429,
+                          'retry_after': 3},
+           })
+           .get_app())
+    t = threading.Thread(target=wsgi_request, args=(app, 'GET', '/slow'))
+    t.start()
+    entered.wait()
+    try:
+        status, headers, _ = wsgi_request(app, 'GET', '/slow')
+        assert status == 429
+        assert headers['Retry-After'] == '3'
+
+        status, _, body = wsgi_request(app, 'GET', '/dossier/v1/status')
+        assert status == 200
+        search = json.loads(body)['admission']['search']
+        assert search['running'] == 1
+        assert search['shed'] == 1
+    finally:
+        finish.set()
+        t.join()
@@ -0,0 +1,53 @@
+from __future__ import absolute_import, division, print_function
+
+from dossier.web import benchmark
+
+
+class Clock(object):
+    def __init__(self):
+        self.now = 0
+
+    def __call__(self):
+        return self.now
+
+
+def test_measure_doubles_until_min_time():
+    clock = Clock()
+
+    def fun():
+        clock.now += 0.01
+
+    number, times = benchmark.measure(fun, repeat=3, min_time=0.1,
+                                      clock=clock)
+    assert number == 16
+    assert len(times) == 3
+    assert all(abs(t - 0.01) < 1e-9 for t in times)
+
+
+def test_run_small():
+    results = benchmark.run(sizes=[20], only=['search.', 'filter.geotime',
+                                              'wsgi.'],
+                            repeat=1, min_time=0)
+    assert list(results) == [
+        'search.streaming_sample/20',
+        'search.plain_index_scan/20',
+        'search.random/20',
+        'filter.geotime/20',
+        'search.setup/1000',
+        'wsgi.search/1000',
+        'wsgi.fc_get/1000',
+        'wsgi.inject/1000',
+    ]
+    for result in results.values():
+        assert result['seconds'] > 0
+
+
+def test_compare():
+    def result(seconds):
+        return {'seconds': seconds}
+
+    baseline = {'a/1': result(1.0), 'b/1': result(1.0), 'c/1': result(1.0)}
+    results = {'a/1': result(1.1), 'b/1': result(1.5), 'd/1': result(1.0)}
+    rows = benchmark.compare(baseline, results, threshold=0.2)
+    assert sorted((key, regressed) for key, _, _, _, regressed in rows) \
+        == [('a/1', False), ('b/1', True)]
@@ -0,0 +1,89 @@
+from __future__ import absolute_import, division, print_function
+
+import json
+
+from dossier.web.breaker import CircuitBreaker
+from dossier.web.builder import WebBuilder
+from dossier.web.config import Config
+from dossier.web.util import wsgi_request
+
+
+class Clock(object):
+    def __init__(self):
+        self.now = 0
+
+    def __call__(self):
+        return self.now
+
+
+def test_opens_after_threshold():
+    breaker = CircuitBreaker('s', threshold=2, clock=Clock())
+    breaker.failure()
+    assert breaker.allow()
+    breaker.failure()
+    assert not breaker.allow()
+    assert breaker.status()['state'] == 'open'
+
+
+def test_success_resets():
+    breaker = CircuitBreaker('s', threshold=2, clock=Clock())
+    breaker.failure()
+    breaker.success()
+    breaker.failure()
+    assert breaker.allow()
+
+
+def test_half_open_backoff():
+    clock = Clock()
+    breaker = CircuitBreaker('s', threshold=1, backoff=1, max_backoff=3,
+                             clock=clock)
+    breaker.failure('down')
+    for delay in [1, 2, 3, 3]:
+        clock.now += delay - 0.5
+        assert not breaker.allow()
+        clock.now += 0.5
+        assert breaker.allow()
+        # Only one caller gets to probe.
+        assert not breaker.allow()
+        breaker.failure('still down')
+    clock.now += 3
+    assert breaker.allow()
+    breaker.success()
+    assert breaker.status() == {'state': 'closed', 'failures': 0,
+                                'last_error': 'still down',
+                                'retry_in': None, 'rejected': 8}
+
+
+def test_cancel():
+    clock = Clock()
+    breaker = CircuitBreaker('s', threshold=1, clock=clock)
+    breaker.failure()
+    clock.now += 1
+    assert breaker.allow()
+    breaker.cancel()
+    assert breaker.allow()
+
+
+class DownConfig(Config):
+    def __init__(self):
+        super(DownConfig, self).__init__(config={'breaker_threshold': 1})
+        self.attempts = 0
+
+    def new_store(self):
+        self.attempts += 1
+        raise IOError('connection refused')
+
+
+def test_config_fails_fast():
+    config = DownConfig()
+    assert config.store is None
+    assert config.store is None
+    assert config.attempts == 1
+
+    app = WebBuilder().set_config(config).get_app()
+    status, _, body = wsgi_request(app, 'GET', '/dossier/v1/status')
+    assert status == 200
+    status = json.loads(body)
+    assert not status['ok']
+    assert status['breakers']['store']['state'] == 'open'
+    assert status['breakers']['store']['last_error'] == 'connection refused'
@@ -0,0 +1,68 @@
+from __future__ import absolute_import, division, print_function
+
+import bottle
+
+from dossier.web.builder import WebBuilder
+from dossier.web.config import Config
+from dossier.web.util import wsgi_request
+
+
+SERVICES = ['service%d' % i for i in xrange(12)]
+
+
+def wsgi_get(app, path):
+    status, _, body = wsgi_request(app, 'GET', path)
+    return status, body
+
+
+def new_routes():
+    routes = bottle.Bottle()
+
+    @routes.get('/one')
+    def one(service0):
+        return service0
+
+    @routes.get('/many')
+    def many(service0, service5, service11):
+        return service0 + service5 + service11
+
+    @routes.get('/all')
+    def all(service0, service1, service2, service3, service4, service5,
+            service6, service7, service8, service9, service10, service11):
+        return 'all'
+
+    @routes.get('/none')
+    def none():
+        return 'none'
+
+    return routes
+
+
+def new_builder():
+    builder = WebBuilder(add_default_routes=False).add_routes(new_routes())
+    for name in SERVICES:
+        builder.inject(name, lambda name=name: name[-1])
+    return builder.set_config(Config(config={}))
+
+
+def test_inject_single_pass():
+    app = new_builder().get_app()
+    assert wsgi_get(app, '/one') == (200, '0')
+    assert wsgi_get(app, '/many') == (200, '051')
+    assert wsgi_get(app, '/none') == (200, 'none')
+
+
+def test_inject_last_wins():
+    builder = new_builder()
+    builder.inject('service0', lambda: 'x')
+    assert wsgi_get(builder.get_app(), '/one') == (200, 'x')
+
+
+def test_inject_unavailable():
+    builder = new_builder()
+    builder.inject('service5', lambda: None)
+    app = builder.get_app()
+    assert wsgi_get(app, '/one') == (200, '0')
+    status, body = wsgi_get(app, '/many')
+    assert status == 503
+    assert 'service &quot;service5&quot; unavailable' in body
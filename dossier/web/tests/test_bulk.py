@@ -0,0 +1,66 @@
+from __future__ import absolute_import, division, print_function
+
+from cStringIO import StringIO
+import threading
+
+from dossier.web import bulk
+from dossier.web.bulk import BatchWriter, BodyReader
+
+
+def test_body_reader_lines(monkeypatch):
+    monkeypatch.setattr(bulk, 'READ_SIZE', 3)
+    reader = BodyReader(StringIO('ab\ncdefg\n\nh\nignored'), length=13)
+    assert list(reader) == ['ab\n', 'cdefg\n', '\n', 'h\n', 'i']
+
+
+def test_body_reader_read(monkeypatch):
+    monkeypatch.setattr(bulk, 'READ_SIZE', 2)
+    reader = BodyReader(StringIO('abcde'))
+    assert reader.read(3) == 'abc'
+    assert not reader.at_eof()
+    assert reader.read(5) == 'de'
+    assert reader.at_eof()
+
+
+def test_batch_writer():
+    batches = []
+    writer = BatchWriter(batches.append, batch_size=2)
+    for i in xrange(5):
+        writer.add(i, str(i))
+    assert writer.close() == []
+    assert sorted(batches) == [['0', '1'], ['2', '3'], ['4']]
+    assert sorted(writer.finished()) == range(5)
+    assert writer.finished() == []
+
+
+def test_batch_writer_errors():
+    def write(batch):
+        if '2' in batch:
+            raise ValueError('oops')
+    writer = BatchWriter(write, batch_size=2)
+    for i in xrange(4):
+        writer.add(i, str(i))
+    assert sorted(writer.close()) == [(2, 'oops'), (3, 'oops')]
+    assert sorted(writer.finished()) == [0, 1]
+
+
+def test_batch_writer_backpressure():
+    release = threading.Event()
+    writing = []
+
+    def write(batch):
+        writing.append(batch)
+        release.wait()
+
+    writer = BatchWriter(write, batch_size=1, max_in_flight=2)
+    writer.add(0, 'a')
+    writer.add(1, 'b')
+    blocked = threading.Thread(target=writer.add, args=(2, 'c'))
+    blocked.start()
+    blocked.join(0.1)
+    # The third batch waits for one of the first two to finish.
+    assert blocked.is_alive()
+    release.set()
+    blocked.join()
+    assert writer.close() == []
+    assert sorted(writer.finished()) == [0, 1, 2]
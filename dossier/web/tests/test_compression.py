@@ -0,0 +1,188 @@
+from __future__ import absolute_import, division, print_function
+
+import gzip
+import json
+import mimetypes
+import zlib
+
+import bottle
+import pytest
+
+from dossier.web.builder import WebBuilder
+from dossier.web.compression import negotiate_encoding
+from dossier.web.config import Config
+from dossier.web.memory import MemoryConfig
+import dossier.web.routes as routes
+from dossier.web.util import wsgi_request
+
+
+BIG = 'x' * 5000
+
+
+@pytest.fixture
+def app():
+    routes = bottle.Bottle()
+
+    @routes.get('/big')
+    def big():
+        return BIG
+
+    @routes.get('/small')
+    def small():
+        return 'small'
+
+    @routes.get('/stream')
+    def stream():
+        for _ in xrange(10):
+            yield BIG
+
+    @routes.get('/short-stream')
+    def short_stream():
+        yield 'a'
+        yield 'b'
+
+    @routes.get('/dict')
+    def dict_():
+        return {'big': BIG}
+
+    @routes.get('/json', json=True)
+    def json_list():
+        return [BIG]
+
+    @routes.get('/encoded')
+    def encoded(response):
+        response.headers['Content-Encoding'] = 'br'
+        return BIG
+
+    @routes.get('/image')
+    def image(response):
+        response.content_type = 'image/png'
+        return BIG
+
+    return (WebBuilder(add_default_routes=False)
+            .add_routes(routes)
+            .set_config(Config(config={}))
+            .enable_compression(min_size=100)
+            .get_app())
+
+
+def get(app, path, accept='gzip, deflate'):
+    return wsgi_request(app, 'GET', path, headers={'Accept-Encoding': accept})
+
+
+def gunzip(s):
+    return zlib.decompress(s, 16 + zlib.MAX_WBITS)
+
+
+def test_negotiate_encoding():
+    assert negotiate_encoding('') is None
+    assert negotiate_encoding('gzip') == 'gzip'
+    assert negotiate_encoding('deflate, gzip') == 'gzip'
+    assert negotiate_encoding('gzip;q=0, deflate') == 'deflate'
+    assert negotiate_encoding('gzip;q=0.5, deflate;q=0.8') == 'deflate'
+    assert negotiate_encoding('*') == 'gzip'
+    assert negotiate_encoding('identity') is None
+
+
+def test_gzip(app):
+    status, headers, body = get(app, '/big')
+    assert status == 200
+    assert headers['Content-Encoding'] == 'gzip'
+    assert int(headers['Content-Length']) == len(body) < len(BIG)
+    assert gunzip(body) == BIG
+
+
+def test_deflate(app):
+    _, headers, body = get(app, '/big', accept='deflate')
+    assert headers['Content-Encoding'] == 'deflate'
+    assert zlib.decompress(body) == BIG
+
+
+def test_not_accepted(app):
+    _, headers, body = get(app, '/big', accept='')
+    assert 'Content-Encoding' not in headers
+    assert headers['Vary'] == 'Accept-Encoding'
+    assert body == BIG
+
+
+def test_skip_small(app):
+    _, headers, body = get(app, '/small')
+    assert 'Content-Encoding' not in headers
+    assert body == 'small'
+
+
+def test_skip_already_encoded(app):
+    _, headers, body = get(app, '/encoded')
+    assert headers['Content-Encoding'] == 'br'
+    assert body == BIG
+
+
+def test_skip_incompressible(app):
+    _, headers, body = get(app, '/image')
+    assert 'Content-Encoding' not in headers
+    assert body == BIG
+
+
+def test_stream(app):
+    _, headers, body = get(app, '/stream')
+    assert headers['Content-Encoding'] == 'gzip'
+    assert gunzip(body) == BIG * 10
+
+
+def test_short_stream(app):
+    _, headers, body = get(app, '/short-stream')
+    assert 'Content-Encoding' not in headers
+    assert body == 'ab'
+
+
+def test_json(app):
+    _, headers, body = get(app, '/dict')
+    assert headers['Content-Type'] == 'application/json'
+    assert json.loads(gunzip(body)) == {'big': BIG}
+
+    _, headers, body = get(app, '/json')
+    assert headers['Content-Type'] == 'application/json'
+    assert json.loads(gunzip(body)) == [BIG]
+
+
+def test_vary(app):
+    for path in ['/big', '/stream']:
+        for accept in ['gzip', '']:
+            _, headers, _ = get(app, path, accept=accept)
+            assert headers['Vary'] == 'Accept-Encoding'
+    _, headers, _ = get(app, '/small')
+    assert 'Vary' not in headers
+
+
+@pytest.fixture
+def static_root(tmpdir, monkeypatch):
+    root = tmpdir.mkdir('v1')
+    for name in ['app.js', 'data.unknown']:
+        root.join(name).write(BIG)
+        with gzip.open(str(root.join(name + '.gz')), 'wb') as fp:
+            fp.write(BIG)
+    root.join('plain.js').write(BIG)
+    monkeypatch.setattr(routes, 'web_static_path', str(tmpdir))
+    return root
+
+
+def test_static_precompressed(static_root):
+    app = WebBuilder().set_config(MemoryConfig()).get_app()
+    url = '/dossier/v1/static/%s'
+    _, headers, body = get(app, url % 'app.js', accept='gzip')
+    assert headers['Content-Encoding'] == 'gzip'
+    assert headers['Content-Type'].startswith(
+        mimetypes.guess_type('app.js')[0])
+    assert headers['Vary'] == 'Accept-Encoding'
+    assert gunzip(body) == BIG
+
+    _, headers, body = get(app, url % 'app.js', accept='')
+    assert 'Content-Encoding' not in headers
+    assert headers['Vary'] == 'Accept-Encoding'
+    assert body == BIG
+
+    _, headers, _ = get(app, url % 'data.unknown', accept='gzip')
+    assert headers['Content-Type'] == 'application/octet-stream'
+
+    _, headers, _ = get(app, url % 'plain.js', accept='gzip')
+    assert 'Vary' not in headers
@@ -0,0 +1,69 @@
+from __future__ import absolute_import, division, print_function
+
+from dossier.web.config import Config
+from dossier.web.filters import already_labeled, nilsimsa_near_duplicates
+from dossier.web.search_engines import plain_index_scan
+
+
+class ServiceConfig(Config):
+    store = None
+    label_store = None
+
+    def __init__(self, store=None, label_store=None):
+        super(ServiceConfig, self).__init__(config={})
+        self.store = store
+        self.label_store = label_store
+
+
+class counting_filter(already_labeled):
+    created = 0
+
+    def __init__(self, label_store):
+        super(counting_filter, self).__init__(label_store)
+        counting_filter.created += 1
+
+
+class FakeLabelStore(object):
+    def directly_connected(self, ident):
+        return []
+
+
+def new_search(config, filters, query_params=None):
+    engine = (config.create(plain_index_scan)
+                    .set_query_id('abc')
+                    .set_query_params(query_params or {}))
+    for name, filter in filters.items():
+        engine.add_lazy_filter(name,
+                               lambda filter=filter: config.create(filter))
+    return engine
+
+
+def test_construction_plan_cached():
+    config = ServiceConfig()
+    plan = config.construction_plan(plain_index_scan)
+    assert plan is config.construction_plan(plain_index_scan)
+    assert plan.services == ['store']
+
+
+def test_create_injects_services():
+    config = ServiceConfig(store='the store', label_store='the labels')
+    assert config.create(plain_index_scan).store == 'the store'
+    filt = config.create(nilsimsa_near_duplicates)
+    assert filt.store == 'the store'
+    assert filt.label_store == 'the labels'
+
+
+def test_lazy_filters_only_created_when_selected():
+    config = ServiceConfig(label_store=FakeLabelStore())
+    counting_filter.created = 0
+    filters = {
+        'already_labeled': already_labeled,
+        'counting': counting_filter,
+    }
+    new_search(config, filters).create_filter_predicate()
+    assert counting_filter.created == 0
+
+    engine = new_search(config, filters, {'filter': 'counting'})
+    engine.create_filter_predicate()
+    engine.create_filter_predicate()
+    assert counting_filter.created == 1
@@ -0,0 +1,156 @@
+from __future__ import absolute_import, division, print_function
+
+import threading
+import time
+
+import pytest
+
+from dossier.fc import FeatureCollection
+from dossier.web.executor import Executor, prefetch
+from dossier.web.builder import WebBuilder
+from dossier.web.memory import MemoryConfig
+from dossier.web.search_engines import plain_index_scan
+from dossier.web.util import wsgi_request
+
+
+class FakeStore(object):
+    '''A store whose fetches are slow and that records concurrency.'''
+    def __init__(self, fcs, delay=0.0):
+        self.fcs = fcs
+        self.delay = delay
+        self.fetches = []
+        self.failing = False
+
+    def get(self, cid):
+        if self.failing:
+            raise IOError('store is down')
+        return self.fcs.get(cid)
+
+    def get_many(self, cids):
+        self.fetches.append(list(cids))
+        time.sleep(self.delay)
+        if self.failing:
+            # Like `ElasticStore.get_many` when a request fails.
+            return
+        for cid in cids:
+            yield cid, self.fcs.get(cid)
+
+    def index_names(self):
+        return [u'NAME']
+
+    def index_scan(self, idx_name, val):
+        for cid, fc in sorted(self.fcs.items()):
+            if val in fc[idx_name]:
+                yield cid
+
+
+def test_submit_result():
+    ex = Executor(max_workers=2)
+    assert ex.submit(lambda x, y: x + y, 1, y=2).result() == 3
+
+
+def test_submit_raises():
+    ex = Executor(max_workers=1)
+    future = ex.submit(lambda: 1 // 0)
+    with pytest.raises(ZeroDivisionError):
+        future.result()
+
+
+def test_shutdown_and_restart():
+    ex = Executor(max_workers=2)
+    assert ex.submit(lambda: 1).result() == 1
+    threads = ex.threads
+    ex.shutdown()
+    assert not any(t.is_alive() for t in threads)
+    assert ex.submit(lambda: 2).result() == 2
+    ex.shutdown()
+
+
+def test_max_workers_bounds_concurrency():
+    ex = Executor(max_workers=2)
+    lock = threading.Lock()
+    running = [0, 0]  # current, maximum
+
+    def work():
+        with lock:
+            running[0] += 1
+            running[1] = max(running)
+        time.sleep(0.02)
+        with lock:
+            running[0] -= 1
+
+    for future in [ex.submit(work) for _ in xrange(8)]:
+        future.result()
+    assert running[1] == 2
+
+
+def test_prefetch_in_order():
+    ex = Executor(max_workers=4)
+    got = list(prefetch(lambda x: x * 2, xrange(10), depth=3, executor=ex))
+    assert got == [x * 2 for x in xrange(10)]
+    assert list(prefetch(lambda x: x * 2, xrange(3), depth=0)) == [0, 2, 4]
+
+
+def test_prefetch_overlaps():
+    ex = Executor(max_workers=4)
+    start = time.time()
+    for _ in prefetch(lambda x: time.sleep(0.05), xrange(4), depth=1,
+                      executor=ex):
+        time.sleep(0.05)
+    # 4 fetches and 4 consumer steps, of which all but one overlap.
+    assert time.time() - start < 0.35
+
+
+@pytest.mark.parametrize('prefetch_depth', [0, 2])
+def test_plain_index_scan_fetches_in_batches(prefetch_depth):
+    fcs = dict(('%02d' % i, FeatureCollection({u'NAME': {u'x': 1}}))
+               for i in xrange(25))
+    store = FakeStore(fcs)
+    engine = (plain_index_scan(store)
+              .set_query_id('00')
+              .set_query_params({'limit': '100', 'fetch_size': '10',
+                                 'prefetch': str(prefetch_depth)}))
+    results = engine.recommendations()['results']
+    assert sorted(cid for cid, _ in results) == sorted(fcs)[1:]
+    assert map(len, store.fetches) == [10, 10, 4]
+
+
+def test_plain_index_scan_failed_fetch_raises():
+    fcs = dict(('%02d' % i, FeatureCollection({u'NAME': {u'x': 1}}))
+               for i in xrange(5))
+    store = FakeStore(fcs)
+    engine = (plain_index_scan(store)
+              .set_query_id('00')
+              .set_query_params({'prefetch': '0'}))
+    query_fc = store.get('00')
+    engine.get_query_fc = lambda cid: query_fc
+    store.failing = True
+    with pytest.raises(IOError):
+        engine.recommendations()
+
+
+class recording_scan(plain_index_scan):
+    prefetches = []
+
+    def recommendations(self):
+        recording_scan.prefetches.append(self.params['prefetch'])
+        return {'results': []}
+
+
+@pytest.mark.parametrize(('mode', 'query', 'expected'), [
+    ('thread_local', '', 1),
+    ('pooled', '', 0),
+    ('pooled', 'prefetch=2', 2),
+])
+def test_no_prefetch_by_default_when_pooled(mode, query, expected):
+    config = MemoryConfig(config={'service_mode': mode})
+    app = (WebBuilder()
+           .set_config(config)
+           .add_search_engine('recording', recording_scan)
+           .get_app())
+    del recording_scan.prefetches[:]
+    status, _, _ = wsgi_request(
+        app, 'GET', '/dossier/v1/feature-collection/q/search/recording',
+        query=query)
+    assert status == 200
+    assert recording_scan.prefetches == [expected]
@@ -0,0 +1,49 @@
+from __future__ import absolute_import, division, print_function
+
+import json
+import subprocess
+import sys
+
+
+#: Modules that `import dossier.web` must not import.
+HEAVY_MODULES = ['bottle', 'elasticsearch', 'kvlayer', 'nilsimsa',
+                 'dossier.fc', 'dossier.label', 'dossier.store', 'yakonfig']
+
+#: Every module that `import dossier.web` may import. Anything else
+#: would make the import slower, so it must be loaded lazily.
+ALLOWED_MODULES = ['__future__', 'dossier', 'dossier.web', 'importlib']
+
+MEASURE = '''
+import json, sys
+before = set(sys.modules)
+import dossier.web
+print(json.dumps(sorted(m for m, mod in sys.modules.items()
+                        if m not in before and mod is not None)))
+'''
+
+
+def imported_modules():
+    '''Return the modules that `import dossier.web` imports.'''
+    out = subprocess.check_output([sys.executable, '-c', MEASURE])
+    return json.loads(out.splitlines()[-1])
+
+
+def test_import_is_lazy():
+    modules = imported_modules()
+    assert [m for m in HEAVY_MODULES if m in modules] == []
+
+
+def test_import_is_small():
+    assert [m for m in imported_modules() if m not in ALLOWED_MODULES] == []
+
+
+def test_public_names():
+    import dossier.web
+    from dossier.web.builder import WebBuilder
+    from dossier.web.search_engines import streaming_sample
+
+    assert dossier.web.WebBuilder is WebBuilder
+    from dossier.web import streaming_sample as lazy_streaming_sample
+    assert lazy_streaming_sample is streaming_sample
+    for name in dossier.web.__all__:
+        assert getattr(dossier.web, name) is not None
@@ -0,0 +1,68 @@
+from __future__ import absolute_import, division, print_function
+
+from itertools import islice
+
+import pytest
+
+from dossier.web import benchmark, loadtest
+
+
+def test_replay():
+    lines = [
+        '1.2.3.4 - - [10/Oct/2015:13:55:36 -0700] '
+        '"GET /api/dossier/v1/folder HTTP/1.1" 200 2',
+        '1.2.3.4 - - [10/Oct/2015:13:55:36 -0700] '
+        '"PUT /api/dossier/v1/feature-collection/a HTTP/1.1" 201 0',
+        'not a request',
+        '1.2.3.4 - - [10/Oct/2015:13:55:36 -0700] '
+        '"GET /api/dossier/v1/feature-collection/a/search/random?limit=5 '
+        'HTTP/1.0" 200 10 "-" "curl/7.0"',
+    ]
+    assert list(loadtest.replay(lines, prefix='/api')) == [
+        ('GET', '/dossier/v1/folder', ''),
+        ('GET', '/dossier/v1/feature-collection/a/search/random', 'limit=5'),
+    ]
+
+
+def test_synthetic():
+    mix = loadtest.parse_mix('fc_get=1,status=0')
+    reqs = list(islice(loadtest.synthetic(mix, ['a|b'], seed=1), 10))
+    assert set(reqs) == {('GET', '/dossier/v1/feature-collection/a%7Cb', '')}
+    with pytest.raises(ValueError):
+        loadtest.synthetic(loadtest.parse_mix('search'))
+    with pytest.raises(ValueError):
+        loadtest.parse_mix('nope=1')
+
+
+def test_route_of():
+    assert loadtest.route_of('GET', '/dossier/v1/label/a%2Fb/direct') \
+        == 'GET /dossier/v1/label/<cid>/direct'
+    assert loadtest.route_of('GET', '/elsewhere') == 'GET /elsewhere'
+
+
+def test_percentile():
+    values = range(1, 101)
+    assert loadtest.percentile(values, 50) == 50
+    assert loadtest.percentile(values, 99) == 99
+    assert loadtest.percentile([7], 95) == 7
+    assert loadtest.percentile([], 95) == 0.0
+
+
+def test_run_in_process():
+    corpus = benchmark.Corpus(50)
+    try:
+        send = loadtest.InProcess(benchmark.app(corpus))
+        mix = loadtest.parse_mix('search=1,fc_get=1')
+        reqs = loadtest.synthetic(mix, ['1', '2', 'missing'], seed=0)
+        report = loadtest.run(send, reqs, concurrency=4, total=40)
+    finally:
+        corpus.close()
+    summary = report.summary()
+    assert summary['all']['requests'] == 40
+    assert summary['all']['rps'] > 0
+    search = summary['GET /dossier/v1/feature-collection/<cid>'
+                     '/search/<engine_name>']
+    fc_get = summary['GET /dossier/v1/feature-collection/<cid>']
+    assert search['requests'] + fc_get['requests'] == 40
+    assert set(fc_get['statuses']) <= {'200', '404'}
+    assert fc_get['p50_ms'] <= fc_get['p99_ms'] <= fc_get['max_ms']
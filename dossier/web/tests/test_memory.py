@@ -0,0 +1,133 @@
+from __future__ import absolute_import, division, print_function
+
+import threading
+import time
+
+import pytest
+
+from dossier.fc import FeatureCollection, StringCounter
+from dossier.label import CorefValue, Label
+from dossier.web.memory import Delay, MemoryLabelStore, MemoryStore
+
+
+def fc(*names):
+    return FeatureCollection({u'NAME': StringCounter(dict.fromkeys(names, 1)),
+                              u'other': StringCounter({u'x': 1})})
+
+
+def test_index_scan():
+    store = MemoryStore()
+    store.put([('a', fc(u'alice', u'bob')), ('b', fc(u'bob'))])
+    assert store.index_names() == [u'NAME']
+    assert list(store.index_scan(u'NAME', u'bob')) == ['a', 'b']
+    assert list(store.index_scan_ids(u'NAME', u'alice')) == ['a']
+    assert list(store.index_scan(u'other', u'x')) == []
+    assert list(store.index_scan(u'NAME', u'carol')) == []
+
+
+def test_put_replaces_and_reindexes():
+    store = MemoryStore()
+    store.put([('a', fc(u'alice'))])
+    store.put([('a', fc(u'bob'))])
+    assert list(store.index_scan(u'NAME', u'alice')) == []
+    assert list(store.index_scan(u'NAME', u'bob')) == ['a']
+    assert store.get('a') == fc(u'bob')
+
+
+def test_get_many_and_delete():
+    store = MemoryStore()
+    store.put([('b', fc(u'bob')), ('a', fc(u'alice'))])
+    assert list(store.scan_ids()) == ['a', 'b']
+    store.delete('a')
+    assert list(store.get_many(['a', 'b'])) == [('a', None),
+                                                ('b', fc(u'bob'))]
+    assert list(store.index_scan(u'NAME', u'alice')) == []
+    store.delete_all()
+    assert list(store.scan()) == []
+
+
+def test_get_feature_names():
+    store = MemoryStore()
+    store.put([('a', fc(u'alice'))])
+    assert store.get('a', feature_names=[u'other']) \
+        == FeatureCollection({u'other': StringCounter({u'x': 1})})
+    assert list(store.get('a', feature_names=[u'N*'])) == [u'NAME']
+    assert list(store.get_many(['a', 'b'], feature_names=[])) \
+        == [('a', FeatureCollection()), ('b', None)]
+
+
+def label(cid1, cid2, value=CorefValue.Positive, ticks=1, **kwargs):
+    return Label(cid1, cid2, 'ann', value, epoch_ticks=ticks, **kwargs)
+
+
+def test_labels_most_recent():
+    ls = MemoryLabelStore()
+    ls.put(label('a', 'b', ticks=1), label('b', 'c'),
+           label('b', 'a', CorefValue.Negative, ticks=2))
+    assert list(ls.directly_connected('a')) == [
+        label('a', 'b', CorefValue.Negative, ticks=2)]
+    assert len(list(ls.everything(include_deleted=True))) == 3
+    assert ls.get('b', 'a', 'ann').value == CorefValue.Negative
+    with pytest.raises(KeyError):
+        ls.get('a', 'c', 'ann')
+
+
+def test_labels_subtopics():
+    ls = MemoryLabelStore()
+    ls.put(label('a', 'b', subtopic_id1='x'), label('a', 'c'))
+    assert list(ls.directly_connected(('a', 'x'))) == [
+        label('a', 'b', subtopic_id1='x')]
+    assert len(list(ls.directly_connected('a'))) == 2
+
+
+def test_labels_inference():
+    ls = MemoryLabelStore()
+    ls.put(label('a', 'b'), label('b', 'c'),
+           label('c', 'd', CorefValue.Negative))
+    assert sorted(ls.connected_component('a')) \
+        == [label('a', 'b'), label('b', 'c')]
+    negs = set((lab.content_id1, lab.content_id2)
+               for lab in ls.negative_inference('d'))
+    assert negs == {('c', 'd'), ('a', 'd'), ('b', 'd')}
+    ls.delete(label('a', 'b'))
+    assert list(ls.connected_component('a')) == []
+    ls.delete_all()
+    assert list(ls.everything()) == []
+
+
+def test_latency_and_jitter():
+    slept = []
+    delay = Delay(latency={'get': 0.5}, jitter=0.1, seed=1,
+                  sleep=slept.append)
+    delay('get')
+    delay('put')
+    assert delay.calls == {'get': 1, 'put': 1}
+    assert 0.5 <= slept[0] <= 0.6
+    assert 0 <= slept[1] <= 0.1
+
+
+def test_calls_counted_across_threads():
+    delay = Delay(jitter=0.1, sleep=lambda secs: None)
+
+    def call():
+        for _ in xrange(1000):
+            delay('get')
+    threads = [threading.Thread(target=call) for _ in xrange(8)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert delay.calls['get'] == 8000
+
+
+def test_store_latency():
+    store = MemoryStore(latency=0.01)
+    store.put([('a', fc(u'alice'))])
+    ls = MemoryLabelStore(latency=0.01)
+    ls.put(label('a', 'b'), label('b', 'c'))
+    start = time.time()
+    list(store.index_scan(u'NAME', u'alice'))
+    list(ls.connected_component('a'))
+    assert time.time() - start >= 0.04
+    assert store.calls['index_scan'] == 1
+    assert ls.calls['directly_connected'] == 3
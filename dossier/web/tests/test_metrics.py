@@ -0,0 +1,114 @@
+from __future__ import absolute_import, division, print_function
+
+import bottle
+
+from dossier.web.builder import WebBuilder
+from dossier.web import metrics
+from dossier.web.memory import MemoryConfig
+from dossier.web.metrics import Registry
+from dossier.web.util import wsgi_request
+
+
+def samples(text):
+    values = {}
+    for line in text.splitlines():
+        if not line.startswith('#'):
+            name, value = line.rsplit(' ', 1)
+            values[name] = float(value)
+    return values
+
+
+def test_render():
+    reg = Registry()
+    reg.counter('hits_total', 'Hits.', labels=('path',)).labels('/a"b').inc()
+    hist = reg.histogram('secs', 'Seconds.', buckets=(0.1, 1))
+    hist.labels().observe(0.05)
+    hist.labels().observe(0.5)
+    hist.labels().observe(5)
+    text = reg.render()
+    assert '# TYPE hits_total counter' in text
+    assert '# TYPE secs histogram' in text
+    values = samples(text)
+    assert values['hits_total{path="/a\\"b"}'] == 1
+    assert values['secs_bucket{le="0.1"}'] == 1
+    assert values['secs_bucket{le="1"}'] == 2
+    assert values['secs_bucket{le="+Inf"}'] == 3
+    assert values['secs_count'] == 3
+    assert values['secs_sum'] == 5.55
+
+
+def test_same_metric_returned():
+    reg = Registry()
+    assert reg.counter('a', 'A.') is reg.counter('a', 'A.')
+
+
+def test_requests_and_backends():
+    routes = bottle.Bottle()
+
+    @routes.get('/test/store/<cid>')
+    def store_route(store, cid):
+        store.get(cid)
+        return list(store.scan_ids())
+
+    @routes.get('/test/fail')
+    def fail_route():
+        raise ValueError('oops')
+
+    app = (WebBuilder()
+           .set_config(MemoryConfig())
+           .add_routes(routes)
+           .enable_metrics()
+           .get_app())
+
+    def scrape():
+        status, headers, body = wsgi_request(app, 'GET', '/dossier/v1/metrics')
+        assert status == 200
+        assert headers['Content-Type'].startswith('text/plain')
+        return samples(body)
+
+    before = scrape()
+    assert wsgi_request(app, 'GET', '/test/store/x')[0] == 200
+    assert wsgi_request(app, 'GET', '/test/fail')[0] == 500
+    after = scrape()
+
+    def delta(name):
+        return after.get(name, 0) - before.get(name, 0)
+
+    ok = ('dossier_web_requests_total'
+          '{route="/test/store/<cid>",method="GET",status="200"}')
+    assert delta(ok) == 1
+    assert delta('dossier_web_request_errors_total'
+                 '{route="/test/fail",method="GET"}') == 1
+    assert delta('dossier_web_request_seconds_count'
+                 '{route="/test/store/<cid>"}') == 1
+    assert delta('dossier_web_backend_seconds_count'
+                 '{service="store",method="get"}') == 1
+    assert delta('dossier_web_backend_seconds_count'
+                 '{service="store",method="scan_ids"}') == 1
+    assert after['dossier_web_active_requests'] == 1
+
+
+def test_returned_response_status():
+    app = (WebBuilder()
+           .set_config(MemoryConfig())
+           .enable_metrics()
+           .get_app())
+    name = ('dossier_web_requests_total'
+            '{route="/dossier/v1/static/<name:path>",method="GET",'
+            'status="404"}')
+
+    def count():
+        _, _, body = wsgi_request(app, 'GET', '/dossier/v1/metrics')
+        return samples(body).get(name, 0)
+
+    before = count()
+    status, _, _ = wsgi_request(app, 'GET', '/dossier/v1/static/missing.js')
+    assert status == 404
+    assert count() == before + 1
+
+
+def test_cache_lookups():
+    counter = metrics.CACHE_REQUESTS.labels('test', 'hit')
+    before = counter.value
+    metrics.cache_lookup('test', True)
+    assert counter.value == before + 1
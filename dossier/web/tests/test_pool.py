@@ -0,0 +1,136 @@
+from __future__ import absolute_import, division, print_function
+
+import itertools
+import threading
+
+import bottle
+import pytest
+
+from dossier.web.builder import WebBuilder
+from dossier.web.config import Config
+from dossier.web.pool import Pool, PoolTimeout
+from dossier.web.util import wsgi_request
+
+
+class Client(object):
+    def __init__(self, ident):
+        self.ident = ident
+        self.healthy = True
+        self.closed = False
+
+    def ping(self):
+        return self.healthy
+
+    def close(self):
+        self.closed = True
+
+
+def new_pool(**kwargs):
+    idents = itertools.count()
+    return Pool(lambda: Client(next(idents)), check=Client.ping, **kwargs)
+
+
+def test_reuse():
+    pool = new_pool(size=2)
+    c = pool.checkout()
+    pool.checkin(c)
+    assert pool.checkout() is c
+    assert pool.stats()['clients'] == 1
+
+
+def test_bounded():
+    pool = new_pool(size=2, timeout=0.05)
+    _, c2 = pool.checkout(), pool.checkout()
+    with pytest.raises(PoolTimeout):
+        pool.checkout()
+
+    got = []
+    waiter = threading.Thread(target=lambda: got.append(pool.checkout()))
+    pool.timeout = 5
+    waiter.start()
+    pool.checkin(c2)
+    waiter.join()
+    assert got == [c2]
+    assert pool.stats() == {'size': 2, 'clients': 2, 'idle': 0,
+                            'in_use': 2, 'waiting': 0}
+
+
+def test_health_check():
+    pool = new_pool(check_idle=0)
+    c = pool.checkout()
+    c.healthy = False
+    pool.checkin(c)
+    c2 = pool.checkout()
+    assert c2 is not c
+    assert c.closed
+    assert pool.stats()['clients'] == 1
+
+
+def test_recycle_idle():
+    pool = new_pool(max_idle=0)
+    c = pool.checkout()
+    pool.checkin(c)
+    assert pool.checkout() is not c
+    assert c.closed
+
+
+def test_create_failure_frees_slot():
+    pool = Pool(lambda: 1 / 0, size=1, timeout=0)
+    for _ in xrange(2):
+        with pytest.raises(ZeroDivisionError):
+            pool.checkout()
+    assert pool.stats()['clients'] == 0
+
+
+class PooledConfig(Config):
+    def __init__(self):
+        super(PooledConfig, self).__init__(config={
+            'service_mode': 'pooled', 'pool_size': 1, 'pool_timeout': 0.05,
+        })
+        self.idents = itertools.count()
+
+    def new_store(self):
+        return Client(next(self.idents))
+
+
+def test_pooled_config_release():
+    config = PooledConfig()
+    routes = bottle.Bottle()
+
+    @routes.get('/store')
+    def store(store):
+        return str(store.ident)
+
+    @routes.get('/stream')
+    def stream(store):
+        yield 'a'
+        yield str(store.ident)
+
+    app = (WebBuilder(add_default_routes=False)
+           .add_routes(routes)
+           .set_config(config)
+           .get_app())
+    # With a pool of one, the second request only succeeds if the
+    # first one released its store.
+    for path, body in [('/store', '0'), ('/store', '0'), ('/stream', 'a0'),
+                       ('/store', '0')]:
+        status, _, rbody = wsgi_request(app, 'GET', path)
+        assert (status, rbody) == (200, body)
+    assert config.pool_stats()['store']['in_use'] == 0
+
+    # Another thread holding the only store makes requests fail fast.
+    holding, done = threading.Event(), threading.Event()
+
+    def hold():
+        assert config.store is not None
+        holding.set()
+        done.wait()
+        config.release()
+    holder = threading.Thread(target=hold)
+    holder.start()
+    holding.wait()
+    status, _, _ = wsgi_request(app, 'GET', '/store')
+    done.set()
+    holder.join()
+    assert status == 503
+    assert wsgi_request(app, 'GET', '/store')[0] == 200
@@ -0,0 +1,83 @@
+from __future__ import absolute_import, division, print_function
+
+import os
+import time
+
+import bottle
+
+from dossier.web.builder import WebBuilder
+from dossier.web.config import Config
+from dossier.web.profiling import Sampler
+from dossier.web.util import wsgi_request
+
+
+def slow_function():
+    end = time.time() + 0.05
+    while time.time() < end:
+        pass
+    return 'done'
+
+
+def new_app(**kwargs):
+    routes = bottle.Bottle()
+
+    @routes.get('/test/slow')
+    def slow_route():
+        return slow_function()
+
+    return (WebBuilder()
+            .set_config(Config(config={}))
+            .add_routes(routes)
+            .enable_profiling('secret', **kwargs)
+            .get_app())
+
+
+def test_sampler():
+    sampler = Sampler(interval=0.001).start()
+    slow_function()
+    sampler.stop()
+    assert 'slow_function' in sampler.collapsed()
+    for line in sampler.collapsed().splitlines():
+        stack, count = line.rsplit(' ', 1)
+        assert int(count) > 0
+
+
+def test_not_profiled_without_param():
+    status, _, body = wsgi_request(new_app(), 'GET', '/test/slow')
+    assert (status, body) == (200, 'done')
+
+
+def test_token_required():
+    app = new_app()
+    status, _, _ = wsgi_request(app, 'GET', '/test/slow', query='_profile=1')
+    assert status == 403
+    status, _, _ = wsgi_request(app, 'GET', '/test/slow', query='_profile=1',
+                                headers={'X-Profile-Token': 'wrong'})
+    assert status == 403
+
+
+def test_summary_and_collapsed():
+    app = new_app()
+    headers = {'X-Profile-Token': 'secret'}
+    status, _, body = wsgi_request(app, 'GET', '/test/slow',
+                                   query='_profile=1', headers=headers)
+    assert status == 200
+    assert 'cumulative' in body
+    assert 'slow_function' in body
+
+    status, _, body = wsgi_request(app, 'GET', '/test/slow',
+                                   query='_profile=collapsed',
+                                   headers=headers)
+    assert status == 200
+    assert 'slow_function' in body
+
+
+def test_save(tmpdir):
+    app = new_app(directory=str(tmpdir))
+    status, headers, body = wsgi_request(
+        app, 'GET', '/test/slow', query='_profile=save',
+        headers={'X-Profile-Token': 'secret'})
+    assert (status, body) == (200, 'done')
+    path = headers['X-Profile']
+    for ext in ['.prof', '.txt', '.collapsed']:
+        assert os.path.exists(path + ext)
@@ -2,13 +2,27 @@ from __future__ import absolute_import, division, print_function
 
 import json
 from cStringIO import StringIO
+import threading
+import time
 import urllib
 
+import uuid
+
 import bottle
+import cbor
+import pytest
 
 from dossier.fc import FeatureCollection
+from dossier.web.builder import WebBuilder
+from dossier.web.config import Config
+from dossier.web.memory import MemoryConfig, MemoryStore
 import dossier.web.routes as routes
-from dossier.web.tests import config_local, kvl, store, label_store  # noqa
+from dossier.web.tests import \
+    config_local, kvl, store, label_store, versions, \
+    fake_config, FakeStore  # noqa
+from dossier.web.util import wsgi_request
+from dossier.web.versions import Versions
+import kvlayer
 
 
 def rot14(s):
@@ -38,15 +52,336 @@ def new_response():
     return bottle.Response()
 
 
-def test_fc_put(store):  # noqa
+def one_at_a_time(fun):
+    '''Wrap ``fun`` so that it fails if two calls overlap.'''
+    lock = threading.Lock()
+
+    def _(*args):
+        if not lock.acquire(False):
+            raise AssertionError('calls overlap')
+        try:
+            time.sleep(0.01)
+            return fun(*args)
+        finally:
+            lock.release()
+    return _
+
+
+def test_fc_put(store, versions):  # noqa
     req = new_request(body=json.dumps({'foo': {'a': 1}}))
     resp = new_response()
-    routes.v1_fc_put(req, resp, visid_to_dbid, store, 'abc')
+    routes.v1_fc_put(req, resp, visid_to_dbid, store, versions, 'abc')
 
     assert store.get(visid_to_dbid('abc'))['foo']['a'] == 1
 
 
-def test_fc_get(store):  # noqa
+def test_fc_get(store, versions):  # noqa
     store.put([(visid_to_dbid('abc'), FeatureCollection({'foo': {'a': 1}}))])
-    fc = routes.v1_fc_get(dbid_to_visid, store, 'abc')
+    fc = routes.v1_fc_get(new_request(), new_response(), dbid_to_visid,
+                          store, versions, 'abc')
     assert fc['foo']['a'] == 1
+
+
+def test_fc_cbor(fake_config):  # noqa
+    app = WebBuilder().set_config(fake_config).get_app()
+    url = '/dossier/v1/feature-collection/abc'
+    body = cbor.dumps({u'foo': {u'a': 1}})
+    status, _, _ = wsgi_request(app, 'PUT', url, body=body,
+                                headers={'Content-Type': 'application/cbor'})
+    assert status == 201
+    assert fake_config.store['abc'][u'foo'][u'a'] == 1
+
+    status, headers, body = wsgi_request(
+        app, 'GET', url, headers={'Accept': 'application/cbor'})
+    assert status == 200
+    assert headers['Content-Type'] == 'application/cbor'
+    assert cbor.loads(body) == {u'foo': {u'a': 1}}
+
+    _, json_headers, _ = wsgi_request(app, 'GET', url)
+    assert headers['ETag'] != json_headers['ETag']
+
+
+def test_label_direct_cbor(fake_config):  # noqa
+    app = WebBuilder().set_config(fake_config).get_app()
+    status, _, _ = wsgi_request(app, 'PUT', '/dossier/v1/label/a/b/ann',
+                                body='1')
+    assert status == 201
+    status, headers, body = wsgi_request(
+        app, 'GET', '/dossier/v1/label/a/direct',
+        headers={'Accept': 'application/cbor'})
+    assert headers['Content-Type'] == 'application/cbor'
+    labels = cbor.loads(body)
+    assert len(labels) == 1
+    assert labels[0]['content_id1'] == u'a'
+    assert labels[0]['value'] == 1
+
+
+def test_fc_get_many(fake_config):  # noqa
+    app = WebBuilder().set_config(fake_config).get_app()
+    for cid in ['a', 'b', 'c']:
+        fake_config.store[cid] = FeatureCollection({'foo': {cid: 1}})
+    body = json.dumps({'content_ids': ['c', 'x', 'a']})
+    status, headers, body = wsgi_request(
+        app, 'POST', '/dossier/v1/feature-collections/get', body=body,
+        query='chunk_size=2')
+    assert status == 200
+    assert headers['Content-Type'] == 'application/x-ndjson'
+    recs = map(json.loads, body.splitlines())
+    assert [rec['content_id'] for rec in recs] == ['c', 'x', 'a']
+    assert recs[0]['fc']['foo'] == {'c': 1}
+    assert recs[1]['fc'] is None
+    assert recs[1]['error'] == 'not found'
+    assert recs[2]['fc']['foo'] == {'a': 1}
+
+
+def test_fc_get_many_feature_names(fake_config):  # noqa
+    app = WebBuilder().set_config(fake_config).get_app()
+    fake_config.store['a'] = FeatureCollection({'foo': {'a': 1},
+                                                'bar': {'b': 1}})
+    body = json.dumps({'content_ids': ['a'], 'feature_names': ['bar']})
+    status, _, body = wsgi_request(
+        app, 'POST', '/dossier/v1/feature-collections/get', body=body)
+    assert status == 200
+    assert json.loads(body)['fc'] == {'bar': {'b': 1}}
+
+
+@pytest.mark.parametrize(('query', 'calls'), [
+    ('', 3),
+    ('chunk_size=50', 5),
+    ('chunk_size=250', 1),
+    ('chunk_size=5000', 1),
+])
+def test_fc_get_many_chunk_size(query, calls):
+    config = MemoryConfig(store=MemoryStore())
+    app = WebBuilder().set_config(config).get_app()
+    body = json.dumps({'content_ids': [str(i) for i in xrange(250)]})
+    status, _, body = wsgi_request(
+        app, 'POST', '/dossier/v1/feature-collections/get', body=body,
+        query=query)
+    assert status == 200
+    assert len(body.splitlines()) == 250
+    assert config.store.calls['get_many'] == calls
+
+
+def test_fc_get_many_cbor(fake_config):  # noqa
+    app = WebBuilder().set_config(fake_config).get_app()
+    fake_config.store['a'] = FeatureCollection({'foo': {'a': 1}})
+    status, headers, body = wsgi_request(
+        app, 'POST', '/dossier/v1/feature-collections/get',
+        body=cbor.dumps(['a', 'a']),
+        headers={'Content-Type': 'application/cbor',
+                 'Accept': 'application/cbor'})
+    assert headers['Content-Type'] == 'application/cbor-seq'
+    stream = StringIO(body)
+    recs = [cbor.load(stream), cbor.load(stream)]
+    assert recs[0] == recs[1] == {'content_id': 'a', 'fc': {'foo': {'a': 1}}}
+
+
+def test_fc_get_many_bad_request(fake_config):  # noqa
+    app = WebBuilder().set_config(fake_config).get_app()
+    status, _, _ = wsgi_request(
+        app, 'POST', '/dossier/v1/feature-collections/get',
+        body=json.dumps({'content_ids': 'a'}))
+    assert status == 400
+    for body in ['\x9f', '\xff']:
+        status, _, _ = wsgi_request(
+            app, 'POST', '/dossier/v1/feature-collections/get', body=body,
+            headers={'Content-Type': 'application/cbor'})
+        assert status == 400
+
+
+def test_fc_put_many(fake_config):  # noqa
+    app = WebBuilder().set_config(fake_config).get_app()
+    lines = [
+        json.dumps({'content_id': 'a', 'fc': {'foo': {'a': 1}}}),
+        '',
+        json.dumps(['b', {'foo': {'b': 1}}]),
+        'not json',
+        json.dumps({'content_id': 'c'}),
+        json.dumps({'content_id': 'd', 'fc': {'foo': {'d': 1}}}),
+    ]
+    status, _, body = wsgi_request(
+        app, 'POST', '/dossier/v1/feature-collections/put',
+        body='\n'.join(lines), query='batch_size=2')
+    assert status == 200
+    result = json.loads(body)
+    assert result['records'] == 5
+    assert result['written'] == 3
+    assert result['error_count'] == 2
+    assert [e['index'] for e in result['errors']] == [2, 3]
+    assert sorted(fake_config.store) == ['a', 'b', 'd']
+    assert fake_config.store['d']['foo'] == {'d': 1}
+
+
+def test_fc_put_many_write_errors(fake_config):  # noqa
+    def put(items):
+        raise IOError('store is down')
+    fake_config.store.put = put
+    app = (WebBuilder()
+           .set_config(fake_config)
+           .set_visid_to_dbid(visid_to_dbid)
+           .get_app())
+    status, _, body = wsgi_request(
+        app, 'POST', '/dossier/v1/feature-collections/put',
+        body=json.dumps(['abc', {'foo': {'a': 1}}]))
+    assert status == 200
+    result = json.loads(body)
+    assert result['written'] == 0
+    assert [(e['index'], e['content_id']) for e in result['errors']] \
+        == [(0, 'abc')]
+
+
+def put_many_body(cids):
+    return '\n'.join(json.dumps([cid, {'foo': {cid: 1}}]) for cid in cids)
+
+
+def test_fc_put_many_one_batch_at_a_time(fake_config):  # noqa
+    fake_config.store.put = one_at_a_time(fake_config.store.put)
+    app = WebBuilder().set_config(fake_config).get_app()
+    status, _, body = wsgi_request(
+        app, 'POST', '/dossier/v1/feature-collections/put',
+        body=put_many_body('abcd'), query='batch_size=1&max_in_flight=4')
+    result = json.loads(body)
+    assert result['errors'] == []
+    assert sorted(fake_config.store) == ['a', 'b', 'c', 'd']
+
+
+class PooledConfig(Config):
+    def __init__(self):
+        super(PooledConfig, self).__init__(config={
+            'service_mode': 'pooled', 'pool_size': 4,
+        })
+        self.stores = []
+
+    def new_store(self):
+        client = FakeStore()
+        client.put = one_at_a_time(client.put)
+        self.stores.append(client)
+        return client
+
+    def new_versions(self):
+        return Versions(kvlayer.client(
+            config={}, storage_type='local', app_name='diffeo',
+            namespace='dossier.web.tests.%s' % uuid.uuid4().hex))
+
+
+def test_fc_put_many_pooled_in_flight():
+    config = PooledConfig()
+    app = WebBuilder().set_config(config).get_app()
+    status, _, body = wsgi_request(
+        app, 'POST', '/dossier/v1/feature-collections/put',
+        body=put_many_body('abcdefgh'), query='batch_size=1&max_in_flight=3')
+    result = json.loads(body)
+    assert result['errors'] == []
+    assert result['written'] == 8
+    written = set()
+    for client in config.stores:
+        written.update(client)
+    assert sorted(written) == list('abcdefgh')
+    assert config.pool_stats()['store']['in_use'] == 0
+
+
+def test_fc_put_many_cbor(fake_config):  # noqa
+    app = WebBuilder().set_config(fake_config).get_app()
+    body = ''.join(cbor.dumps({'content_id': cid, 'fc': {'foo': {cid: 1}}})
+                   for cid in ['a', 'b', 'c'])
+    status, _, body = wsgi_request(
+        app, 'POST', '/dossier/v1/feature-collections/put', body=body,
+        headers={'Content-Type': 'application/cbor-seq'})
+    assert status == 200
+    assert json.loads(body)['written'] == 3
+    assert fake_config.store['b']['foo'] == {'b': 1}
+
+
+def test_fc_put_many_bumps_versions(fake_config):  # noqa
+    app = WebBuilder().set_config(fake_config).get_app()
+    fake_config.store['a'] = FeatureCollection({'foo': {'a': 1}})
+    get = '/dossier/v1/feature-collection/a'
+    _, headers, _ = wsgi_request(app, 'GET', get)
+    etag = headers['ETag']
+    wsgi_request(app, 'POST', '/dossier/v1/feature-collections/put',
+                 body=json.dumps(['a', {'foo': {'a': 2}}]))
+    _, headers, _ = wsgi_request(app, 'GET', get)
+    assert headers['ETag'] != etag
+
+
+def test_labels_put(fake_config):  # noqa
+    app = WebBuilder().set_config(fake_config).get_app()
+    labels = [
+        {'content_id1': 'a', 'content_id2': 'b', 'annotator_id': 'ann',
+         'value': 1},
+        {'content_id1': 'a', 'content_id2': 'c', 'annotator_id': 'ann',
+         'value': 2},
+        {'content_id1': 'c', 'content_id2': 'd', 'annotator_id': 'ann',
+         'value': -1, 'subtopic_id1': 's1'},
+        {'content_id1': 'e', 'annotator_id': 'ann', 'value': 0},
+    ]
+    status, _, body = wsgi_request(
+        app, 'POST', '/dossier/v1/labels/put', body=json.dumps(labels),
+        headers={'Content-Type': 'application/json'}, query='batch_size=1')
+    assert status == 200
+    result = json.loads(body)
+    assert result['records'] == 4
+    assert result['written'] == 2
+    assert [e['index'] for e in result['errors']] == [1, 3]
+
+    stored = sorted(fake_config.label_store.labels,
+                    key=lambda lab: lab.content_id1)
+    assert [(lab.content_id1, lab.content_id2) for lab in stored] \
+        == [('a', 'b'), ('c', 'd')]
+    assert stored[1].subtopic_id1 == 's1'
+    assert stored[1].value.value == -1
+
+
+def test_labels_put_ndjson(fake_config):  # noqa
+    app = WebBuilder().set_config(fake_config).get_app()
+    body = '\n'.join(
+        json.dumps({'content_id1': 'a', 'content_id2': cid,
+                    'annotator_id': 'ann', 'value': 1})
+        for cid in ['b', 'c', 'd'])
+    status, _, body = wsgi_request(
+        app, 'POST', '/dossier/v1/labels/put', body=body, query='batch_size=2')
+    assert json.loads(body)['written'] == 3
+    assert len(fake_config.label_store.labels) == 3
+
+
+def test_labels_put_write_errors(fake_config):  # noqa
+    def put(*labels):
+        raise IOError('label store is down')
+    fake_config.label_store.put = put
+    app = (WebBuilder()
+           .set_config(fake_config)
+           .set_visid_to_dbid(visid_to_dbid)
+           .get_app())
+    status, _, body = wsgi_request(
+        app, 'POST', '/dossier/v1/labels/put',
+        body=json.dumps({'content_id1': 'b', 'content_id2': 'a',
+                         'annotator_id': 'ann', 'value': 1}))
+    assert status == 200
+    result = json.loads(body)
+    assert result['written'] == 0
+    assert [(e['index'], e['content_id']) for e in result['errors']] \
+        == [(0, 'b')]
+
+
+def test_labels_put_one_batch_at_a_time(fake_config):  # noqa
+    fake_config.label_store.put = \
+        one_at_a_time(fake_config.label_store.put)
+    app = WebBuilder().set_config(fake_config).get_app()
+    body = '\n'.join(
+        json.dumps({'content_id1': 'a', 'content_id2': cid,
+                    'annotator_id': 'ann', 'value': 1})
+        for cid in ['b', 'c', 'd', 'e'])
+    status, _, body = wsgi_request(
+        app, 'POST', '/dossier/v1/labels/put', body=body, query='batch_size=1')
+    result = json.loads(body)
+    assert result['errors'] == []
+    assert result['written'] == 4
+
+
+def test_labels_put_bad_request(fake_config):  # noqa
+    app = WebBuilder().set_config(fake_config).get_app()
+    status, _, _ = wsgi_request(
+        app, 'POST', '/dossier/v1/labels/put', body='{}',
+        headers={'Content-Type': 'application/json'})
+    assert status == 400
@@ -1,6 +1,8 @@
 from __future__ import absolute_import, division, print_function
 
-from dossier.fc import FeatureCollection
+from dossier.fc import FeatureCollection, StringCounter
+from dossier.web.interface import Filter
+from dossier.web.memory import MemoryStore
 import dossier.web.search_engines as search_engines
 from dossier.web.tests import config_local, kvl, store  # noqa
 
@@ -9,3 +11,80 @@ def test_random_no_name_index(store):  # noqa
     store.put([('foo', FeatureCollection({u'NAME': {'bar': 1}}))])
     # just make sure it runs
     search_engines.random(store).set_query_id('foo').results()
+
+
+def memory_store(fcs):
+    mem = MemoryStore()
+    mem.put(sorted(fcs.items()))
+    return mem
+
+
+class odd_ids(Filter):
+    def create_predicate(self):
+        return lambda (cid, fc): int(cid) % 2 == 1
+
+
+class callable_even_ids(object):
+    '''A filter that isn't a `Filter`, and is also callable.'''
+    def set_query_id(self, query_content_id):
+        return self
+
+    def set_query_params(self, query_params):
+        return self
+
+    def create_predicate(self):
+        return lambda (cid, fc): int(cid) % 2 == 0
+
+    def __call__(self):
+        raise AssertionError('a filter is not a factory')
+
+
+def test_duck_typed_filter():
+    fcs = dict((str(i), FeatureCollection({u'NAME': StringCounter({u'a': 1})}))
+               for i in xrange(5))
+    engine = (search_engines.plain_index_scan(memory_store(fcs))
+              .set_query_id('0')
+              .set_query_params({'filter': 'even'})
+              .add_filter('even', callable_even_ids()))
+    results = engine.results()
+    assert sorted(r['content_id'] for r in results['results']) == ['2', '4']
+
+
+def test_plain_index_scan_explain():
+    both = StringCounter({u'a': 1, u'b': 1})
+    fcs = {'0': FeatureCollection({u'NAME': both})}
+    for i in xrange(1, 7):
+        fcs[str(i)] = FeatureCollection({u'NAME': StringCounter({u'a': 1})})
+    fcs['7'] = FeatureCollection({u'NAME': StringCounter({u'b': 1})})
+    engine = (search_engines.plain_index_scan(memory_store(fcs))
+              .set_query_id('0')
+              .set_query_params({'explain': '1', 'filter': 'odd',
+                                 'limit': '10'})
+              .add_filter('odd', odd_ids()))
+    results = engine.results()
+    assert sorted(r['content_id'] for r in results['results']) \
+        == ['1', '3', '5', '7']
+
+    explain = results['explain']
+    scans = dict(((s['index'], s['value']), s) for s in explain['scans'])
+    assert scans[(u'NAME', u'a')]['hits'] == 7
+    assert scans[(u'NAME', u'a')]['new'] == 6
+    assert scans[(u'NAME', u'b')]['hits'] == 2
+    assert scans[(u'NAME', u'b')]['new'] == 1
+    assert explain['counts']['fetched'] == 7
+    assert explain['counts']['sampled'] == 4
+    assert explain['counts']['results'] == 4
+    assert explain['filters'] == {'odd': 3}
+    assert 'recommend' in explain['seconds']
+    assert 'transform' in explain['seconds']
+
+
+def test_no_explain_by_default():
+    fcs = {'0': FeatureCollection({u'NAME': StringCounter({u'a': 1})}),
+           '1': FeatureCollection({u'NAME': StringCounter({u'a': 1})})}
+    engine = (search_engines.plain_index_scan(memory_store(fcs))
+              .set_query_id('0')
+              .set_query_params({}))
+    results = engine.results()
+    assert 'explain' not in results
+    assert [r['content_id'] for r in results['results']] == ['1']
@@ -0,0 +1,168 @@
+from __future__ import absolute_import, division, print_function
+
+import os
+import signal
+import socket
+import subprocess
+import sys
+import threading
+import time
+import urllib2
+
+from dossier.web.server import make_server
+
+
+def get(port, path='/'):
+    return urllib2.urlopen('http://127.0.0.1:%d%s' % (port, path),
+                           timeout=10).read()
+
+
+def test_threads_serve_concurrently():
+    unblocked = threading.Event()
+
+    def app(environ, start_response):
+        start_response('200 OK', [('Content-Type', 'text/plain')])
+        if environ['PATH_INFO'] == '/slow':
+            unblocked.wait(10)
+        return [environ['PATH_INFO']]
+
+    server = make_server('127.0.0.1', 0, app, threads=2)
+    t = threading.Thread(target=server.serve_forever,
+                         kwargs={'poll_interval': 0.05})
+    t.daemon = True
+    t.start()
+    try:
+        slow = []
+        slow_t = threading.Thread(
+            target=lambda: slow.append(get(server.server_port, '/slow')))
+        slow_t.start()
+        # A slow request doesn't block other requests.
+        assert get(server.server_port, '/fast') == '/fast'
+        unblocked.set()
+        slow_t.join()
+        assert slow == ['/slow']
+    finally:
+        unblocked.set()
+        server.shutdown()
+        server.drain()
+
+
+def test_accepts_only_when_a_thread_is_idle():
+    unblocked = threading.Event()
+
+    def app(environ, start_response):
+        start_response('200 OK', [('Content-Type', 'text/plain')])
+        unblocked.wait(10)
+        return [environ['PATH_INFO']]
+
+    server = make_server('127.0.0.1', 0, app, threads=1)
+    t = threading.Thread(target=server.serve_forever,
+                         kwargs={'poll_interval': 0.05})
+    t.daemon = True
+    t.start()
+    try:
+        got = []
+        clients = [threading.Thread(
+            target=lambda p=p: got.append(get(server.server_port, p)))
+            for p in ['/a', '/b']]
+        for c in clients:
+            c.start()
+        time.sleep(0.3)
+        # The second connection waits in the backlog, not in the server.
+        assert server.accepted == 1
+        unblocked.set()
+        for c in clients:
+            c.join()
+        assert sorted(got) == ['/a', '/b']
+        assert server.accepted == 2
+    finally:
+        unblocked.set()
+        server.shutdown()
+        server.drain()
+
+
+SERVE = '''
+import os, sys
+from dossier.web.server import serve
+
+def app(environ, start_response):
+    start_response('200 OK', [('Content-Type', 'text/plain')])
+    return [str(os.getpid())]
+
+serve(lambda: app, host='127.0.0.1', port=int(sys.argv[1]),
+      workers=2, threads=2, max_requests=3)
+'''
+
+
+def free_port():
+    sock = socket.socket()
+    sock.bind(('127.0.0.1', 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    return port
+
+
+def wait_for(port):
+    for _ in xrange(100):
+        try:
+            return get(port)
+        except Exception:
+            time.sleep(0.05)
+    raise AssertionError('server never started')
+
+
+def test_prefork_recycles_workers():
+    port = free_port()
+    proc = subprocess.Popen([sys.executable, '-c', SERVE, str(port)])
+    try:
+        pids = [wait_for(port)] + [get(port) for _ in xrange(11)]
+        # 12 requests can't all be served by two workers that are
+        # replaced every three requests.
+        assert len(set(pids)) >= 3
+        assert str(proc.pid) not in pids
+        os.kill(proc.pid, signal.SIGTERM)
+        assert proc.wait() == 0
+    finally:
+        if proc.poll() is None:
+            proc.kill()
+
+
+RELOADABLE = '''
+import os, sys
+from dossier.web.server import serve
+
+VERSION = open(sys.argv[2]).read()
+
+def app(environ, start_response):
+    start_response('200 OK', [('Content-Type', 'text/plain')])
+    return ['%s %d' % (VERSION, os.getppid())]
+
+serve(lambda: app, host='127.0.0.1', port=int(sys.argv[1]),
+      workers=2, threads=2)
+'''
+
+
+def test_sighup_reloads(tmpdir):
+    script, version = tmpdir.join('serve.py'), tmpdir.join('version')
+    script.write(RELOADABLE)
+    version.write('v1')
+    port = free_port()
+    proc = subprocess.Popen([sys.executable, str(script), str(port),
+                             str(version)])
+    try:
+        assert wait_for(port) == 'v1 %d' % proc.pid
+        version.write('v2')
+        os.kill(proc.pid, signal.SIGHUP)
+        # The supervisor runs the script again in the same process, and
+        # the socket stays open, so requests wait instead of failing.
+        for _ in xrange(100):
+            if get(port) == 'v2 %d' % proc.pid:
+                break
+            time.sleep(0.05)
+        else:
+            raise AssertionError('never reloaded')
+        os.kill(proc.pid, signal.SIGTERM)
+        assert proc.wait() == 0
+    finally:
+        if proc.poll() is None:
+            proc.kill()
@@ -0,0 +1,98 @@
+from __future__ import absolute_import, division, print_function
+
+import json
+import os
+
+import bottle
+
+from dossier.web.builder import WebBuilder
+from dossier.web.memory import MemoryConfig, MemoryStore
+from dossier.web.slowlog import RateLimit
+from dossier.web.util import wsgi_request
+
+
+class Clock(object):
+    def __init__(self):
+        self.now = 0
+
+    def __call__(self):
+        return self.now
+
+
+def new_app(path, threshold=0.01, max_per_minute=60):
+    routes = bottle.Bottle()
+
+    @routes.get('/test/slow/<cid>')
+    def slow_route(store, cid):
+        store.get(cid)
+        return 'x' * 10
+
+    @routes.get('/test/stream')
+    def stream_route(store):
+        store.get('a')
+        yield 'ab'
+        yield 'cd'
+
+    @routes.get('/test/fast')
+    def fast_route():
+        return 'fast'
+
+    return (WebBuilder()
+            .set_config(MemoryConfig(store=MemoryStore(latency={'get': 0.02})))
+            .add_routes(routes)
+            .enable_slow_log(threshold, path=path,
+                             max_per_minute=max_per_minute)
+            .get_app())
+
+
+def read_records(path):
+    with open(path) as f:
+        return [json.loads(line) for line in f]
+
+
+def test_rate_limit():
+    clock = Clock()
+    limit = RateLimit(2, clock=clock)
+    assert limit.take() == 0
+    assert limit.take() == 0
+    assert limit.take() is None
+    assert limit.take() is None
+    clock.now += 30
+    assert limit.take() == 2
+
+
+def test_slow_requests_logged(tmpdir):
+    path = str(tmpdir.join('slow.log'))
+    app = new_app(path)
+    assert wsgi_request(app, 'GET', '/test/fast')[0] == 200
+    assert wsgi_request(app, 'GET', '/test/slow/abc')[0] == 200
+    assert wsgi_request(app, 'GET', '/test/stream')[0] == 200
+
+    records = read_records(path)
+    assert len(records) == 2
+    slow, stream = records
+    assert slow['route'] == '/test/slow/<cid>'
+    assert slow['status'] == 200
+    assert slow['bytes'] == 10
+    assert slow['seconds'] >= 0.01
+    assert slow['backends']['store']['calls'] == 1
+    assert slow['suppressed'] == 0
+    assert stream['bytes'] == 4
+
+
+def test_log_storms_suppressed(tmpdir):
+    path = str(tmpdir.join('slow.log'))
+    app = new_app(path, max_per_minute=1)
+    for _ in xrange(3):
+        wsgi_request(app, 'GET', '/test/slow/abc')
+    assert len(read_records(path)) == 1
+
+
+def test_moved_log_reopened(tmpdir):
+    path = str(tmpdir.join('slow.log'))
+    app = new_app(path)
+    wsgi_request(app, 'GET', '/test/slow/abc')
+    os.rename(path, path + '.1')
+    wsgi_request(app, 'GET', '/test/slow/abc')
+    assert len(read_records(path + '.1')) == 1
+    assert len(read_records(path)) == 1
@@ -1,10 +1,11 @@
 from __future__ import absolute_import, division, print_function
 
 import json
+import threading
 import time
 import urllib
 
-from dossier.web.tags import TagsSync
+from dossier.web.tags import Tags, TagsSync
 import dossier.web.tags as tag_routes
 from dossier.web.tests.test_routes import new_request
 import pytest
@@ -34,6 +35,36 @@ def tags(elastic_address, namespace_string):
     x.delete_all()
 
 
+def test_schema_checks_of_other_indexes_dont_wait(monkeypatch):
+    checking, unblocked = threading.Event(), threading.Event()
+    checked = []
+
+    def create_schema(self):
+        if self.index == 'tags_slow':
+            checking.set()
+            unblocked.wait()
+        checked.append(self.index)
+    monkeypatch.setattr(Tags, '_create_schema', create_schema)
+
+    slow = threading.Thread(target=Tags, kwargs={
+        'hosts': ['localhost:1'], 'namespace': 'slow'})
+    slow.start()
+    try:
+        checking.wait()
+        fast = threading.Thread(target=Tags, kwargs={
+            'hosts': ['localhost:1'], 'namespace': 'fast'})
+        fast.start()
+        fast.join(5)
+        assert checked == ['tags_fast']
+    finally:
+        unblocked.set()
+        slow.join()
+    assert checked == ['tags_fast', 'tags_slow']
+    # Each schema is only checked once.
+    Tags(hosts=['localhost:1'], namespace='fast')
+    assert checked == ['tags_fast', 'tags_slow']
+
+
 def test_tag_associate(tags):
     req = new_request(body=json.dumps(DUMMY_ASSOC))
     tag_routes.v1_tag_associate(req, tags, 'foo/bar/baz')
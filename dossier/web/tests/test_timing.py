@@ -0,0 +1,130 @@
+from __future__ import absolute_import, division, print_function
+
+import bottle
+
+from dossier.fc import FeatureCollection
+from dossier.label import Label
+from dossier.web.builder import WebBuilder
+from dossier.web.executor import Executor
+from dossier.web.interface import SearchEngine
+from dossier.web.memory import MemoryConfig, MemoryLabelStore, MemoryStore
+from dossier.web.util import wsgi_request
+from dossier.web import timing
+
+
+def new_store():
+    store = MemoryStore()
+    store.put((cid, FeatureCollection({u'NAME': {cid: 1}}))
+              for cid in ['a', 'b', 'c'])
+    return store
+
+
+class one_result(SearchEngine):
+    def __init__(self, store):
+        super(one_result, self).__init__()
+        self.store = store
+
+    def recommendations(self):
+        cid = next(self.store.scan_ids())
+        return {'results': [(cid, self.store.get(cid))]}
+
+
+def parse_header(value):
+    metrics = {}
+    for metric in value.split(', '):
+        parts = metric.split(';')
+        metrics[parts[0]] = dict(p.split('=', 1) for p in parts[1:])
+    return metrics
+
+
+def test_timed_service():
+    store = timing.timed('store', new_store())
+    assert timing.timed('versions', store) is store
+    assert timing.timed('store', None) is None
+    assert store.indexes == [u'NAME']
+    label_store = timing.timed('label_store', MemoryLabelStore())
+    label_store.put(Label('a', 'b', 'x', 1), Label('a', 'c', 'x', 1))
+
+    # Not timed outside of a request.
+    assert list(store.scan_ids()) == ['a', 'b', 'c']
+
+    timings = timing.Timings()
+    timing.set_current(timings)
+    try:
+        store.get('a')
+        store.get('b')
+        assert len(list(label_store.everything())) == 2
+        with timing.phase('work'):
+            pass
+    finally:
+        timing.set_current(None)
+    spent = timings.to_dict()
+    assert spent['store']['calls'] == 2
+    # Iterating over the generator isn't counted as more calls.
+    assert spent['label_store']['calls'] == 1
+    assert spent['work']['calls'] == 1
+    header = parse_header(timings.header())
+    assert header['store']['desc'] == '"2 calls"'
+    assert 'total' in header
+
+
+def test_executor_counts_towards_request():
+    store = timing.timed('store', new_store())
+    timings = timing.Timings()
+    timing.set_current(timings)
+    try:
+        Executor(max_workers=1).submit(store.get, 'a').result()
+    finally:
+        timing.set_current(None)
+    assert timings.to_dict()['store']['calls'] == 1
+
+
+def test_server_timing_header():
+    app = (WebBuilder()
+           .set_config(MemoryConfig(store=new_store()))
+           .add_search_engine('one', one_result)
+           .enable_timing()
+           .get_app())
+    status, headers, _ = wsgi_request(
+        app, 'GET', '/dossier/v1/feature-collection/q/search/one')
+    assert status == 200
+    metrics = parse_header(headers['Server-Timing'])
+    for name in ['store', 'recommend', 'transform', 'encode', 'total']:
+        assert name in metrics
+    assert float(metrics['store']['dur']) >= 0
+
+
+def test_no_header_by_default():
+    app = (WebBuilder()
+           .set_config(MemoryConfig(store=new_store()))
+           .add_search_engine('one', one_result)
+           .get_app())
+    status, headers, _ = wsgi_request(
+        app, 'GET', '/dossier/v1/feature-collection/q/search/one')
+    assert status == 200
+    assert 'Server-Timing' not in headers
+
+
+def test_header_on_raised_response():
+    routes = bottle.Bottle()
+
+    @routes.get('/test/cached')
+    def cached_route(store):
+        store.get('a')
+        raise bottle.HTTPResponse(status=304)
+
+    @routes.get('/test/missing')
+    def missing_route():
+        bottle.abort(404, 'no')
+
+    app = (WebBuilder()
+           .set_config(MemoryConfig(store=new_store()))
+           .add_routes(routes)
+           .enable_timing()
+           .get_app())
+    status, headers, _ = wsgi_request(app, 'GET', '/test/cached')
+    assert status == 304
+    assert 'store' in parse_header(headers['Server-Timing'])
+    status, headers, _ = wsgi_request(app, 'GET', '/test/missing')
+    assert status == 404
+    assert 'total' in parse_header(headers['Server-Timing'])
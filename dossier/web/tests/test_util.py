@@ -0,0 +1,111 @@
+from __future__ import absolute_import, division, print_function
+
+import json
+import random
+import time
+
+import bottle
+import cbor
+
+from dossier.fc import FeatureCollection, GeoCoords, StringCounter
+
+from dossier.web import util
+
+
+def random_word(n=8):
+    return u''.join(random.choice(u'abcdefghijklmnopqrstuvwxyz')
+                    for _ in xrange(n))
+
+
+def realistic_fc():
+    fc = FeatureCollection()
+    fc[u'NAME'] = StringCounter({random_word(): 1 for _ in xrange(5)})
+    fc[u'title'] = u' '.join(random_word() for _ in xrange(10))
+    fc[u'bowNP'] = StringCounter({random_word(): random.randint(1, 20)
+                                  for _ in xrange(200)})
+    fc[u'bowNP_sip'] = StringCounter({random_word(): random.randint(1, 5)
+                                      for _ in xrange(100)})
+    fc[u'email'] = StringCounter({random_word() + u'@example.com': 1
+                                  for _ in xrange(3)})
+    nhash = '%064x' % random.getrandbits(256)
+    fc[u'#nilsimsa_all'] = StringCounter({nhash: 1})
+    fc[FeatureCollection.GEOCOORDS_PREFIX + 'both_co_LOC_1'] = GeoCoords({
+        random_word(): [(random.uniform(-90, 90), random.uniform(-90, 90),
+                         0.0, 1420070400.0)],
+    })
+    return fc
+
+
+def search_payload(n=100):
+    return {'results': [{'content_id': 'web|%d' % i,
+                         'fc': util.fc_to_json(realistic_fc())}
+                        for i in xrange(n)]}
+
+
+def test_json_compact_by_default():
+    assert util.JsonEncoder(['json']).dumps({'a': [1, 2]}) == '{"a":[1,2]}'
+
+
+def test_json_pretty():
+    assert util.JsonEncoder(['json']).dumps([1], pretty=True) == '[\n  1\n]'
+
+
+def test_json_missing_backend():
+    encoder = util.JsonEncoder(['no_such_json_module'])
+    assert encoder.backend == 'json'
+    assert encoder.dumps({'a': 1}) == '{"a":1}'
+
+
+def test_json_roundtrip_fc():
+    payload = search_payload(5)
+    assert json.loads(util.json_dumps(payload)) == json.loads(
+        json.dumps(payload))
+
+
+def test_json_serialization_speed_perf():
+    payload = search_payload()
+    n = 20
+    encoders = [
+        ('json indent=2', lambda obj: json.dumps(obj, indent=2)),
+        ('json compact', util.JsonEncoder(['json']).dumps),
+        (util.json_encoder.backend, util.json_encoder.dumps),
+    ]
+    ujson = util.JsonEncoder(['ujson'])
+    if ujson.backend == 'ujson':
+        encoders.append(('ujson', ujson.dumps))
+    for name, dumps in encoders:
+        start = time.time()
+        for _ in xrange(n):
+            encoded = dumps(payload)
+        elapsed = time.time() - start
+        print('%s: %d bytes, %d encodings in %f seconds, %f per second' % (
+            name, len(encoded), n, elapsed, n / elapsed))
+
+
+def new_request(accept):
+    return bottle.Request(environ={'HTTP_ACCEPT': accept})
+
+
+def test_negotiate_format():
+    assert util.negotiate_format(new_request('')) == 'json'
+    assert util.negotiate_format(new_request('*/*')) == 'json'
+    assert util.negotiate_format(new_request('application/cbor')) == 'cbor'
+    assert util.negotiate_format(
+        new_request('application/json, application/cbor')) == 'json'
+    assert util.negotiate_format(
+        new_request('application/cbor, */*;q=0.5')) == 'cbor'
+    assert util.negotiate_format(
+        new_request('application/cbor;q=0.5, application/json')) == 'json'
+
+
+def test_cbor_text_strings():
+    fc = util.fc_to_json(realistic_fc())
+    payload = {'results': [{'content_id': 'abc', 'fc': fc}]}
+    decoded = cbor.loads(util.cbor_dumps(payload))
+    assert decoded == json.loads(json.dumps(payload))
+    assert isinstance(decoded['results'][0]['content_id'], unicode)
+
+
+def test_chunks():
+    assert list(util.chunks(xrange(5), 2)) == [[0, 1], [2, 3], [4]]
+    assert list(util.chunks([], 2)) == []
@@ -0,0 +1,102 @@
+from __future__ import absolute_import, division, print_function
+
+import json
+
+import pytest
+
+from dossier.fc import FeatureCollection
+from dossier.label import CorefValue, Label
+
+from dossier.web.builder import WebBuilder
+from dossier.web.tests import fake_config  # noqa
+from dossier.web.util import wsgi_request
+from dossier.web.versions import Versions, etag_matches
+
+
+@pytest.fixture
+def app(fake_config):  # noqa
+    return WebBuilder().set_config(fake_config).get_app()
+
+
+def get(app, path, etag=None):
+    headers = {} if etag is None else {'If-None-Match': etag}
+    return wsgi_request(app, 'GET', path, headers=headers)
+
+
+def test_versions(fake_config):  # noqa
+    versions = fake_config.versions
+    v1 = versions.get(Versions.FC, 'abc')
+    assert v1 == versions.get(Versions.FC, 'abc')
+    versions.bump(Versions.FC, 'abc')
+    v2 = versions.get(Versions.FC, 'abc')
+    assert v2 != v1
+    assert v2 == versions.get(Versions.FC, 'abc')
+    versions.bump(Versions.FC, 'abc')
+    assert versions.get(Versions.FC, 'abc') not in (v1, v2)
+
+
+def test_versions_reads_do_not_write(fake_config):  # noqa
+    versions = fake_config.versions
+    assert versions.get(Versions.FC, 'abc') == Versions.INITIAL
+    assert versions.etag(Versions.LABEL_GRAPH) == '"label_graph-0"'
+    assert list(fake_config.kvlclient.scan_keys(Versions.TABLE)) == []
+
+
+def test_etag_matches():
+    assert etag_matches('"a"', '"a"')
+    assert etag_matches('"b", W/"a"', '"a"')
+    assert etag_matches('*', '"a"')
+    assert not etag_matches('', '"a"')
+    assert not etag_matches('"b"', '"a"')
+
+
+def test_fc_conditional_get(app, fake_config):  # noqa
+    fake_config.store['abc'] = FeatureCollection({'foo': {'a': 1}})
+    status, headers, body = get(app, '/dossier/v1/feature-collection/abc')
+    assert status == 200
+    assert json.loads(body)['foo'] == {'a': 1}
+    etag = headers['ETag']
+
+    status, headers, body = get(
+        app, '/dossier/v1/feature-collection/abc', etag=etag)
+    assert status == 304
+    assert body == ''
+    assert headers['ETag'] == etag
+
+    fc = json.dumps({'foo': {'b': 2}})
+    status, _, _ = wsgi_request(
+        app, 'PUT', '/dossier/v1/feature-collection/abc', body=fc)
+    assert status == 201
+    status, headers, body = get(
+        app, '/dossier/v1/feature-collection/abc', etag=etag)
+    assert status == 200
+    assert json.loads(body)['foo'] == {'b': 2}
+    assert headers['ETag'] != etag
+
+
+def test_label_conditional_get(app, fake_config):  # noqa
+    fake_config.label_store.put(Label('a', 'b', 'ann', CorefValue.Positive))
+    direct, connected = [('/dossier/v1/label/%s/' % cid) + kind
+                         for cid, kind in [('a', 'direct'),
+                                           ('c', 'connected')]]
+    _, headers, _ = get(app, direct)
+    direct_etag = headers['ETag']
+    _, headers, _ = get(app, connected)
+    connected_etag = headers['ETag']
+
+    reads = fake_config.label_store.reads
+    assert get(app, direct, etag=direct_etag)[0] == 304
+    assert get(app, connected, etag=connected_etag)[0] == 304
+    assert fake_config.label_store.reads == reads
+
+    status, _, _ = wsgi_request(app, 'PUT', '/dossier/v1/label/c/d/ann',
+                                body='1')
+    assert status == 201
+    # A label between `c` and `d` doesn't change `a`'s direct labels,
+    # but it may change any connected component.
+    assert get(app, direct, etag=direct_etag)[0] == 304
+    assert get(app, connected, etag=connected_etag)[0] == 200
+
+    status, _, _ = wsgi_request(app, 'PUT', '/dossier/v1/label/a/c/ann',
+                                body='1')
+    assert get(app, direct, etag=direct_etag)[0] == 200
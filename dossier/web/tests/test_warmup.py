@@ -0,0 +1,82 @@
+from __future__ import absolute_import, division, print_function
+
+import itertools
+import json
+import threading
+
+from dossier.web.builder import WebBuilder
+from dossier.web.config import Config
+from dossier.web.util import wsgi_request
+
+
+class SlowConfig(Config):
+    def __init__(self, **config):
+        super(SlowConfig, self).__init__(config=config)
+        self.unblocked = threading.Event()
+        self.idents = itertools.count()
+
+    def new_store(self):
+        self.unblocked.wait()
+        return next(self.idents)
+
+
+def ready(app):
+    status, _, body = wsgi_request(app, 'GET', '/dossier/v1/ready')
+    return status, json.loads(body)
+
+
+def test_ready_without_warmup():
+    config = SlowConfig()
+    app = WebBuilder().set_config(config).get_app()
+    status, body = ready(app)
+    assert status == 200
+    assert body['ready']
+    # No service was created.
+    assert next(config.idents) == 0
+
+
+def test_ready_after_warmup():
+    config = SlowConfig(warmup_services=['store'])
+    builder = WebBuilder().set_config(config).enable_warmup()
+    app = builder.get_app()
+    status, body = ready(app)
+    assert status == 503
+    assert not body['ready']
+
+    config.unblocked.set()
+    builder.warmup.finished_event.wait(5)
+    status, body = ready(app)
+    assert status == 200
+    assert body == {'ready': True, 'seconds': body['seconds'], 'errors': []}
+
+
+def test_warmup_fills_pools():
+    config = SlowConfig(service_mode='pooled', pool_size=3,
+                        warmup_services=['store'])
+    config.unblocked.set()
+    WebBuilder().set_config(config).enable_warmup(background=False).get_app()
+    assert config.pool_stats()['store'] == {
+        'size': 3, 'clients': 3, 'idle': 3, 'in_use': 0, 'waiting': 0,
+    }
+
+
+def test_thread_local_warmup_keeps_no_clients():
+    config = SlowConfig(warmup_services=['store'])
+    config.unblocked.set()
+    WebBuilder().set_config(config).enable_warmup(background=False).get_app()
+    # The store was created once by the warm-up, and not kept.
+    assert config._store is None
+    assert config.store == 1
+
+
+class VersionsConfig(Config):
+    versions = 'the versions'
+
+
+def test_warmup_errors():
+    config = VersionsConfig(config={'warmup_services': ['nope', 'versions']})
+    builder = WebBuilder().set_config(config).enable_warmup(background=False)
+    app = builder.get_app()
+    status, body = ready(app)
+    assert status == 200
+    assert [e['service'] for e in body['errors']] == ['nope']
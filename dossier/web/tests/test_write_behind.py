@@ -0,0 +1,231 @@
+from __future__ import absolute_import, division, print_function
+
+import json
+import os
+import subprocess
+import sys
+import threading
+import uuid
+
+import cbor
+import kvlayer
+import pytest
+
+from dossier.label import CorefValue, Label
+
+from dossier.web.builder import WebBuilder
+from dossier.web.config import Config
+from dossier.web.memory import MemoryConfig
+from dossier.web.tests import FakeLabelStore
+from dossier.web.util import wsgi_request
+from dossier.web.versions import Versions
+from dossier.web.write_behind import LabelWriteQueue, \
+    WriteBehindLabelStore, label_to_record, read_labels
+
+
+class BlockingLabelStore(FakeLabelStore):
+    def __init__(self):
+        super(BlockingLabelStore, self).__init__()
+        self.unblocked = threading.Event()
+        self.puts = 0
+
+    def put(self, *labels):
+        self.unblocked.wait()
+        self.puts += 1
+        super(BlockingLabelStore, self).put(*labels)
+
+
+class GatedLabelStore(FakeLabelStore):
+    '''Lets each ``put`` through once ``allowed`` is released.'''
+    def __init__(self):
+        super(GatedLabelStore, self).__init__()
+        self.started = threading.Semaphore(0)
+        self.allowed = threading.Semaphore(0)
+
+    def put(self, *labels):
+        self.started.release()
+        self.allowed.acquire()
+        super(GatedLabelStore, self).put(*labels)
+
+
+@pytest.fixture
+def queue_path(tmpdir):
+    return str(tmpdir.join('labels.queue'))
+
+
+def label(cid1, cid2, value=CorefValue.Positive):
+    return Label(cid1, cid2, 'ann', value)
+
+
+def test_group_commit(queue_path):
+    store = BlockingLabelStore()
+    queue = LabelWriteQueue(lambda: store, queue_path, flush_ms=10)
+    try:
+        for cid in ['b', 'c', 'd']:
+            queue.put(label('a', cid))
+        assert store.labels == []
+        store.unblocked.set()
+        assert queue.flush(timeout=5)
+        assert len(store.labels) == 3
+        # All three writes were acknowledged before the first flush.
+        assert store.puts == 1
+    finally:
+        store.unblocked.set()
+        queue.close()
+
+
+def test_pending_reads(queue_path):
+    store = BlockingLabelStore()
+    store.labels.append(label('a', 'b', CorefValue.Negative))
+    queue = LabelWriteQueue(lambda: store, queue_path, flush_ms=10)
+    wrapped = WriteBehindLabelStore(store, queue)
+    try:
+        wrapped.put(label('a', 'b'), label('c', 'd'))
+        labels = list(wrapped.directly_connected('a'))
+        assert len(labels) == 1
+        assert labels[0].value == CorefValue.Positive
+        assert [lab.other('d') for lab in wrapped.directly_connected('d')] \
+            == ['c']
+    finally:
+        store.unblocked.set()
+        queue.close()
+
+
+def test_replay(queue_path):
+    def new_broken_store():
+        raise IOError('label store is down')
+    queue = LabelWriteQueue(new_broken_store, queue_path, flush_ms=10)
+    queue.put(label('a', 'b'))
+    queue.put(label('a', 'c'))
+    # The labels can't be written, so they stay in the queue file.
+    assert not queue.close(timeout=0.05)
+
+    with open(queue.path, 'ab') as fp:
+        fp.write(b'\x85\x01')  # an unacknowledged partial write
+
+    store = BlockingLabelStore()
+    store.unblocked.set()
+    queue = LabelWriteQueue(lambda: store, queue_path, flush_ms=10)
+    assert queue.close()
+    assert sorted(lab.content_id2 for lab in store.labels) == ['b', 'c']
+
+
+def test_queue_file_compacted(queue_path):
+    store = GatedLabelStore()
+    queue = LabelWriteQueue(lambda: store, queue_path, flush_ms=10,
+                            max_batch=1)
+    try:
+        queue.put(label('a', 'b'))
+        store.started.acquire()
+        # More labels arrive while the first one is being written.
+        queue.put(label('a', 'c'), label('a', 'd'))
+        store.allowed.release()
+        store.started.acquire()
+        # Only the pending labels are left in the file.
+        labels, _ = read_labels(queue.path)
+        assert [lab.content_id2 for lab in labels] == ['c', 'd']
+    finally:
+        for _ in xrange(3):
+            store.allowed.release()
+        assert queue.close(timeout=5)
+    assert os.path.getsize(queue.path) == 0
+    assert [lab.content_id2 for lab in store.labels] == ['b', 'c', 'd']
+
+
+def test_queue_file_per_process(queue_path):
+    store = BlockingLabelStore()
+    store.unblocked.set()
+    queue = LabelWriteQueue(lambda: store, queue_path, flush_ms=10)
+    try:
+        assert queue.path == '%s.%d' % (queue_path, os.getpid())
+    finally:
+        queue.close()
+
+
+def test_replay_orphans(queue_path):
+    # A process that has exited, and one that is still running.
+    dead = subprocess.Popen([sys.executable, '-c', ''])
+    dead.wait()
+    alive = subprocess.Popen([sys.executable, '-c',
+                              'import sys; sys.stdin.read()'],
+                             stdin=subprocess.PIPE)
+    try:
+        for pid, cid in [(dead.pid, 'b'), (alive.pid, 'c')]:
+            with open('%s.%d' % (queue_path, pid), 'wb') as fp:
+                fp.write(cbor.dumps(label_to_record(label('a', cid))))
+
+        store = BlockingLabelStore()
+        store.unblocked.set()
+        queue = LabelWriteQueue(lambda: store, queue_path, flush_ms=10)
+        assert queue.close()
+        assert [lab.content_id2 for lab in store.labels] == ['b']
+        assert not os.path.exists('%s.%d' % (queue_path, dead.pid))
+        assert os.path.exists('%s.%d' % (queue_path, alive.pid))
+    finally:
+        alive.communicate()
+
+
+def test_versions_bumped_after_flush(queue_path):
+    store = BlockingLabelStore()
+    config = MemoryConfig(label_store=store)
+    queue = LabelWriteQueue(lambda: store, queue_path, flush_ms=10,
+                            on_write=config.versions.bump_labels)
+    config.label_store = WriteBehindLabelStore(store, queue)
+    app = WebBuilder().set_config(config).get_app()
+    path = '/dossier/v1/label/a/connected'
+    try:
+        status, headers, body = wsgi_request(app, 'GET', path)
+        assert (status, json.loads(body)) == (200, [])
+        status, _, _ = wsgi_request(app, 'PUT', '/dossier/v1/label/a/b/ann',
+                                    body='1')
+        assert status == 201
+
+        # The label is queued, so the new version still has no labels.
+        status, headers, body = wsgi_request(app, 'GET', path)
+        assert (status, json.loads(body)) == (200, [])
+        etag = headers['ETag']
+
+        store.unblocked.set()
+        assert queue.flush(timeout=5)
+        status, headers, body = wsgi_request(
+            app, 'GET', path, headers={'If-None-Match': etag})
+        assert status == 200
+        assert headers['ETag'] != etag
+        assert len(json.loads(body)) == 1
+    finally:
+        store.unblocked.set()
+        queue.close()
+        config.kvlclient.delete_namespace()
+
+
+class PooledWriteBehindConfig(Config):
+    def __init__(self, path):
+        super(PooledWriteBehindConfig, self).__init__(config={
+            'service_mode': 'pooled',
+            'label_write_behind': {'path': path, 'flush_ms': 10},
+        })
+        self.label_store_ = FakeLabelStore()
+        self.kvl = kvlayer.client(
+            config={}, storage_type='local', app_name='diffeo',
+            namespace='dossier.web.tests.%s' % uuid.uuid4().hex)
+
+    def new_label_store(self):
+        return self.label_store_
+
+    def new_versions(self):
+        return Versions(self.kvl)
+
+
+def test_flusher_versions_not_pooled(queue_path):
+    config = PooledWriteBehindConfig(queue_path)
+    try:
+        config.label_store.put(label('a', 'b'))
+        config.release()
+        assert config.label_queue.flush(timeout=5)
+        # The flushing thread has bumped versions without holding a
+        # pooled client.
+        assert config.new_versions().get(Versions.LABEL, 'a') \
+            != Versions.INITIAL
+        assert config.pool_stats().get('versions', {}).get('in_use', 0) == 0
+    finally:
+        config.label_queue.close()
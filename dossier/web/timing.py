@@ -0,0 +1,270 @@
+'''Per-request timing of backend calls and search phases.
+
+.. This software is released under an MIT/X11 open source license.
+   Copyright 2012-2015 Diffeo, Inc.
+
+When timing is enabled (with :meth:`dossier.web.WebBuilder.enable_timing`
+or ``timing: true`` in the ``dossier.web`` configuration), every
+request records how long it spent in:
+
+* each backend service (``store``, ``label_store``, ``kvlclient`` and
+  ``tags``), by wrapping the services given to routes, search engines
+  and filters in a :class:`TimedService`;
+* each phase marked with :func:`phase`, such as ``recommend`` and
+  ``transform`` in :meth:`dossier.web.SearchEngine.results` and
+  ``encode`` in :meth:`dossier.web.SearchEngine.respond`.
+
+The totals are sent in a ``Server-Timing`` header, e.g.::
+
+    Server-Timing: store;dur=41.2;desc="3 calls", recommend;dur=52.8,
+                   encode;dur=3.1, total;dur=58.4
+
+and, if ``log`` is set (``timing: log`` in the configuration), in one
+JSON log line per request from the ``dossier.web.timing`` logger.
+
+Backend calls made by :mod:`dossier.web.executor` on behalf of a
+request are counted for that request. Durations overlap when calls
+run concurrently, and for streamed responses only the time until the
+route returns is counted.
+
+.. autoclass:: Timings
+.. autoclass:: TimedService
+.. autoclass:: TimingPlugin
+.. autofunction:: current
+.. autofunction:: phase
+.. autofunction:: annotate
+'''
+from __future__ import absolute_import, division, print_function
+
+from collections import OrderedDict
+from contextlib import contextmanager
+import json
+import logging
+import threading
+import time
+import types
+
+import bottle
+
+
+logger = logging.getLogger(__name__)
+
+#: The services that are wrapped in a :class:`TimedService`.
+TIMED_SERVICES = ('store', 'label_store', 'kvlclient', 'tags')
+
+_local = threading.local()
+
+
+class Timings(object):
+    '''The time a single request spent in each service or phase.
+
+    .. automethod:: add
+    .. automethod:: total
+    .. automethod:: to_dict
+    .. automethod:: header
+
+    ``context`` is a dictionary of details about the request added with
+    :func:`annotate`.
+    '''
+    def __init__(self, clock=time.time):
+        self.clock = clock
+        self.started = clock()
+        self.lock = threading.Lock()
+        # name -> [calls, seconds]
+        self.spent = OrderedDict()
+        self.context = OrderedDict()
+
+    def add(self, name, seconds, calls=1):
+        '''Add ``calls`` calls taking ``seconds`` in all to ``name``.'''
+        with self.lock:
+            spent = self.spent.setdefault(name, [0, 0.0])
+            spent[0] += calls
+            spent[1] += seconds
+
+    def total(self):
+        '''Seconds since this request started.'''
+        return self.clock() - self.started
+
+    def to_dict(self):
+        '''Return ``{name: {'calls': n, 'ms': milliseconds}}``.'''
+        with self.lock:
+            return OrderedDict((name, {'calls': calls, 'ms': 1000 * secs})
+                               for name, (calls, secs) in self.spent.items())
+
+    def header(self):
+        '''Return the value of a ``Server-Timing`` header.'''
+        metrics = []
+        for name, spent in self.to_dict().items():
+            metric = '%s;dur=%0.1f' % (name, spent['ms'])
+            if spent['calls'] > 1:
+                metric += ';desc="%d calls"' % spent['calls']
+            metrics.append(metric)
+        metrics.append('total;dur=%0.1f' % (1000 * self.total()))
+        return ', '.join(metrics)
+
+
+def current():
+    '''Return the :class:`Timings` of the current request, if any.'''
+    return getattr(_local, 'timings', None)
+
+
+def set_current(timings):
+    '''Make ``timings`` the :class:`Timings` of the current thread.'''
+    _local.timings = timings
+
+
+def annotate(**context):
+    '''Add details to the :class:`Timings` of the current request.
+
+    This does nothing when the current request isn't being timed.
+    '''
+    timings = current()
+    if timings is not None:
+        timings.context.update(context)
+
+
+@contextmanager
+def phase(name):
+    '''Count the time spent in a ``with`` block towards ``name``.
+
+    This does nothing when the current request isn't being timed.
+    '''
+    timings = current()
+    if timings is None:
+        yield
+        return
+    start = time.time()
+    try:
+        yield
+    finally:
+        timings.add(name, time.time() - start)
+
+
+def timed(name, service, observe=None):
+    '''Wrap ``service`` in a :class:`TimedService` if it is timed.
+
+    Services not in :data:`TIMED_SERVICES` (and ``None``) are returned
+    as is.
+    '''
+    if service is None or name not in TIMED_SERVICES \
+            or isinstance(service, TimedService):
+        return service
+    return TimedService(name, service, observe=observe)
+
+
+class TimedService(object):
+    '''Times every method call of a service.
+
+    Calls are counted towards the :class:`Timings` of the request
+    making them, under the service's name. When a method returns a
+    generator, the time spent iterating over it is counted too.
+    Attributes that aren't methods are passed through.
+
+    If ``observe`` is given, then it is also called with the service
+    name, the method name and the seconds spent in each call (such as
+    :func:`dossier.web.metrics.observe_backend`).
+    '''
+    def __init__(self, name, service, observe=None):
+        self._name = name
+        self._service = service
+        self._observe = observe
+
+    def __getattr__(self, attr):
+        value = getattr(self._service, attr)
+        if not callable(value):
+            return value
+        name, observe = self._name, self._observe
+
+        def call(*args, **kwargs):
+            timings = current()
+            if timings is None and observe is None:
+                return value(*args, **kwargs)
+            start = time.time()
+            try:
+                rv = value(*args, **kwargs)
+            finally:
+                spent = time.time() - start
+                if timings is not None:
+                    timings.add(name, spent)
+            if isinstance(rv, types.GeneratorType):
+                return timed_iter(rv, timings, observe, name, attr, spent)
+            if observe is not None:
+                observe(name, attr, spent)
+            return rv
+        return call
+
+
+def timed_iter(it, timings, observe, name, attr, spent):
+    '''Yield from ``it``, timing each step like :class:`TimedService`.
+
+    The steps are not counted as calls, since the call that returned
+    ``it`` already was.
+    '''
+    try:
+        while True:
+            start = time.time()
+            try:
+                x = next(it)
+            except StopIteration:
+                return
+            finally:
+                elapsed = time.time() - start
+                spent += elapsed
+                if timings is not None:
+                    timings.add(name, elapsed, calls=0)
+            yield x
+    finally:
+        if observe is not None:
+            observe(name, attr, spent)
+
+
+class TimingPlugin(object):
+    '''A Bottle plugin that times each request.
+
+    It sets the ``Server-Timing`` header of every response, and logs
+    the timings of every request if ``log`` is true.
+    '''
+    api = 2
+    name = 'timing'
+
+    def __init__(self, log=False):
+        self.log = log
+
+    def apply(self, callback, route):
+        def _(*args, **kwargs):
+            # Another plugin (like `dossier.web.slowlog`) may already be
+            # timing this request.
+            timings = current()
+            owner = timings is None
+            if owner:
+                timings = Timings()
+                set_current(timings)
+            # Bottle replaces the headers of `bottle.response` with
+            # those of an `HTTPResponse` (or `HTTPError`) that is
+            # returned or raised, so the header is set on that instead.
+            resp = bottle.response
+            try:
+                rv = callback(*args, **kwargs)
+                if isinstance(rv, bottle.HTTPResponse):
+                    resp = rv
+                return rv
+            except bottle.HTTPResponse as e:
+                resp = e
+                raise
+            finally:
+                if owner:
+                    set_current(None)
+                resp.set_header('Server-Timing', timings.header())
+                if self.log:
+                    self.log_request(route, timings, resp)
+        return _
+
+    def log_request(self, route, timings, resp):
+        logger.info('%s', json.dumps(OrderedDict([
+            ('method', bottle.request.method),
+            ('path', bottle.request.path),
+            ('route', route.rule),
+            ('status', resp.status_code),
+            ('total_ms', 1000 * timings.total()),
+            ('timings', timings.to_dict()),
+        ])))
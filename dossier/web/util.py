@@ -5,10 +5,217 @@
 '''
 from __future__ import absolute_import, division, print_function
 
+from cStringIO import StringIO
+import importlib
+from itertools import islice
+import json
+import logging
+
+import bottle
+import cbor
+
 from dossier.fc import \
     FeatureCollection, FeatureTokens, StringCounter, GeoCoords
 
 
+logger = logging.getLogger(__name__)
+
+#: JSON libraries to try by default, in order of preference. The
+#: standard library ``json`` module is always used as a last resort.
+#:
+#: ``ujson`` is also supported, but must be asked for explicitly since
+#: it rounds floats to 15 significant digits.
+JSON_BACKENDS = ['simplejson', 'json']
+
+
+class JsonEncoder(object):
+    '''Serializes Python values to JSON.
+
+    Output is compact (no whitespace between tokens) unless ``pretty``
+    is set, in which case it is indented for human consumption.
+
+    Compact output is produced by the first importable library in
+    ``backends``. If that library fails to serialize a value, then the
+    standard library ``json`` module is used instead. Pretty output
+    always uses the standard library.
+
+    :ivar str backend: The name of the library in use.
+    '''
+    def __init__(self, backends=None):
+        if backends is None:
+            backends = JSON_BACKENDS
+        self.backend, self._dumps = 'json', json_dumps_compact
+        for name in backends:
+            try:
+                mod = importlib.import_module(name)
+            except ImportError:
+                continue
+            self.backend = name
+            if name == 'simplejson':
+                self._dumps = lambda obj: mod.dumps(obj, separators=(',', ':'))
+            elif name == 'ujson':
+                self._dumps = lambda obj: mod.dumps(
+                    obj, double_precision=15, escape_forward_slashes=False)
+            elif name != 'json':
+                self._dumps = mod.dumps
+            break
+        logger.debug('using JSON backend %r', self.backend)
+
+    def dumps(self, obj, pretty=False):
+        '''Serialize ``obj`` to a JSON string.
+
+        :param obj: A JSON encodable value.
+        :param bool pretty: When true, indent the output.
+        :rtype: str
+        '''
+        if pretty:
+            return json.dumps(obj, indent=2)
+        try:
+            return self._dumps(obj)
+        except (TypeError, ValueError, OverflowError):
+            if self._dumps is json_dumps_compact:
+                raise
+            return json_dumps_compact(obj)
+
+
+def json_dumps_compact(obj):
+    return json.dumps(obj, separators=(',', ':'))
+
+
+#: The encoder used by ``dossier.web`` routes and search engines.
+json_encoder = JsonEncoder()
+
+
+def set_json_encoder(encoder):
+    '''Set the encoder used by ``dossier.web`` routes.
+
+    :param encoder: Anything with a ``dumps(obj, pretty=False)`` method.
+    :type encoder: :class:`JsonEncoder`
+    '''
+    global json_encoder
+    json_encoder = encoder
+
+
+def json_dumps(obj, pretty=False):
+    '''Serialize ``obj`` with the current :data:`json_encoder`.'''
+    return json_encoder.dumps(obj, pretty=pretty)
+
+
+def wants_pretty(request):
+    '''Returns true if the request asked for indented JSON.
+
+    This is controlled by the ``pretty`` query parameter, e.g.,
+    ``?pretty=1``.
+    '''
+    return request.query.get('pretty', '0') not in ('', '0')
+
+
+CBOR_MIME = 'application/cbor'
+
+
+def negotiate_format(request):
+    '''Choose between JSON and CBOR given the ``Accept`` header.
+
+    Returns ``'cbor'`` if the client prefers ``application/cbor`` to
+    ``application/json``. Otherwise, returns ``'json'``.
+
+    :param request: The web request.
+    :type request: :class:`bottle.Request`
+    :rtype: str
+    '''
+    accept = request.headers.get('Accept', '')
+    if 'cbor' not in accept:
+        return 'json'
+    quality = {}
+    for part in accept.split(','):
+        fields = part.strip().split(';')
+        mime = fields[0].strip().lower()
+        q = 1.0
+        for param in fields[1:]:
+            name, _, value = param.strip().partition('=')
+            if name.strip() == 'q':
+                try:
+                    q = float(value)
+                except ValueError:
+                    q = 0.0
+        quality[mime] = q
+    json_q = max(quality.get('application/json', 0.0),
+                 quality.get('application/*', 0.0),
+                 quality.get('*/*', 0.0))
+    return 'cbor' if quality.get(CBOR_MIME, 0.0) > json_q else 'json'
+
+
+def cbor_dumps(obj):
+    '''Serialize a JSON encodable value to CBOR.
+
+    The value is encoded the same way it would be as JSON. In
+    particular, byte strings are decoded as UTF-8 and written as CBOR
+    text strings.
+    '''
+    return cbor.dumps(as_text(obj))
+
+
+def as_text(obj):
+    if isinstance(obj, str):
+        return obj.decode('utf-8')
+    elif isinstance(obj, dict):
+        return {as_text(k): as_text(v) for k, v in obj.iteritems()}
+    elif isinstance(obj, (list, tuple)):
+        return [as_text(v) for v in obj]
+    return obj
+
+
+NDJSON_MIME = 'application/x-ndjson'
+CBOR_SEQ_MIME = 'application/cbor-seq'
+
+
+def read_body(request):
+    '''Decode a JSON or CBOR request body.
+
+    The body is decoded as CBOR if the ``Content-Type`` of the request
+    is ``application/cbor``, and as JSON otherwise.
+
+    :param request: The web request.
+    :type request: :class:`bottle.Request`
+    :raises: :exc:`ValueError` if the body can't be decoded
+    '''
+    if request.content_type.startswith(CBOR_MIME):
+        try:
+            return cbor.load(request.body)
+        except LookupError as e:
+            # `cbor` raises this when the body ends too soon.
+            raise ValueError('invalid CBOR: %s' % e)
+    return json.load(request.body)
+
+
+def stream_records(request, response, records):
+    '''Stream an iterable of JSON encodable records.
+
+    If the client prefers CBOR (see :func:`negotiate_format`), then
+    the records are written as a CBOR sequence. Otherwise, they are
+    written as newline delimited JSON.
+
+    :param records: JSON encodable values.
+    :rtype: generator of str
+    '''
+    response.add_header('Vary', 'Accept')
+    if negotiate_format(request) == 'cbor':
+        response.content_type = CBOR_SEQ_MIME
+        return (cbor_dumps(rec) for rec in records)
+    response.content_type = NDJSON_MIME
+    return (json_dumps(rec) + '\n' for rec in records)
+
+
+def chunks(it, size):
+    '''Group an iterable into lists of at most ``size`` elements.'''
+    it = iter(it)
+    while True:
+        chunk = list(islice(it, size))
+        if len(chunk) == 0:
+            return
+        yield chunk
+
+
 def fc_to_json(fc):
     # If `fc` has already been converted to a dict elsewhere, then
     # don't try to do it again.
@@ -28,3 +235,41 @@ def fc_to_json(fc):
 def is_filterable_geo_feature(name, feat):
     want = FeatureCollection.GEOCOORDS_PREFIX + 'both_co_LOC_1'
     return isinstance(feat, GeoCoords) and name == want
+
+
+def wsgi_request(app, method, path, headers=None, body='', query=''):
+    '''Run a request through a WSGI ``app`` without a server.
+
+    The response body is read to the end. Returns a triple of status
+    code, a (case insensitive) dictionary of response headers and the
+    response body.
+    '''
+    environ = {
+        'REQUEST_METHOD': method,
+        'PATH_INFO': path,
+        'QUERY_STRING': query,
+        'SERVER_NAME': 'localhost',
+        'SERVER_PORT': '80',
+        'SERVER_PROTOCOL': 'HTTP/1.1',
+        'wsgi.url_scheme': 'http',
+        'wsgi.input': StringIO(body),
+        'wsgi.errors': StringIO(),
+        'CONTENT_LENGTH': str(len(body)),
+    }
+    for name, value in (headers or {}).items():
+        name = name.upper().replace('-', '_')
+        if name not in ('CONTENT_TYPE', 'CONTENT_LENGTH'):
+            name = 'HTTP_' + name
+        environ[name] = value
+    started = []
+
+    def start_response(status, headers, exc_info=None):
+        started.append((int(status.split()[0]), bottle.HeaderDict(headers)))
+
+    out = app(environ, start_response)
+    try:
+        body = b''.join(out)
+    finally:
+        if hasattr(out, 'close'):
+            out.close()
+    return started[0][0], started[0][1], body
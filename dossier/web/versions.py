@@ -0,0 +1,177 @@
+'''Version tokens for conditional requests.
+
+.. This software is released under an MIT/X11 open source license.
+   Copyright 2012-2015 Diffeo, Inc.
+
+Routes like :func:`dossier.web.routes.v1_fc_get` are polled constantly
+by the user interface. To avoid sending the same data over and over,
+they set a strong ``ETag`` header on their responses and answer a
+matching ``If-None-Match`` with ``304 Not Modified``.
+
+The ``ETag`` is a version token stored in ``kvlayer``, so that it is
+shared by every process serving requests. A new token is stored every
+time the resource is written through ``dossier.web`` (e.g., by
+:func:`dossier.web.routes.v1_fc_put`). Resources that have never been
+written have the token :data:`Versions.INITIAL`, which isn't stored,
+so reads never write to ``kvlayer``. Checking a version is a single
+``kvlayer`` read, which is much cheaper than fetching and serializing
+the resource.
+
+N.B. Writes that bypass ``dossier.web`` (for example, loading feature
+collections directly into the store) do not change version tokens.
+
+.. autoclass:: Versions
+'''
+from __future__ import absolute_import, division, print_function
+
+import uuid
+
+import bottle
+
+from dossier.web import util
+from dossier.web.metrics import cache_lookup
+
+
+class Versions(object):
+    '''Version tokens for resources, stored in ``kvlayer``.
+
+    A resource is identified by a ``kind`` (like ``'fc'``) and a
+    ``key`` (like a content id).
+
+    .. automethod:: __init__
+    .. automethod:: get
+    .. automethod:: bump
+    .. automethod:: bump_labels
+    .. automethod:: etag
+    '''
+    TABLE = 'versions'
+
+    _kvlayer_namespace = {
+        # (kind, key) -> version token
+        TABLE: (str, str),
+    }
+
+    #: The kind for feature collections, keyed by content id.
+    FC = 'fc'
+    #: The kind for labels directly connected to a content id.
+    LABEL = 'label'
+    #: The kind for the label graph as a whole. (Writing any label can
+    #: change the connected component of any content id.)
+    LABEL_GRAPH = 'label_graph'
+
+    #: The version token of a resource that has never been written.
+    #: Every token stored by :meth:`bump` is different from it.
+    INITIAL = '0'
+
+    def __init__(self, kvl):
+        '''Create a new version store.
+
+        :param kvl: A ``kvlayer`` client.
+        '''
+        self.kvl = kvl
+        self.kvl.setup_namespace(self._kvlayer_namespace)
+
+    def get(self, kind, key=''):
+        '''Return the current version token of a resource.
+
+        If the resource has no version token yet, then this is
+        :data:`INITIAL`.
+
+        :param str kind: The kind of resource.
+        :param str key: The resource identifier.
+        :rtype: str
+        '''
+        k = (utf8(kind), utf8(key))
+        for _, v in self.kvl.get(self.TABLE, k):
+            if v is not None:
+                return v
+        # A concurrent write stores a new token (after the write), so a
+        # caller reading the resource now can't miss the change.
+        return self.INITIAL
+
+    def bump(self, kind, *keys):
+        '''Record that resources have changed.
+
+        Every resource ``(kind, key)`` for ``key`` in ``keys`` gets a
+        new version token. This should be called *after* the write.
+
+        :param str kind: The kind of resource.
+        :param keys: The resource identifiers. If empty, then the
+                     resource with an empty key is bumped.
+        '''
+        if len(keys) == 0:
+            keys = ('',)
+        self.kvl.put(self.TABLE, *[((utf8(kind), utf8(key)), new_token())
+                                   for key in keys])
+
+    def bump_labels(self, *labels):
+        '''Record that labels have been written.
+
+        This bumps :data:`LABEL` for both content ids of each label,
+        and :data:`LABEL_GRAPH`.
+
+        :param labels: The labels written.
+        :type labels: :class:`dossier.label.Label`
+        '''
+        cids = set()
+        for lab in labels:
+            cids.add(lab.content_id1)
+            cids.add(lab.content_id2)
+        self.bump(self.LABEL, *cids)
+        self.bump(self.LABEL_GRAPH)
+
+    def etag(self, kind, key=''):
+        '''Return a strong ``ETag`` for a resource.
+
+        :rtype: str
+        '''
+        return '"%s-%s"' % (kind, self.get(kind, key))
+
+
+def check_etag(request, response, etag):
+    '''Set the ``ETag`` header and answer ``If-None-Match``.
+
+    If ``etag`` matches the request's ``If-None-Match`` header, then
+    this raises a ``304 Not Modified`` response. Otherwise, the
+    ``ETag`` header is set on ``response`` and this returns normally.
+
+    :param request: The web request.
+    :type request: :class:`bottle.Request`
+    :param response: The web response.
+    :type response: :class:`bottle.Response`
+    :param str etag: A quoted entity tag.
+    '''
+    # The CBOR representation of a resource needs its own entity tag.
+    if util.negotiate_format(request) == 'cbor':
+        etag = etag[:-1] + '-cbor"'
+    matches = etag_matches(request.headers.get('If-None-Match', ''), etag)
+    cache_lookup('etag', matches)
+    if matches:
+        raise bottle.HTTPResponse(status=304, headers={'ETag': etag})
+    response.headers['ETag'] = etag
+
+
+def etag_matches(if_none_match, etag):
+    '''Returns true if ``etag`` is in an ``If-None-Match`` header.
+
+    This uses the weak comparison required for ``If-None-Match``.
+    '''
+    for tag in if_none_match.split(','):
+        tag = tag.strip()
+        if tag == '*':
+            return True
+        if tag.startswith('W/'):
+            tag = tag[2:]
+        if tag == etag:
+            return True
+    return False
+
+
+def new_token():
+    return uuid.uuid4().hex
+
+
+def utf8(s):
+    if isinstance(s, unicode):
+        return s.encode('utf-8')
+    return s
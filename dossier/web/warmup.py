@@ -0,0 +1,146 @@
+'''Warming up a dossier.web process before it serves requests.
+
+.. This software is released under an MIT/X11 open source license.
+   Copyright 2012-2015 Diffeo, Inc.
+
+Without a warm-up, the first requests served by a process pay for
+connecting to every backend, for the index and mapping checks done by
+:class:`dossier.web.Tags` and for filling various caches. A warm-up
+does that work once, before the load balancer sends any traffic.
+
+Warm-up is opt in, either with
+:meth:`dossier.web.WebBuilder.enable_warmup`, with the ``--warmup``
+command line flag of ``dossier.web`` or with ``warmup: true`` in the
+``dossier.web`` configuration. The services to warm up can be set
+with ``warmup_services``. By default, they are ``kvlclient``,
+``store``, ``label_store`` and ``versions`` (and ``tags``, if
+``dossier.tags`` is configured).
+
+Clients are only kept in pooled mode, where the pool of each service
+is filled with ``warmup_pool_size`` clients (which defaults to
+``pool_size``). In the default thread local mode, every request thread
+creates its own clients the first time it uses them, so clients
+created by the warm-up would never be used. Each service is still
+created once (and then dropped) to do the work that is only done once
+per process, like the schema checks of :class:`dossier.web.Tags`, and
+to find backends that are unavailable. Most of the benefit of warm-up
+therefore comes with ``service_mode: pooled``.
+
+:func:`dossier.web.routes.v1_ready` reports whether warm-up has
+finished.
+
+.. autoclass:: Warmup
+'''
+from __future__ import absolute_import, division, print_function
+
+import logging
+import mimetypes
+import threading
+import time
+
+from dossier.web.config import global_config
+
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_SERVICES = ['kvlclient', 'store', 'label_store', 'versions']
+
+
+class Warmup(object):
+    '''Warms up the services and caches of a process.
+
+    .. automethod:: __init__
+    .. automethod:: run
+    .. automethod:: start
+    .. automethod:: skip
+    .. autoattribute:: ready
+    .. automethod:: status
+    '''
+    def __init__(self, config, search_engines=None, filters=None,
+                 services=None):
+        '''Prepare a warm-up.
+
+        :param config: The config instance that provides services.
+        :type config: :class:`dossier.web.Config`
+        :param dict search_engines: Search engine classes, whose
+                                    construction plans are cached.
+        :param dict filters: Filter classes, whose construction plans
+                             are cached.
+        :param list services: Names of the services to warm up.
+        '''
+        self.config = config
+        self.search_engines = search_engines or {}
+        self.filters = filters or {}
+        self.services = services
+        self.started = None
+        self.finished = None
+        self.finished_event = threading.Event()
+        self.errors = []
+
+    def run(self):
+        '''Warm up in the current thread.'''
+        self.started = time.time()
+        for name in self.service_names():
+            start = time.time()
+            try:
+                ok = self.config.warm(name, self.pool_size())
+                error = None if ok else 'unavailable'
+            except Exception as e:
+                logger.error('could not warm up "%s"', name, exc_info=True)
+                error = str(e)
+            if error is not None:
+                self.errors.append({'service': name, 'error': error})
+            logger.info('warmed up "%s" in %0.3f seconds',
+                        name, time.time() - start)
+
+        if hasattr(self.config, 'construction_plan'):
+            for cls in self.search_engines.values() + self.filters.values():
+                if isinstance(cls, type):
+                    self.config.construction_plan(cls)
+        mimetypes.init()
+        self.finished = time.time()
+        self.finished_event.set()
+        logger.info('warm-up finished in %0.3f seconds with %d errors',
+                    self.finished - self.started, len(self.errors))
+
+    def start(self):
+        '''Warm up in a background thread.'''
+        t = threading.Thread(target=self.run, name='dossier-warmup')
+        t.daemon = True
+        t.start()
+        return t
+
+    def skip(self):
+        '''Mark this process as ready without warming up.'''
+        self.started = self.finished = time.time()
+        self.finished_event.set()
+
+    @property
+    def ready(self):
+        '''True once warm-up has finished (or was skipped).'''
+        return self.finished is not None
+
+    def status(self):
+        '''Return the progress of warm-up as a dictionary.'''
+        seconds = None
+        if self.started is not None:
+            seconds = (self.finished or time.time()) - self.started
+        return {
+            'ready': self.ready,
+            'seconds': seconds,
+            'errors': list(self.errors),
+        }
+
+    def service_names(self):
+        if self.services is not None:
+            return self.services
+        conf = self.config.config
+        if 'warmup_services' in conf:
+            return conf['warmup_services']
+        names = list(DEFAULT_SERVICES)
+        if global_config('dossier.tags'):
+            names.append('tags')
+        return names
+
+    def pool_size(self):
+        return self.config.config.get('warmup_pool_size')
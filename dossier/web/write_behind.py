@@ -0,0 +1,378 @@
+'''Write-behind label storage.
+
+.. This software is released under an MIT/X11 open source license.
+   Copyright 2012-2015 Diffeo, Inc.
+
+During a sorting session, the user interface sends a burst of
+individual label writes to :func:`dossier.web.routes.v1_label_put`.
+Normally, each one is a synchronous write to the label store. In
+write-behind mode, a label is instead appended to a local file and
+acknowledged right away. A background thread writes pending labels to
+the label store in batches (a "group commit") every ``flush_ms``
+milliseconds, or sooner once ``max_batch`` labels are pending.
+
+Write-behind mode is enabled in the ``dossier.web`` configuration::
+
+    dossier.web:
+      label_write_behind:
+        path: /var/lib/dossier/labels.queue
+        flush_ms: 50
+        max_batch: 500
+        fsync: true
+
+``path`` is required. Each process appends its process id to it, so
+that worker processes of :mod:`dossier.web.server` each have their own
+file (e.g., ``labels.queue.1234``). The file holds every label that has
+been acknowledged but may not have been written to the label store
+yet. After each flush, it is rewritten to hold only the labels that
+are still pending, so it doesn't grow while labels keep coming. If a
+process dies, the labels in its file are written to the label store
+by the next queue started with the same ``path``, and the file is
+removed. (Some of them may be written twice, which is harmless since
+they are identical.)
+
+Labels that are still pending are visible to
+:meth:`WriteBehindLabelStore.directly_connected` in the same process.
+Other processes, and other label store methods like
+``connected_component``, only see labels once they have been flushed.
+The version tokens of labels (see :mod:`dossier.web.versions`) are
+bumped again once they have been flushed, so that responses cached in
+between are not reused.
+
+.. autoclass:: LabelWriteQueue
+.. autoclass:: WriteBehindLabelStore
+'''
+from __future__ import absolute_import, division, print_function
+
+import errno
+import glob
+import logging
+import os
+import threading
+import time
+
+import cbor
+
+from dossier.label import CorefValue, Label
+from dossier.label.label import normalize_ident
+
+
+logger = logging.getLogger(__name__)
+
+
+class LabelWriteQueue(object):
+    '''A durable queue of labels waiting to be written.
+
+    .. automethod:: __init__
+    .. automethod:: put
+    .. automethod:: pending
+    .. automethod:: flush
+    .. automethod:: close
+    '''
+    def __init__(self, new_label_store, path, flush_ms=50, max_batch=500,
+                 fsync=True, on_write=None):
+        '''Create a new queue and start flushing it.
+
+        Pending labels are appended to ``path`` followed by a dot and
+        the process id. Any labels left in such files by processes
+        that are no longer running are queued first.
+
+        :param new_label_store: A function that returns a new
+                                :class:`dossier.label.LabelStore`.
+                                It is called by the flushing thread.
+        :param str path: The prefix of the file to append pending
+                         labels to.
+        :param int flush_ms: Milliseconds between flushes.
+        :param int max_batch: The maximum number of labels written
+                              to the label store at once.
+        :param bool fsync: Whether to ``fsync`` the file before a
+                           write is acknowledged.
+        :param on_write: If given, this is called by the flushing
+                         thread with the labels of each batch, once
+                         they have been written to the label store.
+        '''
+        self.new_label_store = new_label_store
+        self.path = '%s.%d' % (path, os.getpid())
+        self.flush_interval = flush_ms / 1000
+        self.max_batch = max(1, max_batch)
+        self.fsync = fsync
+        self.on_write = on_write
+
+        self.lock = threading.Lock()
+        self.wake = threading.Condition(self.lock)
+        self.flushed = threading.Condition(self.lock)
+        self.fp = open(self.path, 'ab')
+        self.pending_labels = self._replay(path)
+        self.stopped = False
+        self.flusher = threading.Thread(target=self._run,
+                                        name='label-write-behind')
+        self.flusher.daemon = True
+        self.flusher.start()
+
+    def put(self, *labels):
+        '''Durably queue labels.
+
+        This returns once the labels are in the queue file.
+        '''
+        data = b''.join(cbor.dumps(label_to_record(lab)) for lab in labels)
+        with self.lock:
+            fp = self.fp
+            fp.write(data)
+            fp.flush()
+            self.pending_labels.extend(labels)
+            if len(self.pending_labels) >= self.max_batch:
+                self.wake.notify()
+        # Concurrent writers don't wait for each other's `fsync`. (If
+        # the labels are flushed first, then the file may have been
+        # truncated or replaced, which is fine: a replaced file stays
+        # open while `fp` refers to it, and its replacement was synced.)
+        if self.fsync:
+            os.fsync(fp.fileno())
+
+    def pending(self, ident):
+        '''Return pending labels connected to ``ident``.
+
+        ``ident`` is a content id or a ``(content_id, subtopic_id)``
+        pair, as in
+        :meth:`dossier.label.LabelStore.directly_connected`. Labels
+        are returned oldest first.
+
+        :rtype: list of :class:`dossier.label.Label`
+        '''
+        content_id, subtopic_id = normalize_ident(ident)
+        ident = content_id if subtopic_id is None \
+            else (content_id, subtopic_id)
+        with self.lock:
+            return [lab for lab in self.pending_labels if ident in lab]
+
+    def flush(self, timeout=None):
+        '''Wait until there are no pending labels.
+
+        :param float timeout: The maximum number of seconds to wait,
+                              or ``None`` to wait forever.
+        :return: ``True`` if every pending label was written.
+        '''
+        deadline = None if timeout is None else time.time() + timeout
+        with self.lock:
+            self.wake.notify()
+            while len(self.pending_labels) > 0 and not self.stopped:
+                if deadline is not None and time.time() >= deadline:
+                    break
+                self.flushed.wait(self.flush_interval)
+            return len(self.pending_labels) == 0
+
+    def close(self, timeout=None):
+        '''Flush pending labels and stop the flushing thread.
+
+        Labels that could not be written within ``timeout`` seconds
+        stay in the queue file, and are written the next time the
+        queue is started.
+
+        :return: ``True`` if every pending label was written.
+        '''
+        flushed = self.flush(timeout)
+        with self.lock:
+            self.stopped = True
+            self.wake.notify()
+        self.flusher.join()
+        self.fp.close()
+        return flushed
+
+    def _run(self):
+        label_store = None
+        while True:
+            with self.lock:
+                if len(self.pending_labels) < self.max_batch \
+                        and not self.stopped:
+                    self.wake.wait(self.flush_interval)
+                batch = self.pending_labels[:self.max_batch]
+                if len(batch) == 0:
+                    if self.stopped:
+                        return
+                    continue
+            try:
+                if label_store is None:
+                    label_store = self.new_label_store()
+                label_store.put(*batch)
+            except Exception:
+                logger.error('could not write %d pending labels',
+                             len(batch), exc_info=True)
+                label_store = None
+                if self.stopped:
+                    return
+                time.sleep(self.flush_interval)
+                continue
+            # This is done while the labels are still pending, so that
+            # they are visible to readers of the new version.
+            if self.on_write is not None:
+                try:
+                    self.on_write(*batch)
+                except Exception:
+                    logger.error('could not record %d written labels',
+                                 len(batch), exc_info=True)
+            with self.lock:
+                del self.pending_labels[:len(batch)]
+                try:
+                    self._compact()
+                except Exception:
+                    logger.error('could not compact %s', self.path,
+                                 exc_info=True)
+                self.flushed.notify_all()
+
+    def _compact(self):
+        '''Remove written labels from the queue file.
+
+        This must be called with the lock held. Labels that are still
+        pending are written to a new file, which replaces the queue
+        file, so that the queue file is intact if this is interrupted.
+        '''
+        if len(self.pending_labels) == 0:
+            self.fp.seek(0)
+            self.fp.truncate()
+            return
+        tmp_path = self.path + '.compact'
+        with open(tmp_path, 'wb') as fp:
+            fp.write(b''.join(cbor.dumps(label_to_record(lab))
+                              for lab in self.pending_labels))
+            fp.flush()
+            if self.fsync:
+                os.fsync(fp.fileno())
+        os.rename(tmp_path, self.path)
+        # The old file is closed once no `put` is syncing it.
+        self.fp = open(self.path, 'ab')
+
+    def _replay(self, path):
+        '''Claim the labels left by processes that have exited.
+
+        The labels are copied to this process's file before the files
+        they came from are removed, so they stay durable.
+        '''
+        # An earlier process with the same id may have left labels in
+        # this process's file. New labels are appended after the last
+        # complete one.
+        labels, end = read_labels(self.path)
+        self.fp.truncate(end)
+        for orphan in [path] + sorted(glob.glob(path + '.*')):
+            if orphan == self.path or not is_orphan(path, orphan):
+                continue
+            replayed, _ = read_labels(orphan)
+            if len(replayed) > 0:
+                logger.info('replaying %d pending labels from %s',
+                            len(replayed), orphan)
+                self.fp.write(b''.join(cbor.dumps(label_to_record(lab))
+                                       for lab in replayed))
+                self.fp.flush()
+                os.fsync(self.fp.fileno())
+                labels.extend(replayed)
+            try:
+                os.unlink(orphan)
+            except OSError as e:
+                # Another process starting at the same time claimed it.
+                if e.errno != errno.ENOENT:
+                    raise
+        return labels
+
+
+class WriteBehindLabelStore(object):
+    '''A label store whose writes go through a :class:`LabelWriteQueue`.
+
+    Writes are queued, and :meth:`directly_connected` merges pending
+    labels with the ones in the label store. Every other method is
+    passed through to the wrapped label store.
+
+    .. automethod:: __init__
+    .. automethod:: put
+    .. automethod:: directly_connected
+    '''
+    def __init__(self, label_store, queue):
+        '''Wrap a label store.
+
+        :param label_store: The label store to read from.
+        :type label_store: :class:`dossier.label.LabelStore`
+        :param queue: The queue to write to.
+        :type queue: :class:`LabelWriteQueue`
+        '''
+        self.label_store = label_store
+        self.queue = queue
+
+    def put(self, *labels):
+        '''Queue labels to be written.'''
+        self.queue.put(*labels)
+
+    def directly_connected(self, ident):
+        '''Return labels connected to ``ident``, including pending ones.
+
+        See :meth:`dossier.label.LabelStore.directly_connected`.
+        '''
+        pending = self.queue.pending(ident)
+        stored = self.label_store.directly_connected(ident)
+        if len(pending) == 0:
+            return stored
+        labels = list(stored)
+        for lab in pending:
+            labels = [old for old in labels if not old.same_subject_as(lab)]
+            labels.append(lab)
+        return sorted(labels)
+
+    def __getattr__(self, name):
+        return getattr(self.label_store, name)
+
+
+def is_orphan(path, orphan):
+    '''Return true if ``orphan`` is a queue file of no running process.
+
+    ``path`` itself (from before queue files had a process id) is
+    always an orphan.
+    '''
+    if orphan == path:
+        return os.path.isfile(orphan)
+    pid = orphan[len(path) + 1:]
+    if not pid.isdigit():
+        return False
+    try:
+        os.kill(int(pid), 0)
+    except OSError as e:
+        return e.errno == errno.ESRCH
+    return False
+
+
+def read_labels(path):
+    '''Return the labels in a queue file.
+
+    Returns ``(labels, end)``, where ``end`` is the byte offset after
+    the last complete label.
+    '''
+    labels, end = [], 0
+    try:
+        fp = open(path, 'rb')
+    except IOError as e:
+        if e.errno == errno.ENOENT:
+            return labels, end
+        raise
+    with fp:
+        size = os.fstat(fp.fileno()).st_size
+        while end < size:
+            try:
+                labels.append(record_to_label(cbor.load(fp)))
+            except Exception:
+                # A partial record at the end of the file is from a
+                # write that was never acknowledged.
+                logger.warn('ignoring partial label at byte %d of %s',
+                            end, path)
+                break
+            end = fp.tell()
+    return labels, end
+
+
+def label_to_record(lab):
+    return [lab.content_id1, lab.content_id2, lab.subtopic_id1,
+            lab.subtopic_id2, lab.annotator_id, lab.value.value,
+            lab.epoch_ticks, lab.rating, lab.meta]
+
+
+def record_to_label(rec):
+    (cid1, cid2, subid1, subid2, annotator_id, value,
+     epoch_ticks, rating, meta) = rec
+    return Label(cid1, cid2, annotator_id, CorefValue(value),
+                 subtopic_id1=subid1, subtopic_id2=subid2,
+                 epoch_ticks=epoch_ticks, rating=rating, meta=meta)
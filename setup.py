@@ -56,6 +56,7 @@ setup(
     entry_points={
         'console_scripts': [
             'dossier.web = dossier.web.run:main',
+            'dossier.web.loadtest = dossier.web.loadtest:main',
         ],
     },
 )